@@ -0,0 +1,358 @@
+"""
+Servidor HTTP local que imita la parte de la API de Google Drive v3 que usa el bot:
+subida resumible, creación de carpetas, listado por carpeta, cambio de padres, borrado
+y peticiones batch.
+
+Se arranca en un hilo y el bot lo usa a través de DRIVE_API_ROOT_URL, de modo que el
+código real de googleapiclient (ProgressMediaUpload, list_drive_videos, delete_from_drive)
+habla HTTP de verdad contra él. Latencia, ancho de banda y errores son configurables.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+@dataclass
+class FakeDriveConfig:
+    latency: float = 0.0 # Segundos añadidos a cada petición
+    bandwidth: float = 0.0 # Bytes/s de subida por conexión (0 = sin límite)
+    error_rate: float = 0.0 # Probabilidad de responder 503 a un chunk de subida
+    md5_corruption_rate: float = 0.0 # Probabilidad de devolver un md5Checksum incorrecto
+    seed: int = 0
+
+
+class FakeDriveServer:
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or FakeDriveConfig()
+        self._random = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self.files = {} # {file_id: metadata}
+        self.sessions = {} # {upload_id: {'metadata': ..., 'received': ..., 'total': ..., 'md5': ...}}
+        self.stats = {'requests': 0, 'chunks': 0, 'bytes': 0, 'errors_injected': 0, 'deletes': 0, 'batches': 0, 'updates': 0,
+                      'sessions_cancelled': 0}
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def root_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-drive", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_file(self, name, size=0, mime_type='video/mp4', parents=None):
+        """Crea un archivo directamente (para preparar escenarios de listado/borrado)."""
+        file_id = uuid.uuid4().hex
+        metadata = self._metadata(file_id, name, mime_type, size, hashlib.md5().hexdigest())
+        metadata['parents'] = list(parents or [])
+        with self._lock:
+            self.files[file_id] = metadata
+        return file_id
+
+    def _chance(self, rate):
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    @staticmethod
+    def _metadata(file_id, name, mime_type, size, md5):
+        return {
+            'id': file_id,
+            'name': name,
+            'mimeType': mime_type,
+            'size': str(size),
+            'md5Checksum': md5,
+            'createdTime': datetime.now(timezone.utc).isoformat(),
+            'parents': [],
+            'isAppAuthorized': True, # Todo lo que guarda este servidor lo subió el bot
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _read_body(self, throttle=False):
+                length = int(self.headers.get('Content-Length') or 0)
+                remaining = length
+                chunks = []
+                start = time.monotonic()
+                while remaining > 0:
+                    data = self.rfile.read(min(remaining, 64 * 1024))
+                    if not data:
+                        break
+                    chunks.append(data)
+                    remaining -= len(data)
+                    if throttle and server.config.bandwidth > 0:
+                        expected = (length - remaining) / server.config.bandwidth
+                        delay = expected - (time.monotonic() - start)
+                        if delay > 0:
+                            time.sleep(delay)
+                return b''.join(chunks)
+
+            def _send(self, status, body=b'', headers=None, content_type='application/json'):
+                if isinstance(body, (dict, list)):
+                    body = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    for key, value in (headers or {}).items():
+                        self.send_header(key, value)
+                    if body:
+                        self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    if body:
+                        self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True # El cliente abortó la petición (cancelación)
+
+            def _begin(self):
+                server._count('requests')
+                if server.config.latency > 0:
+                    time.sleep(server.config.latency)
+                parsed = urlparse(self.path)
+                return parsed.path, {k: v[0] for k, v in parse_qs(parsed.query).items()}
+
+            def do_POST(self):
+                path, query = self._begin()
+                if path == '/upload/drive/v3/files' and query.get('uploadType') == 'resumable':
+                    metadata = json.loads(self._read_body() or b'{}')
+                    missing = [p for p in metadata.get('parents', []) if p not in server.files]
+                    if missing:
+                        self._send(404, {'error': {'code': 404, 'message': f'File not found: {missing[0]}.'}})
+                        return
+                    upload_id = uuid.uuid4().hex
+                    total = self.headers.get('X-Upload-Content-Length')
+                    with server._lock:
+                        server.sessions[upload_id] = {
+                            'metadata': metadata,
+                            'mime_type': self.headers.get('X-Upload-Content-Type', 'application/octet-stream'),
+                            'received': 0,
+                            'total': int(total) if total else None,
+                            'md5': hashlib.md5(),
+                            'fields': query.get('fields'),
+                        }
+                    location = f"{server.root_url}upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+                    self._send(200, headers={'Location': location})
+                elif path == '/drive/v3/files':
+                    # Solo metadatos (p. ej. crear una carpeta)
+                    body = json.loads(self._read_body() or b'{}')
+                    file_id = uuid.uuid4().hex
+                    metadata = server._metadata(file_id, body.get('name', 'Sin_nombre'),
+                                                body.get('mimeType', 'application/octet-stream'), 0, hashlib.md5().hexdigest())
+                    metadata['parents'] = body.get('parents', [])
+                    metadata['appProperties'] = body.get('appProperties', {})
+                    with server._lock:
+                        server.files[file_id] = metadata
+                    self._send(200, metadata)
+                elif path == '/batch/drive/v3':
+                    self._handle_batch()
+                else:
+                    self._read_body()
+                    self._send(404, {'error': {'code': 404, 'message': f'Ruta no soportada: {path}'}})
+
+            def do_PUT(self):
+                path, query = self._begin()
+                session = server.sessions.get(query.get('upload_id'))
+                if path != '/upload/drive/v3/files' or session is None:
+                    self._read_body()
+                    self._send(404, {'error': {'code': 404, 'message': 'Sesión de subida no encontrada.'}})
+                    return
+                data = self._read_body(throttle=True)
+                server._count('chunks')
+                if server._chance(server.config.error_rate):
+                    server._count('errors_injected')
+                    self._send(503, {'error': {'code': 503, 'message': 'Error inyectado.'}})
+                    return
+
+                content_range = self.headers.get('Content-Range', '')
+                # Formatos: "bytes a-b/total", "bytes a-b/*" o "bytes */total" (consulta de estado)
+                spec, _, total = content_range.replace('bytes ', '').partition('/')
+                if total and total != '*':
+                    session['total'] = int(total)
+                if spec != '*' and data:
+                    begin = int(spec.split('-')[0])
+                    if begin == session['received']:
+                        session['md5'].update(data)
+                        session['received'] += len(data)
+                        server._count('bytes', len(data))
+
+                if session['total'] is not None and session['received'] >= session['total']:
+                    self._finish_upload(query['upload_id'], session)
+                    return
+                headers = {'Range': f"bytes=0-{session['received'] - 1}"} if session['received'] else {}
+                self._send(308, headers=headers)
+
+            def _finish_upload(self, upload_id, session):
+                md5 = session['md5'].hexdigest()
+                if server._chance(server.config.md5_corruption_rate):
+                    server._count('errors_injected')
+                    md5 = hashlib.md5(md5.encode()).hexdigest()
+                file_id = uuid.uuid4().hex
+                metadata = server._metadata(file_id, session['metadata'].get('name', 'Sin_nombre'),
+                                            session['mime_type'], session['received'], md5)
+                metadata['parents'] = session['metadata'].get('parents', [])
+                with server._lock:
+                    server.files[file_id] = metadata
+                    server.sessions.pop(upload_id, None)
+                self._send(200, metadata)
+
+            def do_GET(self):
+                path, query = self._begin()
+                if path == '/drive/v3/files':
+                    with server._lock:
+                        items = sorted(server.files.values(), key=lambda f: f['createdTime'], reverse=True)
+                    items = [f for f in items if _matches_query(query.get('q', ''), f)]
+                    page_size = int(query.get('pageSize', 100))
+                    offset = int(query.get('pageToken', 0))
+                    page = items[offset:offset + page_size]
+                    body = {'files': page}
+                    if offset + page_size < len(items):
+                        body['nextPageToken'] = str(offset + page_size)
+                    self._send(200, body)
+                elif path.startswith('/drive/v3/files/'):
+                    file_id = path.rsplit('/', 1)[1]
+                    metadata = server.files.get(file_id)
+                    if metadata:
+                        self._send(200, metadata)
+                    else:
+                        self._send(404, {'error': {'code': 404, 'message': 'File not found'}})
+                else:
+                    self._send(404, {'error': {'code': 404, 'message': f'Ruta no soportada: {path}'}})
+
+            def do_PATCH(self):
+                path, query = self._begin()
+                self._read_body()
+                metadata = server.files.get(path.rsplit('/', 1)[1]) if path.startswith('/drive/v3/files/') else None
+                if metadata is None:
+                    self._send(404, {'error': {'code': 404, 'message': 'File not found'}})
+                    return
+                with server._lock:
+                    removed = set(filter(None, query.get('removeParents', '').split(',')))
+                    metadata['parents'] = [p for p in metadata['parents'] if p not in removed]
+                    metadata['parents'] += [p for p in query.get('addParents', '').split(',') if p]
+                    server.stats['updates'] += 1
+                self._send(200, metadata)
+
+            def do_DELETE(self):
+                path, query = self._begin()
+                self._read_body()
+                if path == '/upload/drive/v3/files':
+                    # Cancelar una subida resumible: Drive responde 499
+                    with server._lock:
+                        found = server.sessions.pop(query.get('upload_id'), None) is not None
+                        if found:
+                            server.stats['sessions_cancelled'] += 1
+                    self._send(499 if found else 404)
+                    return
+                status = server._delete(path.rsplit('/', 1)[1]) if path.startswith('/drive/v3/files/') else 404
+                self._send(status)
+
+            def _handle_batch(self):
+                server._count('batches')
+                content_type = self.headers.get('Content-Type', '')
+                boundary = content_type.split('boundary=', 1)[1].strip('"') if 'boundary=' in content_type else ''
+                body = self._read_body().decode('utf-8', 'replace')
+                out_boundary = uuid.uuid4().hex
+                parts = []
+                for raw_part in body.split(f'--{boundary}'):
+                    raw_part = raw_part.strip()
+                    if not raw_part or raw_part == '--':
+                        continue
+                    part_headers, _, inner = raw_part.replace('\r\n', '\n').partition('\n\n')
+                    content_id = ''
+                    for line in part_headers.split('\n'):
+                        if line.lower().startswith('content-id:'):
+                            content_id = line.split(':', 1)[1].strip()
+                    request_line = inner.split('\n', 1)[0].split()
+                    method, inner_path = (request_line + ['', ''])[:2]
+                    if method == 'DELETE' and inner_path.startswith('/drive/v3/files/'):
+                        status = server._delete(urlparse(inner_path).path.rsplit('/', 1)[1])
+                    else:
+                        status = 404
+                    reason = {204: 'No Content', 404: 'Not Found'}.get(status, 'OK')
+                    response_id = f"<response-{content_id[1:-1]}>" if content_id else ''
+                    parts.append(
+                        f"--{out_boundary}\r\nContent-Type: application/http\r\nContent-ID: {response_id}\r\n\r\n"
+                        f"HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\n\r\n"
+                    )
+                payload = (''.join(parts) + f"--{out_boundary}--\r\n").encode()
+                self._send(200, payload, content_type=f'multipart/mixed; boundary={out_boundary}')
+
+        return Handler
+
+    def _delete(self, file_id):
+        with self._lock:
+            if self.files.pop(file_id, None) is None:
+                return 404
+            self.stats['deletes'] += 1
+        return 204
+
+
+_APP_PROPERTY = re.compile(r"appProperties has \{ key='([^']*)' and value='([^']*)' \}")
+_CLAUSES = {
+    'parent': re.compile(r"^'([^']*)' in parents$"),
+    'name_contains': re.compile(r"^name contains '([^']*)'$"),
+    'mime_type': re.compile(r"^mimeType = '([^']*)'$"),
+    'mime_contains': re.compile(r"^mimeType contains '([^']*)'$"),
+}
+
+
+def _matches_query(q, metadata):
+    """Evalúa el subconjunto de la sintaxis q de Drive que usa el bot (cláusulas unidas por 'and')."""
+    for key, value in _APP_PROPERTY.findall(q):
+        if metadata.get('appProperties', {}).get(key) != value:
+            return False
+    for clause in _APP_PROPERTY.sub('', q).split(' and '):
+        clause = clause.strip()
+        if not clause or clause == 'trashed = false':
+            continue
+        match = _CLAUSES['parent'].match(clause)
+        if match:
+            parent = match.group(1)
+            # Los archivos sin padres están en la raíz ('root')
+            if parent not in metadata['parents'] and not (parent == 'root' and not metadata['parents']):
+                return False
+            continue
+        match = _CLAUSES['name_contains'].match(clause)
+        if match:
+            if match.group(1) not in metadata['name']:
+                return False
+            continue
+        match = _CLAUSES['mime_type'].match(clause)
+        if match:
+            if metadata['mimeType'] != match.group(1):
+                return False
+            continue
+        match = _CLAUSES['mime_contains'].match(clause)
+        if match:
+            if match.group(1) not in metadata['mimeType']:
+                return False
+            continue
+        raise ValueError(f"Cláusula de consulta no soportada: {clause}")
+    return True
@@ -0,0 +1,225 @@
+"""
+Cliente de Telegram falso con la misma superficie que usa el bot de pyrogram.Client:
+send_message, edit_message_text, get_messages, download_media y stream_media, más mensajes
+con reply_text/edit_text.
+
+download_media y stream_media generan datos sintéticos con el ancho de banda configurado
+(por descarga y por sesión), y tanto las ediciones como las descargas pueden recibir
+FLOOD_WAIT como haría Telegram. Cada instancia representa una sesión.
+"""
+import asyncio
+import itertools
+import os
+import random
+import time
+from dataclasses import dataclass, field
+
+from pyrogram.errors import FloodWait
+
+_SYNTHETIC_BLOCK = os.urandom(1024 * 1024)
+
+
+@dataclass
+class FakeUser:
+    id: int
+    first_name: str = "Bench"
+    username: str = None
+
+
+@dataclass
+class FakeChat:
+    id: int
+
+
+@dataclass
+class FakeMedia:
+    """Video, documento, audio o animación: los campos que usa el bot son los mismos."""
+    file_unique_id: str
+    file_name: str
+    file_size: int
+    mime_type: str = 'video/mp4'
+
+
+@dataclass
+class FakeMessage:
+    client: "FakeTelegramClient"
+    id: int
+    chat: FakeChat
+    from_user: FakeUser = None
+    text: str = None
+    video: FakeMedia = None
+    document: FakeMedia = None
+    audio: FakeMedia = None
+    animation: FakeMedia = None
+    reply_to_message_id: int = None
+    media_group_id: str = None # Mismo valor en todos los mensajes de un álbum
+    matches: list = field(default_factory=list)
+
+    async def reply_text(self, text, reply_to_message_id=None, **kwargs):
+        return await self.client.send_message(self.chat.id, text, reply_to_message_id=reply_to_message_id or self.id, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        return await self.client.edit_message_text(self.chat.id, self.id, text, **kwargs)
+
+
+@dataclass
+class FakeCallbackQuery:
+    data: str
+    from_user: FakeUser
+    message: FakeMessage
+    answers: list = field(default_factory=list)
+
+    async def answer(self, text=None, show_alert=False, **kwargs):
+        self.answers.append(text)
+
+
+@dataclass
+class FakeTelegramConfig:
+    latency: float = 0.0 # Segundos por llamada a la API (send/edit)
+    download_bandwidth: float = 0.0 # Bytes/s por descarga (0 = sin límite)
+    download_part_size: int = 1024 * 1024 # Tamaño de cada parte descargada
+    session_bandwidth: float = 0.0 # Bytes/s de la sesión, compartidos por todas sus descargas (0 = sin límite)
+    download_flood_wait_rate: float = 0.0 # Probabilidad de FLOOD_WAIT por parte descargada
+    download_flood_wait: int = 5 # Segundos del FLOOD_WAIT de descarga
+    flood_wait_rate: float = 0.0 # Probabilidad de FLOOD_WAIT en una edición
+    max_messages: int = 0 # Mensajes recordados (0 = sin límite); los más antiguos se olvidan, como si se borraran
+    seed: int = 0
+
+
+class FakeTelegramClient:
+    def __init__(self, workdir, config=None):
+        self.workdir = workdir
+        self.config = config or FakeTelegramConfig()
+        self._random = random.Random(self.config.seed)
+        self._ids = itertools.count(1)
+        self.messages = {} # {message_id: FakeMessage}
+        self.stats = {'sends': 0, 'edits': 0, 'flood_waits': 0, 'downloads': 0, 'downloaded_bytes': 0, 'download_flood_waits': 0}
+        self._session_free_at = 0.0 # Instante en que la sesión termina de "enviar" lo ya reservado
+        self.edit_listeners = [] # Funciones (message, text) llamadas en cada intento de edición
+        self.is_connected = True
+        os.makedirs(workdir, exist_ok=True)
+
+    def _remember(self, message):
+        self.messages[message.id] = message
+        if self.config.max_messages and len(self.messages) > self.config.max_messages:
+            self.messages.pop(next(iter(self.messages)))
+
+    def make_callback_query(self, user_id, data, message):
+        return FakeCallbackQuery(data=data, from_user=FakeUser(user_id), message=message)
+
+    def make_video_message(self, user_id, size, file_name='clip.mp4'):
+        return self.make_media_message(user_id, size, file_name)
+
+    def make_media_message(self, user_id, size, file_name='clip.mp4', kind='video', mime_type='video/mp4', media_group_id=None):
+        message_id = next(self._ids)
+        message = FakeMessage(
+            client=self,
+            id=message_id,
+            chat=FakeChat(user_id),
+            from_user=FakeUser(user_id, username=f"user{user_id}"),
+            media_group_id=media_group_id,
+        )
+        setattr(message, kind, FakeMedia(file_unique_id=f"U{message_id}", file_name=file_name, file_size=size, mime_type=mime_type))
+        self._remember(message)
+        return message
+
+    def make_text_message(self, user_id, text):
+        message_id = next(self._ids)
+        message = FakeMessage(client=self, id=message_id, chat=FakeChat(user_id), from_user=FakeUser(user_id), text=text)
+        self._remember(message)
+        return message
+
+    async def _api_call(self):
+        if self.config.latency > 0:
+            await asyncio.sleep(self.config.latency)
+
+    async def send_message(self, chat_id, text, reply_to_message_id=None, **kwargs):
+        await self._api_call()
+        self.stats['sends'] += 1
+        message_id = next(self._ids)
+        message = FakeMessage(client=self, id=message_id, chat=FakeChat(chat_id), text=text, reply_to_message_id=reply_to_message_id)
+        self._remember(message)
+        return message
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await self._api_call()
+        message = self.messages.get(message_id)
+        if message is None:
+            raise Exception("Message to edit not found")
+        # Los listeners ven cada intento de edición, aunque Telegram lo rechace con FLOOD_WAIT
+        for listener in self.edit_listeners:
+            listener(message, text)
+        if self.config.flood_wait_rate > 0 and self._random.random() < self.config.flood_wait_rate:
+            self.stats['flood_waits'] += 1
+            raise FloodWait(value=1)
+        self.stats['edits'] += 1
+        message.text = text
+        return message
+
+    async def get_messages(self, chat_id, message_ids):
+        await self._api_call()
+        if isinstance(message_ids, list):
+            return [self.messages.get(message_id) for message_id in message_ids]
+        return self.messages.get(message_ids)
+
+    async def _transfer_part(self, length, started, done):
+        """Espera lo que tardaría una parte según el ancho de banda por descarga y por sesión."""
+        if self.config.download_flood_wait_rate > 0 and self._random.random() < self.config.download_flood_wait_rate:
+            self.stats['download_flood_waits'] += 1
+            raise FloodWait(value=self.config.download_flood_wait)
+        delay = 0.0
+        if self.config.session_bandwidth > 0:
+            now = time.monotonic()
+            self._session_free_at = max(self._session_free_at, now) + length / self.config.session_bandwidth
+            delay = self._session_free_at - now
+        if self.config.download_bandwidth > 0:
+            delay = max(delay, (done + length) / self.config.download_bandwidth - (time.monotonic() - started))
+        await asyncio.sleep(max(delay, 0))
+        self.stats['downloaded_bytes'] += length
+
+    async def download_media(self, message, file_name=None, progress=None, progress_args=()):
+        media = _media_of(message)
+        size = media.file_size
+        path = os.path.join(self.workdir, f"{media.file_unique_id}_{media.file_name}")
+        part_size = self.config.download_part_size
+        started = time.monotonic()
+        written = 0
+        try:
+            with open(path, 'wb') as f:
+                while written < size:
+                    length = min(part_size, size - written)
+                    await self._transfer_part(length, started, written)
+                    await asyncio.to_thread(_write_synthetic, f, length)
+                    written += length
+                    if progress:
+                        progress(written, size, *progress_args)
+        except BaseException:
+            # Como pyrogram: una descarga cancelada o fallida no deja el archivo parcial
+            os.remove(path)
+            raise
+        self.stats['downloads'] += 1
+        return path
+
+    async def stream_media(self, message, limit=0, offset=0):
+        """Como en pyrogram: offset y limit cuentan bloques de 1 MiB."""
+        size = _media_of(message).file_size
+        chunk_size = 1024 * 1024
+        position = offset * chunk_size
+        end = size if not limit else min(size, (offset + limit) * chunk_size)
+        started = time.monotonic()
+        while position < end:
+            length = min(chunk_size, end - position)
+            await self._transfer_part(length, started, position - offset * chunk_size)
+            yield _SYNTHETIC_BLOCK[:length]
+            position += length
+
+
+def _media_of(message):
+    return message.video or message.document or message.audio or message.animation
+
+
+def _write_synthetic(f, length):
+    while length > 0:
+        block = _SYNTHETIC_BLOCK[:min(length, len(_SYNTHETIC_BLOCK))]
+        f.write(block)
+        length -= len(block)
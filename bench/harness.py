@@ -0,0 +1,157 @@
+"""
+Entorno compartido por los benchmarks: arranca el servidor Drive falso, importa el
+bot apuntando a él y prepara un cliente de Telegram falso y usuarios autenticados.
+
+El bot guarda su estado en variables globales del módulo, así que cada escenario
+debe ejecutarse en su propio proceso (run_benchmarks.py ya lo hace).
+"""
+import asyncio
+import dataclasses
+import importlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from bench.fake_drive import FakeDriveServer, FakeDriveConfig
+from bench.fake_telegram import FakeTelegramClient, FakeTelegramConfig
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Configuración OAuth ficticia: basta para generar enlaces de /drive_login sin red
+FAKE_CLIENT_CONFIG = {
+    'web': {
+        'client_id': 'bench.apps.googleusercontent.com',
+        'client_secret': 'bench',
+        'auth_uri': 'https://accounts.google.com/o/oauth2/auth',
+        'token_uri': 'https://oauth2.googleapis.com/token',
+        'redirect_uris': ['http://localhost/oauth2callback'],
+    }
+}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def peak_rss_mb():
+    # En Linux ru_maxrss está en KiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class BenchEnvironment:
+    def __init__(self, drive_config=None, telegram_config=None, download_sessions=0):
+        self.drive = FakeDriveServer(drive_config or FakeDriveConfig())
+        self.telegram_config = telegram_config or FakeTelegramConfig()
+        self.download_sessions = download_sessions # Sesiones extra de descarga (cada una con su propio límite)
+        self.workdir = tempfile.mkdtemp(prefix="bot-bench-")
+        self.bot = None
+        self.client = None
+        self.download_clients = [] # Sesiones extra registradas en bot.download_pool
+        self.worker = None
+        self.trace_exporter = None
+        self.enqueued_at = {} # {video_message_id: instante de encolado}
+        self.enqueued_chat = {} # {video_message_id: chat_id}
+        self.completed = {} # {video_message_id: (instante, éxito)}
+
+    def __enter__(self):
+        self.drive.start()
+        os.environ.setdefault("TELEGRAM_API_ID", "1")
+        os.environ.setdefault("TELEGRAM_API_HASH", "bench")
+        os.environ.setdefault("TELEGRAM_BOT_TOKEN", "1:bench")
+        os.environ["DRIVE_API_ROOT_URL"] = self.drive.root_url
+        os.environ.setdefault("GOOGLE_CREDENTIALS_JSON", json.dumps(FAKE_CLIENT_CONFIG))
+        # Sin lotes salvo que el escenario los pida: así cada video mide su propio recorrido
+        os.environ.setdefault("BATCH_WINDOW", "0")
+        # Sin cuotas ni límite de cola salvo que el escenario los pida: los benchmarks encolan ráfagas enormes
+        for name in ("QUOTA_MAX_QUEUED", "QUOTA_MAX_QUEUED_MB", "QUOTA_UPLOADS_PER_HOUR", "QUEUE_HIGH_WATER"):
+            os.environ.setdefault(name, "0")
+        if REPO_ROOT not in sys.path:
+            sys.path.insert(0, REPO_ROOT)
+        os.chdir(self.workdir) # La sesión de pyrogram y los temporales quedan fuera del repo
+        self.bot = importlib.import_module("bot")
+        self.client = FakeTelegramClient(os.path.join(self.workdir, "downloads"), self.telegram_config)
+        self.client.edit_listeners.append(self._on_edit)
+        for n in range(1, self.download_sessions + 1):
+            config = dataclasses.replace(self.telegram_config, seed=self.telegram_config.seed + n)
+            session = FakeTelegramClient(os.path.join(self.workdir, "downloads"), config)
+            self.download_clients.append(session)
+            self.bot.download_pool.add(f"bench_dl{n}", session)
+        return self
+
+    def __exit__(self, *exc):
+        self.drive.stop()
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def add_user(self, user_id):
+        from google.oauth2.credentials import Credentials
+        self.bot.user_credentials[user_id] = Credentials(token=f"bench-{user_id}")
+        self.bot.approved_users.add(user_id)
+
+    def _on_edit(self, message, text):
+        # Los mensajes de estado responden al archivo original; el texto final empieza por ✅ o ❌
+        if message.reply_to_message_id is None or message.reply_to_message_id in self.completed:
+            return
+        if "Lote terminado:" in text:
+            # El estado de un lote responde a su primer archivo: "Lote terminado: X de N archivos..."
+            uploaded, total = (int(n) for n in text.split("Lote terminado: ", 1)[1].split(" archivos", 1)[0].split(" de "))
+            members = sorted(mid for mid, chat_id in self.enqueued_chat.items()
+                             if chat_id == message.chat.id and mid >= message.reply_to_message_id and mid not in self.completed)
+            for mid in members[:total]:
+                self.completed[mid] = (time.monotonic(), uploaded == total)
+        elif (text.startswith("✅ ¡") and "subido exitosamente" in text) or text.startswith("❌"):
+            self.completed[message.reply_to_message_id] = (time.monotonic(), text.startswith("✅"))
+
+    async def start_worker(self):
+        self.worker = asyncio.create_task(self.bot.process_upload_queue(self.client))
+        self.bot.queue_processor_task = self.worker
+        if self.bot.tracer is not None:
+            # Como en producción: las trazas se vuelcan a TRACE_PATH (dentro de workdir) durante la medición
+            self.trace_exporter = asyncio.create_task(self.bot.export_traces())
+
+    async def stop_worker(self):
+        for task in (self.worker, self.trace_exporter):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+    async def enqueue_video(self, user_id, size, file_name='clip.mp4', kind='video', mime_type='video/mp4', media_group_id=None):
+        message = self.client.make_media_message(user_id, size, file_name, kind, mime_type, media_group_id)
+        self.enqueued_at[message.id] = time.monotonic()
+        self.enqueued_chat[message.id] = message.chat.id
+        await self.bot.handle_media(self.client, message)
+        return message
+
+    def find_task_id(self, message_id):
+        """task_id de un video en cola o en proceso, o None si ya terminó."""
+        for task_id, info in list(self.bot.queued_tasks.items()):
+            if info.get('message_id') == message_id:
+                return task_id
+        for task_id, operation in list(self.bot.active_operations.items()):
+            message = operation.get('message')
+            if message is not None and message.id == message_id:
+                return task_id
+        return None
+
+    async def wait_for_completion(self, expected, timeout):
+        deadline = time.monotonic() + timeout
+        while len(self.completed) < expected:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Solo terminaron {len(self.completed)}/{expected} tareas en {timeout}s.")
+            await asyncio.sleep(0.05)
+
+    def latencies(self):
+        return [done - self.enqueued_at[mid] for mid, (done, _) in self.completed.items() if mid in self.enqueued_at]
+
+    def failures(self):
+        return sum(1 for _, ok in self.completed.values() if not ok)
@@ -0,0 +1,335 @@
+"""
+Benchmarks offline del pipeline de subida.
+
+Ejecuta el código real de process_upload_queue, ProgressMediaUpload y
+delete_all_user_videos contra un servidor Drive local y un cliente de Telegram falso,
+y reporta archivos/min, MB/s, latencia extremo a extremo (p50/p95) y RSS máximo.
+
+Uso (desde la raíz del repositorio):
+    python -m bench.run_benchmarks
+    python -m bench.run_benchmarks --scenario many_small_clips --drive-latency 0.02 --drive-bandwidth 20
+    python -m bench.run_benchmarks --scale 0.1 --json resultados.json
+    python -m bench.run_benchmarks --scenario few_huge_files --telegram-session-bandwidth 10 --download-sessions 3
+    python -m bench.run_benchmarks --scenario bulk_forward --batch-window 0   # comparar con el valor por defecto
+    python -m bench.run_benchmarks --scenario cancel_latency --telegram-bandwidth 0.5 --drive-bandwidth 0.5
+    python -m bench.run_benchmarks --scenario spike_shedding --queue-high-water 0 --quota-max-queued 0   # sin control de admisión
+
+Cada escenario corre en un subproceso para que el estado global del bot y el RSS
+máximo no se mezclen entre escenarios.
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from bench.fake_drive import FakeDriveConfig
+from bench.fake_telegram import FakeTelegramConfig
+from bench.harness import BenchEnvironment, REPO_ROOT, percentile, peak_rss_mb
+
+MiB = 1024 * 1024
+
+# {nombre: (usuarios, archivos por usuario, tamaño de cada archivo en bytes)}
+UPLOAD_SCENARIOS = {
+    'many_small_clips': (10, 20, 1 * MiB),
+    'few_huge_files': (1, 3, 200 * MiB),
+    'many_users': (100, 2, 4 * MiB),
+}
+# Ráfagas: cada usuario reenvía todos sus videos de golpe (se agrupan en lotes con --batch-window > 0).
+# {nombre: (usuarios, archivos por usuario, tamaño, archivos por álbum o 0 si son mensajes sueltos)}
+BATCH_SCENARIOS = {
+    'bulk_forward': (5, 50, 256 * 1024, 0),
+    'albums': (5, 50, 256 * 1024, 10), # Telegram admite hasta 10 archivos por álbum
+}
+DELETE_SCENARIOS = {
+    'delete_all': 1500, # Archivos a borrar con delete_all_user_videos (más de una página del listado)
+}
+# {nombre: (cancelaciones, tamaño de cada archivo)}: la mitad durante la descarga y la mitad durante la subida,
+# con enlaces lentos (1 MiB/s si no se indica otro ancho de banda) para que cada parte/chunk tarde en llegar
+CANCEL_SCENARIOS = {
+    'cancel_latency': (12, 16 * MiB),
+}
+# Pico de tráfico con control de admisión: {nombre: (usuarios, archivos por usuario, tamaño)}; los límites
+# salen de --quota-max-queued y --queue-high-water
+SHEDDING_SCENARIOS = {
+    'spike_shedding': (40, 10, 1 * MiB),
+}
+SCENARIOS = (list(UPLOAD_SCENARIOS) + list(BATCH_SCENARIOS) + list(DELETE_SCENARIOS) + list(CANCEL_SCENARIOS)
+             + list(SHEDDING_SCENARIOS))
+
+
+def build_configs(args):
+    drive = FakeDriveConfig(
+        latency=args.drive_latency,
+        bandwidth=args.drive_bandwidth * MiB,
+        error_rate=args.error_rate,
+        md5_corruption_rate=args.md5_corruption_rate,
+        seed=args.seed,
+    )
+    telegram = FakeTelegramConfig(
+        latency=args.telegram_latency,
+        download_bandwidth=args.telegram_bandwidth * MiB,
+        session_bandwidth=args.telegram_session_bandwidth * MiB,
+        flood_wait_rate=args.flood_wait_rate,
+        download_flood_wait_rate=args.download_flood_wait_rate,
+        seed=args.seed,
+    )
+    return drive, telegram
+
+
+async def run_upload_scenario(env, users, files_per_user, size, timeout, burst=False, album_size=0):
+    for user_id in range(1, users + 1):
+        env.add_user(user_id)
+    await env.start_worker()
+    started = time.monotonic()
+    if burst:
+        # Cada usuario reenvía todos sus videos seguidos
+        for user_id in range(1, users + 1):
+            for n in range(files_per_user):
+                media_group_id = f"{user_id}-{n // album_size}" if album_size else None
+                await env.enqueue_video(user_id, size, f"clip_{n}.mp4", media_group_id=media_group_id)
+    else:
+        # Intercalar usuarios, como llegarían mensajes de varios chats a la vez
+        for n in range(files_per_user):
+            for user_id in range(1, users + 1):
+                await env.enqueue_video(user_id, size, f"clip_{n}.mp4")
+    total = users * files_per_user
+    await env.wait_for_completion(total, timeout)
+    elapsed = time.monotonic() - started
+    await env.stop_worker()
+
+    latencies = env.latencies()
+    metrics = env.bot.metrics
+    return {
+        'files': total,
+        'failed': env.failures(),
+        'elapsed_s': round(elapsed, 3),
+        'files_per_min': round(total / elapsed * 60, 2),
+        'mb_per_s': round(total * size / MiB / elapsed, 2),
+        'latency_p50_s': round(percentile(latencies, 0.5), 3),
+        'latency_p95_s': round(percentile(latencies, 0.95), 3),
+        'download_p50_s': metrics.quantile("bot_stage_seconds", 0.5, stage="download"),
+        'upload_p50_s': metrics.quantile("bot_stage_seconds", 0.5, stage="upload"),
+        'telegram_sends': env.client.stats['sends'],
+        'telegram_edits': env.client.stats['edits'],
+        'flood_waits': env.client.stats['flood_waits'],
+        'download_flood_waits': sum(c.stats['download_flood_waits'] for c in [env.client] + env.download_clients),
+        'drive_requests': env.drive.stats['requests'],
+    }
+
+
+async def run_shedding_scenario(env, users, files_per_user, size, timeout):
+    """Todos los usuarios envían a la vez; mide cuántos archivos se rechazan y la latencia de los aceptados."""
+    for user_id in range(1, users + 1):
+        env.add_user(user_id)
+    await env.start_worker()
+    started = time.monotonic()
+    for n in range(files_per_user):
+        for user_id in range(1, users + 1):
+            await env.enqueue_video(user_id, size, f"clip_{n}.mp4")
+    total = users * files_per_user
+    # Los rechazados reciben al momento una respuesta "🚦 ..." y no entran en la cola
+    rejected = [m for m in env.client.messages.values() if m.text and m.text.startswith("🚦")]
+    for message in rejected:
+        env.enqueued_at.pop(message.reply_to_message_id, None)
+    accepted = total - len(rejected)
+    await env.wait_for_completion(accepted, timeout)
+    elapsed = time.monotonic() - started
+    await env.stop_worker()
+
+    latencies = env.latencies()
+    return {
+        'files': total,
+        'failed': env.failures(),
+        'rejected': len(rejected),
+        'elapsed_s': round(elapsed, 3),
+        'files_per_min': round(accepted / elapsed * 60, 2),
+        'latency_p50_s': round(percentile(latencies, 0.5), 3),
+        'latency_p95_s': round(percentile(latencies, 0.95), 3),
+        'telegram_sends': env.client.stats['sends'],
+        'telegram_edits': env.client.stats['edits'],
+    }
+
+
+async def run_delete_scenario(env, count, timeout):
+    user_id = 1
+    env.add_user(user_id)
+    for n in range(count):
+        env.drive.add_file(f"video_U{n}_clip_{n}.mp4")
+    status_message = await env.client.send_message(user_id, "🗑️ Borrando...")
+    started = time.monotonic()
+    await asyncio.wait_for(env.bot.delete_all_user_videos(user_id, status_message, env.client), timeout)
+    elapsed = time.monotonic() - started
+    return {
+        'files': count,
+        # La carpeta del bot (creada al listar) no cuenta como fallo
+        'failed': sum(1 for f in env.drive.files.values() if f['mimeType'] != env.bot.DRIVE_FOLDER_MIME),
+        'elapsed_s': round(elapsed, 3),
+        'files_per_min': round(count / elapsed * 60, 2),
+        'telegram_edits': env.client.stats['edits'],
+        'drive_requests': env.drive.stats['requests'],
+    }
+
+
+async def run_cancel_scenario(env, count, size, timeout, seed):
+    """Mide el tiempo desde que el usuario pulsa Cancelar hasta que el worker queda libre."""
+    import random
+    rng = random.Random(seed)
+    user_id = 1
+    env.add_user(user_id)
+    await env.start_worker()
+    latencies = []
+    for n in range(count):
+        target_stage = 'download' if n % 2 == 0 else 'upload'
+        message = await env.enqueue_video(user_id, size, f"cancel_{n}.mp4")
+        deadline = time.monotonic() + timeout
+        while True:
+            task_id = env.find_task_id(message.id)
+            operation = env.bot.active_operations.get(task_id) if task_id else None
+            if operation and operation.get('stage') == target_stage:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"La tarea {n} no llegó a la etapa {target_stage}.")
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(rng.uniform(0.1, 0.6)) # A mitad de una parte o de un chunk
+        query = env.client.make_callback_query(user_id, f"cancel_{task_id}", message)
+        started = time.monotonic()
+        await env.bot.on_callback_query(env.client, query)
+        while task_id in env.bot.active_operations:
+            await asyncio.sleep(0.002)
+        latencies.append(time.monotonic() - started)
+    await asyncio.sleep(1) # Borrado de las sesiones resumibles en segundo plano
+    await env.stop_worker()
+
+    download_dir = env.bot.DOWNLOAD_DIR
+    return {
+        'files': count,
+        'failed': sum(1 for f in env.drive.files.values() if f['mimeType'] != env.bot.DRIVE_FOLDER_MIME), # Subidas que no se cortaron
+        'cancel_p50_s': round(percentile(latencies, 0.5), 3),
+        'cancel_p95_s': round(percentile(latencies, 0.95), 3),
+        'cancel_max_s': round(max(latencies), 3),
+        'temp_files_left': len(os.listdir(download_dir)) if os.path.isdir(download_dir) else 0,
+        'drive_sessions_left': len(env.drive.sessions),
+        'drive_sessions_cancelled': env.drive.stats['sessions_cancelled'],
+    }
+
+
+def run_in_process(name, args):
+    drive_config, telegram_config = build_configs(args)
+    if name in BATCH_SCENARIOS:
+        os.environ["BATCH_WINDOW"] = str(args.batch_window)
+    if name in SHEDDING_SCENARIOS:
+        os.environ["QUOTA_MAX_QUEUED"] = str(args.quota_max_queued)
+        os.environ["QUEUE_HIGH_WATER"] = str(args.queue_high_water)
+    if name in CANCEL_SCENARIOS:
+        drive_config = dataclasses.replace(drive_config, bandwidth=drive_config.bandwidth or MiB)
+        telegram_config = dataclasses.replace(telegram_config, download_bandwidth=telegram_config.download_bandwidth or MiB)
+    with BenchEnvironment(drive_config, telegram_config, download_sessions=args.download_sessions) as env:
+        if name in UPLOAD_SCENARIOS:
+            users, files_per_user, size = UPLOAD_SCENARIOS[name]
+            files_per_user = max(1, int(files_per_user * args.scale))
+            size = max(1, int(size * args.scale))
+            result = asyncio.run(run_upload_scenario(env, users, files_per_user, size, args.timeout))
+        elif name in BATCH_SCENARIOS:
+            users, files_per_user, size, album_size = BATCH_SCENARIOS[name]
+            files_per_user = max(1, int(files_per_user * args.scale))
+            size = max(1, int(size * args.scale))
+            result = asyncio.run(run_upload_scenario(env, users, files_per_user, size, args.timeout, burst=True, album_size=album_size))
+        elif name in CANCEL_SCENARIOS:
+            count, size = CANCEL_SCENARIOS[name]
+            result = asyncio.run(run_cancel_scenario(env, count, max(1, int(size * args.scale)), args.timeout, args.seed))
+        elif name in SHEDDING_SCENARIOS:
+            users, files_per_user, size = SHEDDING_SCENARIOS[name]
+            files_per_user = max(1, int(files_per_user * args.scale))
+            size = max(1, int(size * args.scale))
+            result = asyncio.run(run_shedding_scenario(env, users, files_per_user, size, args.timeout))
+        else:
+            count = max(1, int(DELETE_SCENARIOS[name] * args.scale))
+            result = asyncio.run(run_delete_scenario(env, count, args.timeout))
+    result['scenario'] = name
+    result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return result
+
+
+def run_in_subprocess(name, argv):
+    cmd = [sys.executable, '-m', 'bench.run_benchmarks', '--in-process', '--scenario', name] + argv
+    proc = subprocess.run(cmd, cwd=REPO_ROOT, capture_output=True, text=True)
+    for line in proc.stdout.splitlines():
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+    sys.stderr.write(proc.stderr[-4000:])
+    return {'scenario': name, 'error': f"El subproceso terminó con código {proc.returncode}"}
+
+
+def print_table(results):
+    columns = ['scenario', 'files', 'failed', 'rejected', 'elapsed_s', 'files_per_min', 'mb_per_s',
+               'latency_p50_s', 'latency_p95_s', 'cancel_p95_s', 'telegram_sends', 'telegram_edits', 'peak_rss_mb']
+    widths = {c: max(len(c), *(len(str(r.get(c, '-'))) for r in results)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for r in results:
+        if 'error' in r:
+            print(f"{r['scenario'].ljust(widths['scenario'])}  ERROR: {r['error']}")
+            continue
+        print("  ".join(str(r.get(c, '-')).ljust(widths[c]) for c in columns))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="Escenario a ejecutar (repetible). Por defecto, todos.")
+    parser.add_argument('--scale', type=float, default=1.0, help="Multiplicador de número y tamaño de archivos.")
+    parser.add_argument('--drive-latency', type=float, default=0.0, help="Latencia por petición a Drive (s).")
+    parser.add_argument('--drive-bandwidth', type=float, default=0.0, help="Ancho de banda de subida a Drive (MiB/s, 0 = ilimitado).")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help="Latencia por llamada a Telegram (s).")
+    parser.add_argument('--telegram-bandwidth', type=float, default=0.0, help="Ancho de banda de descarga de Telegram (MiB/s, 0 = ilimitado).")
+    parser.add_argument('--telegram-session-bandwidth', type=float, default=0.0, help="Ancho de banda por sesión de Telegram (MiB/s, 0 = ilimitado).")
+    parser.add_argument('--download-sessions', type=int, default=0, help="Sesiones extra de descarga (DOWNLOAD_SESSIONS).")
+    parser.add_argument('--download-flood-wait-rate', type=float, default=0.0, help="Probabilidad de FLOOD_WAIT por parte descargada.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Probabilidad de 503 por chunk subido.")
+    parser.add_argument('--md5-corruption-rate', type=float, default=0.0, help="Probabilidad de md5Checksum incorrecto.")
+    parser.add_argument('--flood-wait-rate', type=float, default=0.0, help="Probabilidad de FLOOD_WAIT por edición.")
+    parser.add_argument('--batch-window', type=float, default=1.0, help="BATCH_WINDOW para bulk_forward (0 = un trabajo por video).")
+    parser.add_argument('--quota-max-queued', type=int, default=3, help="QUOTA_MAX_QUEUED para spike_shedding (0 = sin límite).")
+    parser.add_argument('--queue-high-water', type=int, default=60, help="QUEUE_HIGH_WATER para spike_shedding (0 = sin límite).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=1800, help="Tiempo máximo por escenario (s).")
+    parser.add_argument('--json', help="Guardar los resultados en este archivo JSON.")
+    parser.add_argument('--in-process', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    args = parse_args(argv)
+    if args.in_process:
+        logging.disable(logging.WARNING) # Los logs INFO del bot distorsionan la medición
+        print("RESULT " + json.dumps(run_in_process(args.scenario[0], args)))
+        return 0
+
+    # Reenviar las opciones comunes a cada subproceso, sin --scenario ni --json
+    passthrough = []
+    skip = False
+    for item in argv:
+        if skip:
+            skip = False
+            continue
+        if item in ('--scenario', '--json'):
+            skip = True
+            continue
+        if item.startswith('--scenario=') or item.startswith('--json='):
+            continue
+        passthrough.append(item)
+
+    results = [run_in_subprocess(name, passthrough) for name in (args.scenario or SCENARIOS)]
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if any('error' in r for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+"""
+Prueba de carga y resistencia (soak) del bot.
+
+Simula miles de usuarios que envían videos, cancelan al azar (en cola o en proceso)
+y piden /drive_login sin completarlo, durante el tiempo indicado, sobre los mismos
+stand-ins locales de Telegram y Drive que los benchmarks. Cada --sample-interval
+registra RSS, tamaño de las estructuras en memoria del bot y latencia p95.
+
+Al terminar deja de generar tráfico, espera a que la cola se vacíe y falla
+(código de salida 1) si detecta:
+  - crecimiento de RSS por encima de --max-rss-growth-mb tras el calentamiento,
+  - entradas huérfanas en queued_tasks, active_operations o la cola,
+  - login_states u otros mapas por encima de --max-map-size,
+  - deriva de la latencia p95 mayor que --max-latency-drift veces la inicial.
+
+Uso (desde la raíz del repositorio):
+    python -m bench.soak --users 5000 --duration 7200 --rate 1.5 --pattern bursty
+    python -m bench.soak --duration 120 --sample-interval 10   # prueba corta
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+
+from bench.fake_drive import FakeDriveConfig
+from bench.fake_telegram import FakeTelegramConfig
+from bench.harness import BenchEnvironment, percentile
+
+KiB = 1024
+
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def arrival_rate(pattern, base_rate, elapsed, period):
+    """Tasa de llegada instantánea (videos/s) según el patrón."""
+    if pattern == 'bursty':
+        # 10% del periodo con 8x la tasa base, el resto a 0.2x
+        return base_rate * (8.0 if (elapsed % period) < period * 0.1 else 0.2)
+    if pattern == 'diurnal':
+        return base_rate * (1 + 0.9 * math.sin(2 * math.pi * elapsed / period))
+    return base_rate
+
+
+class SoakDriver:
+    def __init__(self, env, args):
+        self.env = env
+        self.args = args
+        self.bot = env.bot
+        self.random = random.Random(args.seed)
+        self.samples = []
+        self.window_latencies = [] # Latencias de las subidas exitosas en la ventana actual
+        self.totals = {'enqueued': 0, 'cancel_requests': 0, 'logins': 0, 'succeeded': 0, 'failed': 0}
+        self.pending_cancels = set()
+        self.started = None
+
+    async def run(self):
+        for user_id in range(1, self.args.users + 1):
+            self.env.add_user(user_id)
+        # Una parte de los usuarios está aprobada pero sin autenticar: son los que piden /drive_login
+        self.login_users = list(range(self.args.users + 1, self.args.users + 1 + max(1, self.args.users // 10)))
+        self.bot.approved_users.update(self.login_users)
+
+        await self.env.start_worker()
+        self.started = time.monotonic()
+        sampler = asyncio.create_task(self._sample_loop())
+        await asyncio.gather(self._arrivals(), self._logins())
+
+        # Fin del tráfico: esperar a que se vacíe la cola
+        drain_deadline = time.monotonic() + self.args.drain_timeout
+        while (self.bot.queued_tasks or self.bot.active_operations) and time.monotonic() < drain_deadline:
+            await asyncio.sleep(0.5)
+        await asyncio.sleep(1) # Dejar que terminen las ediciones en vuelo
+        self._collect()
+        sampler.cancel()
+        self._take_sample()
+        await self.env.stop_worker()
+        return self.evaluate()
+
+    async def _arrivals(self):
+        while time.monotonic() - self.started < self.args.duration:
+            elapsed = time.monotonic() - self.started
+            rate = arrival_rate(self.args.pattern, self.args.rate, elapsed, self.args.period)
+            if rate <= 0:
+                await asyncio.sleep(0.1)
+                continue
+            await asyncio.sleep(self.random.expovariate(rate))
+            user_id = self.random.randint(1, self.args.users)
+            size = self.random.randint(self.args.min_size_kib, self.args.max_size_kib) * KiB
+            message = await self.env.enqueue_video(user_id, size)
+            self.totals['enqueued'] += 1
+            if self.random.random() < self.args.cancel_rate:
+                task = asyncio.create_task(self._cancel_later(user_id, message))
+                self.pending_cancels.add(task)
+                task.add_done_callback(self.pending_cancels.discard)
+
+    async def _cancel_later(self, user_id, message):
+        await asyncio.sleep(self.random.uniform(0, self.args.cancel_delay))
+        task_id = self.env.find_task_id(message.id)
+        if task_id is None:
+            return
+        self.totals['cancel_requests'] += 1
+        query = self.env.client.make_callback_query(user_id, f"cancel_{task_id}", message)
+        await self.bot.on_callback_query(self.env.client, query)
+
+    async def _logins(self):
+        if self.args.login_rate <= 0:
+            return
+        while time.monotonic() - self.started < self.args.duration:
+            await asyncio.sleep(self.random.expovariate(self.args.login_rate))
+            user_id = self.random.choice(self.login_users)
+            message = self.env.client.make_text_message(user_id, "/drive_login")
+            await self.bot.drive_login_command(self.env.client, message)
+            self.totals['logins'] += 1
+
+    def _collect(self):
+        """Pasa las tareas terminadas del entorno a la ventana actual y libera sus entradas."""
+        for message_id, (done, ok) in list(self.env.completed.items()):
+            enqueued = self.env.enqueued_at.pop(message_id, None)
+            del self.env.completed[message_id]
+            if enqueued is None:
+                continue
+            if ok:
+                self.totals['succeeded'] += 1
+                self.window_latencies.append(done - enqueued)
+            else:
+                self.totals['failed'] += 1
+
+    async def _sample_loop(self):
+        while True:
+            await asyncio.sleep(self.args.sample_interval)
+            self._collect()
+            self._take_sample()
+
+    def _take_sample(self):
+        bot = self.bot
+        sample = {
+            't': round(time.monotonic() - self.started, 1),
+            'rss_mb': round(current_rss_mb(), 1),
+            'queued_tasks': len(bot.queued_tasks),
+            'active_operations': len(bot.active_operations),
+            'queue_size': bot.upload_queue.qsize(),
+            'login_states': len(bot.login_states),
+            'user_info': len(bot.user_info),
+            'pending_emails': len(bot.pending_emails),
+            'completed_in_window': len(self.window_latencies),
+            'latency_p95_s': round(percentile(self.window_latencies, 0.95), 3) if self.window_latencies else None,
+        }
+        self.window_latencies = []
+        self.samples.append(sample)
+        print("SAMPLE " + json.dumps(sample), flush=True)
+
+    def evaluate(self):
+        args = self.args
+        failures = []
+        final = self.samples[-1]
+
+        warm = [s for s in self.samples if s['t'] >= args.warmup] or self.samples
+        rss_growth = final['rss_mb'] - warm[0]['rss_mb']
+        if rss_growth > args.max_rss_growth_mb:
+            failures.append(f"RSS creció {rss_growth:.1f} MiB tras el calentamiento (límite {args.max_rss_growth_mb}).")
+
+        for key in ('queued_tasks', 'active_operations', 'queue_size'):
+            if final[key]:
+                failures.append(f"{final[key]} entradas huérfanas en {key} tras vaciar la cola.")
+        if self.bot.total_uploads_queued != 0:
+            failures.append(f"total_uploads_queued quedó en {self.bot.total_uploads_queued} (debería ser 0).")
+        for key in ('login_states', 'user_info', 'pending_emails'):
+            peak = max(s[key] for s in self.samples)
+            if peak > args.max_map_size:
+                failures.append(f"{key} llegó a {peak} entradas (límite {args.max_map_size}).")
+
+        p95s = [s['latency_p95_s'] for s in self.samples if s['latency_p95_s'] is not None]
+        if len(p95s) >= 2:
+            baseline = max(p95s[0], args.min_latency_baseline)
+            drift = max(p95s[-3:]) / baseline
+            if drift > args.max_latency_drift:
+                failures.append(f"La latencia p95 derivó {drift:.1f}x (de {p95s[0]}s a {max(p95s[-3:])}s; límite {args.max_latency_drift}x).")
+
+        return {'totals': self.totals, 'final': final, 'rss_growth_mb': round(rss_growth, 1), 'failures': failures}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--duration', type=float, default=3600, help="Duración del tráfico (s).")
+    parser.add_argument('--rate', type=float, default=1.0, help="Videos por segundo (tasa base).")
+    parser.add_argument('--pattern', choices=['constant', 'bursty', 'diurnal'], default='constant')
+    parser.add_argument('--period', type=float, default=300, help="Periodo de los patrones bursty/diurnal (s).")
+    parser.add_argument('--min-size-kib', type=int, default=64)
+    parser.add_argument('--max-size-kib', type=int, default=2048)
+    parser.add_argument('--cancel-rate', type=float, default=0.1, help="Fracción de videos que se cancelan.")
+    parser.add_argument('--cancel-delay', type=float, default=10, help="Retraso máximo antes de cancelar (s).")
+    parser.add_argument('--login-rate', type=float, default=0.2, help="/drive_login abandonados por segundo.")
+    parser.add_argument('--drive-latency', type=float, default=0.005)
+    parser.add_argument('--telegram-latency', type=float, default=0.005)
+    parser.add_argument('--flood-wait-rate', type=float, default=0.01)
+    parser.add_argument('--sample-interval', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=60, help="Segundos excluidos de la referencia de RSS.")
+    parser.add_argument('--drain-timeout', type=float, default=600)
+    parser.add_argument('--max-rss-growth-mb', type=float, default=64)
+    parser.add_argument('--max-map-size', type=int, default=10000)
+    parser.add_argument('--max-latency-drift', type=float, default=3.0)
+    parser.add_argument('--min-latency-baseline', type=float, default=1.0, help="Referencia mínima de p95 (s) para medir la deriva.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="Guardar muestras y resultado en este archivo JSON.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.disable(logging.ERROR) # Las cancelaciones generan errores esperados en el log del bot
+    drive_config = FakeDriveConfig(latency=args.drive_latency, seed=args.seed)
+    telegram_config = FakeTelegramConfig(latency=args.telegram_latency, flood_wait_rate=args.flood_wait_rate,
+                                         max_messages=200000, seed=args.seed)
+    with BenchEnvironment(drive_config, telegram_config) as env:
+        driver = SoakDriver(env, args)
+        result = asyncio.run(driver.run())
+
+    print("RESULT " + json.dumps(result))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'samples': driver.samples, 'result': result}, f, indent=2)
+    if result['failures']:
+        print("\n❌ SOAK FALLIDO:", file=sys.stderr)
+        for failure in result['failures']:
+            print(f"  - {failure}", file=sys.stderr)
+        return 1
+    print("\n✅ Soak superado.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,17 +5,30 @@ import logging
 import base64
 import json
 import time
+BOOT_STARTED = time.monotonic() # Referencia para medir el tiempo de arranque
 import mimetypes
-import aiofiles
 import secrets
 import uuid
-from quart import Quart, request, redirect, url_for
+import signal
+import shutil
+import sys
+import threading
+import traceback
+import hashlib
+import socket
+import sqlite3
+import urllib.request
+import contextvars
+import zlib
+import atexit
+import logging.handlers
+from queue import Queue as ThreadQueue, Full as QueueFull
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from quart import Quart, request, redirect, url_for, jsonify, make_response
 from pyrogram import Client, filters, enums
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand, CallbackQuery
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from pyrogram.errors import FloodWait
 import io
 
 # --- CONFIGURACIÓN DESDE VARIABLES DE ENTORNO ---
@@ -34,27 +47,870 @@ ADMIN_EMAIL = os.environ.get("ADMIN_EMAIL", "telegramprueba30@gmail.com")
 # --- CONFIGURACIÓN DE GOOGLE DRIVE ---
 SCOPES = ['https://www.googleapis.com/auth/drive']
 RENDER_REDIRECT_URI = os.environ.get("RENDER_REDIRECT_URI", "https://drive-bot-vip.onrender.com/oauth2callback")
+# Raíz alternativa de la API de Drive (solo para benchmarks/pruebas contra un servidor Drive local)
+DRIVE_API_ROOT_URL = os.environ.get("DRIVE_API_ROOT_URL")
+# Número máximo de intentos de subida cuando el MD5 local no coincide con el md5Checksum de Drive
+UPLOAD_MD5_MAX_ATTEMPTS = int(os.environ.get("UPLOAD_MD5_MAX_ATTEMPTS", 3))
+
+# Carpeta de la app en el Drive de cada usuario, donde van las subidas (se crea al primer uso)
+DRIVE_FOLDER_NAME = os.environ.get("DRIVE_FOLDER_NAME", "Videos de Telegram")
+DRIVE_FOLDERS_PATH = os.environ.get("DRIVE_FOLDERS_PATH", "bot_drive_folders.json") # IDs de carpeta ya resueltos (modo inline)
+
+# --- CONFIGURACIÓN DE MÉTRICAS ---
+# Número de observaciones recientes usadas para calcular p50/p95/p99 de cada serie
+METRICS_WINDOW = int(os.environ.get("METRICS_WINDOW", 1024))
+
+# --- CONFIGURACIÓN DE TRAZAS POR TAREA ---
+TRACE_PATH = os.environ.get("TRACE_PATH", "") # Spans por tarea en formato Chrome trace-event, p. ej. bot_trace.json (vacío = desactivado)
+TRACE_MAX_MB = float(os.environ.get("TRACE_MAX_MB", 50)) # Tamaño a partir del cual se rota el archivo de trazas
+TRACE_BACKUPS = int(os.environ.get("TRACE_BACKUPS", 3)) # Archivos rotados que se conservan (.1, .2, ...)
+TRACE_FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", 2.0)) # Cada cuánto se vuelcan los spans al archivo (s)
+TRACE_BUFFER_MAX = int(os.environ.get("TRACE_BUFFER_MAX", 50000)) # Spans en memoria entre volcados; si se llena, se descartan
+
+# --- CONFIGURACIÓN DE LOGS Y PERFILADO ---
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_QUEUE_MAX = int(os.environ.get("LOG_QUEUE_MAX", 10000)) # Registros pendientes de escribir; si se llena, se descartan
+LOG_SAMPLE_BURST = int(os.environ.get("LOG_SAMPLE_BURST", 20)) # Mensajes INFO/DEBUG por línea de código y ventana antes de muestrear (0 = sin muestreo)
+LOG_SAMPLE_WINDOW = float(os.environ.get("LOG_SAMPLE_WINDOW", 10)) # Ventana del muestreo de logs repetitivos (s)
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.01)) # Intervalo entre muestras de pila del perfilador (s)
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 60)) # Duración máxima de un perfil pedido por el admin
+
+# --- CONFIGURACIÓN DEL PANEL DE ADMINISTRACIÓN (SSE) ---
+DASHBOARD_TOKEN = os.environ.get("DASHBOARD_TOKEN") or secrets.token_urlsafe(24) # Para scripts (Authorization: Bearer); sin definir, uno aleatorio por arranque
+DASHBOARD_LINK_TTL = int(os.environ.get("DASHBOARD_LINK_TTL", 300)) # Validez del enlace de un solo uso que da /stats (s)
+DASHBOARD_SESSION_TTL = int(os.environ.get("DASHBOARD_SESSION_TTL", 12 * 3600)) # Duración de la sesión del panel en el navegador (s)
+DASHBOARD_INTERVAL = float(os.environ.get("DASHBOARD_INTERVAL", 1.0)) # Cada cuánto se publica el estado a los paneles abiertos (s)
+DASHBOARD_MAX_WATCHERS = int(os.environ.get("DASHBOARD_MAX_WATCHERS", 500)) # Conexiones SSE simultáneas como máximo
+DASHBOARD_FAILURES_KEPT = int(os.environ.get("DASHBOARD_FAILURES_KEPT", 20)) # Errores recientes mostrados
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", RENDER_REDIRECT_URI.rsplit('/oauth2callback', 1)[0]) # Para el enlace al panel
+
+# --- CONFIGURACIÓN DEL WATCHDOG DEL EVENT LOOP ---
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", 0.5)) # Cada cuánto se mide el retraso del loop (s)
+LOOP_LAG_THRESHOLD = float(os.environ.get("LOOP_LAG_THRESHOLD", 1.0)) # Retraso a partir del cual se registra el stack y se deja de estar "ready" (s)
+
+# --- CONFIGURACIÓN DEL ESTADO EN MEMORIA (TTL y tamaño máximo) ---
+LOGIN_STATE_TTL = int(os.environ.get("LOGIN_STATE_TTL", 15 * 60)) # Vida de un enlace de /drive_login (s)
+PENDING_EMAIL_TTL = int(os.environ.get("PENDING_EMAIL_TTL", 0)) # Correos esperando aprobación (s, 0 = hasta que el admin decida)
+USER_INFO_TTL = int(os.environ.get("USER_INFO_TTL", 30 * 24 * 3600)) # Nombre/usuario de quien no está aprobado, pendiente ni autenticado (s)
+STATE_MAX_ENTRIES = int(os.environ.get("STATE_MAX_ENTRIES", 10000)) # Tamaño máximo de cada mapa acotado
+STATE_SWEEP_INTERVAL = int(os.environ.get("STATE_SWEEP_INTERVAL", 60)) # Cada cuánto se purgan entradas expiradas (s)
+
+# --- CONFIGURACIÓN DE APAGADO CONTROLADO (drain) ---
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 25)) # Tiempo máximo para terminar transferencias activas tras SIGTERM (s)
+CHECKPOINT_PATH = os.environ.get("CHECKPOINT_PATH", "bot_checkpoint.json") # Cola pendiente y credenciales guardadas al apagar
+DOWNLOAD_DIR = os.path.abspath(os.environ.get("DOWNLOAD_DIR", "downloads")) # Archivos temporales de descarga
+CANCEL_GRACE = float(os.environ.get("CANCEL_GRACE", 1.0)) # Espera máxima a que la E/S abortada termine de limpiar al cancelar (s)
+
+# --- CONFIGURACIÓN DE DESCARGAS MULTI-SESIÓN ---
+DOWNLOAD_SESSIONS = int(os.environ.get("DOWNLOAD_SESSIONS", 0)) # Sesiones extra del mismo bot dedicadas a descargar
+DOWNLOAD_SHARD_MB = int(os.environ.get("DOWNLOAD_SHARD_MB", 8)) # Tamaño de los fragmentos que se reparten las sesiones (MiB)
+DOWNLOAD_SESSION_COOLDOWN = float(os.environ.get("DOWNLOAD_SESSION_COOLDOWN", 30)) # Pausa de una sesión tras un corte de descarga (s)
+DOWNLOAD_SHARD_ATTEMPTS = int(os.environ.get("DOWNLOAD_SHARD_ATTEMPTS", 3)) # Intentos por fragmento (o por archivo) antes de fallar
+
+# --- CONFIGURACIÓN DE LOTES (álbumes y reenvíos masivos) ---
+BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW", 1.0)) # Videos del mismo usuario con menos de esta pausa forman un lote; el primero no espera (s, 0 = sin lotes)
+BATCH_MAX_WAIT = float(os.environ.get("BATCH_MAX_WAIT", 10)) # Espera máxima para cerrar un lote aunque sigan llegando videos (s)
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 50)) # Videos por lote como máximo
+BATCH_STATUS_INTERVAL = float(os.environ.get("BATCH_STATUS_INTERVAL", 3)) # Intervalo mínimo entre ediciones del estado del lote (s)
+BATCH_LINKS_SHOWN = int(os.environ.get("BATCH_LINKS_SHOWN", 20)) # Enlaces listados en el resumen final del lote
+
+# --- CONFIGURACIÓN DE CUOTAS Y CONTROL DE ADMISIÓN ---
+# Se aplican al encolar; el admin está exento y puede cambiarlas en caliente con /cuota
+QUOTA_MAX_QUEUED = int(os.environ.get("QUOTA_MAX_QUEUED", 50)) # Archivos en cola o en proceso por usuario (0 = sin límite)
+QUOTA_MAX_QUEUED_MB = int(os.environ.get("QUOTA_MAX_QUEUED_MB", 20480)) # MB en cola o en proceso por usuario (0 = sin límite)
+QUOTA_UPLOADS_PER_HOUR = int(os.environ.get("QUOTA_UPLOADS_PER_HOUR", 200)) # Archivos aceptados por usuario y hora (0 = sin límite)
+QUEUE_HIGH_WATER = int(os.environ.get("QUEUE_HIGH_WATER", 1000)) # Con tantos archivos pendientes en total se rechazan los nuevos (0 = sin límite)
+
+# --- CONFIGURACIÓN DE ESCALADO HORIZONTAL (procesos front/worker) ---
+# inline: un solo proceso hace todo (por defecto)
+# front: handlers de Telegram y Quart; encola en la cola compartida y publica el progreso
+# worker: solo transfiere; reclama trabajos de la cola compartida con un lease
+WORKER_MODE = os.environ.get("WORKER_MODE", "inline")
+JOB_DB_PATH = os.environ.get("JOB_DB_PATH", "bot_jobs.sqlite3") # Cola compartida (SQLite) entre front y workers
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", 60)) # Un trabajo sin renovar en este tiempo vuelve a la cola
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 0.5)) # Sondeo de trabajos, cancelaciones y progreso (s)
+WORKER_ID = os.environ.get("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+if WORKER_MODE == "worker" and "DOWNLOAD_DIR" not in os.environ:
+    # Cada worker limpia su propio directorio al arrancar; no debe tocar los temporales de otros
+    DOWNLOAD_DIR = os.path.join(DOWNLOAD_DIR, WORKER_ID)
+if WORKER_MODE == "worker" and TRACE_PATH:
+    # Un archivo por proceso: la rotación no se pisa entre workers que comparten la configuración
+    TRACE_PATH = "{0}_{2}{1}".format(*os.path.splitext(TRACE_PATH), WORKER_ID)
 
 # --- Inicialización ---
 app_quart = Quart(__name__)
-app_telegram = Client("my_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+if WORKER_MODE == "worker":
+    # Sesión propia y sin updates: los mensajes los recibe solo el proceso front
+    app_telegram = Client(f"worker_{WORKER_ID}", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, no_updates=True)
+else:
+    app_telegram = Client("my_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+
+# --- Mapa con expiración para el estado en memoria ---
+class ExpiringDict:
+    """
+    Diccionario con TTL y tamaño máximo.
+    Las entradas se mantienen en orden de expiración (cada escritura las mueve al final),
+    así que leer, escribir y purgar son O(1) amortizado. Las entradas expiradas se
+    eliminan al acceder a ellas, al escribir y en el barrido periódico (sweep_expiring_maps).
+    Las claves para las que keep(clave) es cierto no caducan ni se desalojan por tamaño.
+    """
+    def __init__(self, ttl, max_size=0, keep=None):
+        self._ttl = ttl # 0 = sin caducidad (solo cuenta el tamaño máximo)
+        self._max_size = max_size # 0 = sin límite de tamaño
+        self._keep = keep
+        self._data = OrderedDict() # {clave: (instante de expiración, valor)}
+
+    def _kept(self, key):
+        return self._keep is not None and self._keep(key)
+
+    def sweep(self, now=None):
+        """Elimina las entradas expiradas y devuelve cuántas se eliminaron."""
+        if self._ttl <= 0:
+            return 0
+        now = now if now is not None else time.monotonic()
+        removed = 0
+        for _ in range(len(self._data)):
+            key, (expires_at, value) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            if self._kept(key):
+                # Sigue vigente: se renueva al final para no volver a revisarla en cada barrido
+                self._data[key] = (now + self._ttl, value)
+                self._data.move_to_end(key)
+                continue
+            self._data.popitem(last=False)
+            removed += 1
+        return removed
+
+    def _live_entry(self, key):
+        entry = self._data.get(key)
+        if entry is not None and self._ttl > 0 and entry[0] <= time.monotonic() and not self._kept(key):
+            del self._data[key]
+            return None
+        return entry
+
+    def full(self):
+        """Cierto si una clave nueva obligaría a desalojar otra."""
+        return bool(self._max_size) and len(self) >= self._max_size
+
+    def __setitem__(self, key, value):
+        now = time.monotonic()
+        self.sweep(now)
+        self._data[key] = (now + self._ttl, value)
+        self._data.move_to_end(key)
+        if self._max_size and len(self._data) > self._max_size:
+            # Desalojar la entrada más antigua que no haya que conservar
+            for oldest in self._data:
+                if not self._kept(oldest):
+                    del self._data[oldest]
+                    break
+
+    def __getitem__(self, key):
+        entry = self._live_entry(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[1]
+
+    def get(self, key, default=None):
+        entry = self._live_entry(key)
+        return default if entry is None else entry[1]
+
+    def pop(self, key, *default):
+        entry = self._live_entry(key)
+        if entry is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        del self._data[key]
+        return entry[1]
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        return self._live_entry(key) is not None
+
+    def __len__(self):
+        self.sweep()
+        return len(self._data)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        self.sweep()
+        return list(self._data.keys())
+
+    def values(self):
+        self.sweep()
+        return [value for _, value in self._data.values()]
+
+    def items(self):
+        self.sweep()
+        return [(key, value) for key, (_, value) in self._data.items()]
 
 # --- Diccionarios y Colas en memoria ---
-active_operations = {} # {task_id: {...}} - Operaciones ACTIVAS (en proceso de descarga/subida)
+# {task_id: {...}} - Operaciones ACTIVAS (en proceso de descarga/subida). Sin TTL: es trabajo vivo, no estado
+# abandonado, y el finally de process_upload_queue siempre retira su entrada
+active_operations = {}
 user_credentials = {}
-login_states = {}
-pending_emails = {}
+login_states = ExpiringDict(LOGIN_STATE_TTL, STATE_MAX_ENTRIES) # {state: user_id} - Enlaces de /drive_login pendientes
+pending_emails = ExpiringDict(PENDING_EMAIL_TTL, STATE_MAX_ENTRIES) # {user_id: correo} - Solicitudes esperando /aprobar_usuario
 approved_users = set()
-user_info = {} # {user_id: {'name': '...', 'username': '...'}}
+# {user_id: {'name': '...', 'username': '...'}} - Solo caduca el de quien no está aprobado, pendiente ni autenticado
+user_info = ExpiringDict(USER_INFO_TTL, STATE_MAX_ENTRIES,
+                         keep=lambda user_id: user_id in approved_users or user_id in pending_emails or user_id in user_credentials)
 
 # --- NUEVO: Sistema de Cola Mejorado ---
 upload_queue = asyncio.Queue()
 queued_tasks = {} # {task_id: {'user_id': ..., 'message_id': ..., 'file_name': ..., 'position': ..., 'queue_status_message_id': ..., 'chat_id': ...}}
 total_uploads_queued = 0 # Contador global de uploads encolados
+pending_batches = {} # {user_id o (user_id, media_group_id): {'messages': [...], 'started': t, 'last': t, 'timer': Task}} - Lotes aún recibiendo videos
+recent_media = ExpiringDict(BATCH_WINDOW, STATE_MAX_ENTRIES) # {user_id: instante} - Usuarios que enviaron un archivo hace menos de BATCH_WINDOW
+queue_processor_task = None # Tarea del procesador de cola (para comprobar que sigue viva)
+
+# --- Estado del apagado controlado ---
+draining = False # True tras SIGTERM: no se empiezan transferencias nuevas
+shutdown_event = asyncio.Event() # Detiene el servidor Quart al terminar el drain
+startup_error = None # Excepción con la que terminó run_bot: /healthz deja de responder "ok"
+interrupted_tasks = [] # Tareas activas interrumpidas por el drain (entradas de checkpoint)
+
+# --- Cola compartida entre procesos (modos front/worker) ---
+class JobStore:
+    """
+    Cola de trabajos en SQLite compartida por el proceso front y los workers.
+    Los workers reclaman trabajos con un lease que renuevan mientras transfieren; si un worker
+    muere, el lease expira y otro lo retoma. El progreso que muestran los mensajes de estado
+    y las peticiones de cancelación viajan por la misma tabla.
+    """
+    def __init__(self, path):
+        # Guarda refresh tokens: solo legible por el propietario, también si el archivo ya existía
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            for suffix in ('-wal', '-shm'): # SQLite los crea con los permisos del archivo principal, salvo los heredados
+                if os.path.exists(path + suffix):
+                    os.chmod(path + suffix, 0o600)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    task_id TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    batch_message_ids TEXT,
+                    file_name TEXT,
+                    status_message_id INTEGER,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    position INTEGER NOT NULL DEFAULT 0,
+                    enqueued_at REAL NOT NULL,
+                    worker_id TEXT,
+                    lease_expires REAL,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    status_text TEXT,
+                    status_buttons INTEGER NOT NULL DEFAULT 0,
+                    status_version INTEGER NOT NULL DEFAULT 0,
+                    relayed_version INTEGER NOT NULL DEFAULT 0,
+                    total_bytes INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, enqueued_at);
+                CREATE TABLE IF NOT EXISTS credentials (
+                    user_id INTEGER PRIMARY KEY,
+                    creds_json TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS drive_folders (
+                    user_id INTEGER PRIMARY KEY,
+                    folder_id TEXT NOT NULL
+                );
+            """)
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+            if 'batch_message_ids' not in columns: # Colas creadas antes de los lotes
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN batch_message_ids TEXT")
+            if 'total_bytes' not in columns: # Colas creadas antes de las cuotas
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN total_bytes INTEGER NOT NULL DEFAULT 0")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def enqueue(self, task_id, user_id, chat_id, message_id, file_name, status_message_id, position, batch_message_ids=None, total_bytes=0):
+        self._execute(
+            "INSERT INTO jobs (task_id, user_id, chat_id, message_id, batch_message_ids, file_name, status_message_id, position, enqueued_at, total_bytes)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (task_id, user_id, chat_id, message_id, json.dumps(batch_message_ids) if batch_message_ids else None,
+             file_name, status_message_id, position, time.time(), total_bytes))
+
+    def claim(self, worker_id):
+        """Reclama el trabajo más antiguo en cola (o con el lease vencido). Devuelve un dict o None."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT task_id, user_id, chat_id, message_id, batch_message_ids, file_name, status_message_id, enqueued_at FROM jobs"
+                    " WHERE cancel_requested = 0 AND (status = 'queued' OR (status = 'running' AND lease_expires < ?))"
+                    " ORDER BY enqueued_at LIMIT 1", (now,)).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', worker_id = ?, lease_expires = ? WHERE task_id = ?",
+                        (worker_id, now + JOB_LEASE_SECONDS, row[0]))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        keys = ('task_id', 'user_id', 'chat_id', 'message_id', 'batch_message_ids', 'file_name', 'status_message_id', 'enqueued_at')
+        job = dict(zip(keys, row))
+        job['batch_message_ids'] = json.loads(job['batch_message_ids']) if job['batch_message_ids'] else None
+        return job
+
+    def renew(self, task_id, worker_id):
+        """Renueva el lease. Devuelve True si se pidió cancelar el trabajo (o si otro worker lo tomó)."""
+        self._execute("UPDATE jobs SET lease_expires = ? WHERE task_id = ? AND worker_id = ?",
+                      (time.time() + JOB_LEASE_SECONDS, task_id, worker_id))
+        rows = self._execute("SELECT cancel_requested, worker_id FROM jobs WHERE task_id = ?", (task_id,))
+        return not rows or bool(rows[0][0]) or rows[0][1] != worker_id
+
+    def release(self, task_id):
+        """Devuelve a la cola un trabajo que el worker no pudo terminar (p. ej. por un apagado)."""
+        self._execute("UPDATE jobs SET status = 'queued', worker_id = NULL, lease_expires = NULL WHERE task_id = ?", (task_id,))
+
+    def finish(self, task_id):
+        self._execute("UPDATE jobs SET status = 'finished', lease_expires = NULL WHERE task_id = ?", (task_id,))
+
+    def report_status(self, chat_id, status_message_id, text, buttons):
+        """Registra el texto actual del mensaje de estado; el proceso front lo publica en Telegram."""
+        self._execute(
+            "UPDATE jobs SET status_text = ?, status_buttons = ?, status_version = status_version + 1"
+            " WHERE chat_id = ? AND status_message_id = ? AND status != 'finished'",
+            (text, int(buttons), chat_id, status_message_id))
+
+    def get_job(self, task_id):
+        """(estado, user_id, chat_id, status_message_id) de un trabajo pendiente o en curso, o None."""
+        rows = self._execute(
+            "SELECT status, user_id, chat_id, status_message_id FROM jobs WHERE task_id = ? AND status != 'finished'", (task_id,))
+        return rows[0] if rows else None
+
+    def request_cancel(self, task_id):
+        """
+        Pide cancelar un trabajo. Si aún estaba en cola se da por terminado; si está en curso,
+        el worker lo verá al renovar el lease. Devuelve el estado previo o None si ya terminó.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM jobs WHERE task_id = ?", (task_id,)).fetchone()
+            if not row or row[0] == 'finished':
+                return None
+            if row[0] == 'queued':
+                self._conn.execute("UPDATE jobs SET status = 'finished', cancel_requested = 1 WHERE task_id = ?", (task_id,))
+            else:
+                self._conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE task_id = ?", (task_id,))
+            return row[0]
+
+    def pending_status_updates(self):
+        return self._execute(
+            "SELECT task_id, user_id, chat_id, status_message_id, status_text, status_buttons, status_version FROM jobs"
+            " WHERE status_version > relayed_version")
+
+    def mark_relayed(self, task_id, version):
+        self._execute("UPDATE jobs SET relayed_version = ? WHERE task_id = ?", (version, task_id))
+
+    def queued_jobs(self):
+        """Trabajos aún en cola, en orden: (task_id, user_id, chat_id, status_message_id, posición mostrada)."""
+        return self._execute(
+            "SELECT task_id, user_id, chat_id, status_message_id, position FROM jobs WHERE status = 'queued' ORDER BY enqueued_at")
+
+    def set_position(self, task_id, position):
+        self._execute("UPDATE jobs SET position = ? WHERE task_id = ?", (position, task_id))
+
+    def count(self, status):
+        return self._execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,))[0][0]
+
+    def unfinished_jobs(self):
+        """Trabajos en cola o en curso, para reconstruir la cuota admitida al arrancar el front: (task_id, user_id, archivos, bytes)."""
+        return [(task_id, user_id, len(json.loads(batch)) if batch else 1, total_bytes) for task_id, user_id, batch, total_bytes in self._execute(
+            "SELECT task_id, user_id, batch_message_ids, total_bytes FROM jobs WHERE status IN ('queued', 'running')")]
+
+    def finish_abandoned_cancels(self):
+        """
+        Cierra los trabajos cancelados cuyo worker murió: claim no los retoma (cancel_requested = 1)
+        y sin esto quedarían 'running' para siempre. El aviso pasa por el relay como cualquier estado.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE jobs SET status = 'finished', lease_expires = NULL, status_text = ?, status_buttons = 0,"
+                " status_version = status_version + 1"
+                " WHERE status = 'running' AND cancel_requested = 1 AND lease_expires < ?",
+                ("❌ Operación cancelada.", time.time())).rowcount
+
+    def purge_finished(self):
+        """Borra los trabajos terminados cuyo último estado ya se publicó. Devuelve sus task_id."""
+        # Sin DELETE ... RETURNING, que pide SQLite 3.35: SELECT y DELETE en la misma transacción
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                task_ids = [row[0] for row in self._conn.execute(
+                    "SELECT task_id FROM jobs WHERE status = 'finished' AND status_version <= relayed_version")]
+                self._conn.executemany("DELETE FROM jobs WHERE task_id = ?", [(task_id,) for task_id in task_ids])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return task_ids
+
+    def save_credentials(self, user_id, creds_json):
+        self._execute("INSERT OR REPLACE INTO credentials (user_id, creds_json) VALUES (?, ?)", (user_id, creds_json))
+
+    def delete_credentials(self, user_id):
+        self._execute("DELETE FROM credentials WHERE user_id = ?", (user_id,))
+
+    def load_credentials(self, user_id):
+        rows = self._execute("SELECT creds_json FROM credentials WHERE user_id = ?", (user_id,))
+        return rows[0][0] if rows else None
+
+    def running_jobs(self):
+        """Trabajos en curso para el panel: (task_id, user_id, file_name, worker_id, status_text)."""
+        return self._execute(
+            "SELECT task_id, user_id, file_name, worker_id, status_text FROM jobs WHERE status = 'running' ORDER BY enqueued_at")
+
+    def save_drive_folder(self, user_id, folder_id):
+        if folder_id:
+            self._execute("INSERT OR REPLACE INTO drive_folders (user_id, folder_id) VALUES (?, ?)", (user_id, folder_id))
+        else:
+            self._execute("DELETE FROM drive_folders WHERE user_id = ?", (user_id,))
+
+    def load_drive_folder(self, user_id):
+        rows = self._execute("SELECT folder_id FROM drive_folders WHERE user_id = ?", (user_id,))
+        return rows[0][0] if rows else None
+
+job_store = JobStore(JOB_DB_PATH) if WORKER_MODE in ("front", "worker") else None
 
-logging.basicConfig(level=logging.INFO)
+# --- Estado del panel de administración ---
+dashboard_links = ExpiringDict(DASHBOARD_LINK_TTL, 100) # {código: True} - Enlaces de /stats aún sin usar
+dashboard_sessions = ExpiringDict(DASHBOARD_SESSION_TTL, 1000) # {sesión: True} - Cookies del panel emitidas al abrir un enlace
+recent_failures = deque(maxlen=DASHBOARD_FAILURES_KEPT) # Últimas tareas fallidas (no cuenta cancelaciones ni drain)
+worker_busy_samples = deque(maxlen=max(1, int(60 / DASHBOARD_INTERVAL))) # 1/0 por muestra: ¿había una transferencia activa?
+
+# --- Estado del watchdog del event loop ---
+loop_heartbeat = time.monotonic() # Último instante en que el loop ejecutó el monitor
+loop_lag_seconds = 0.0 # Último retraso de planificación medido
+loop_max_lag_seconds = 0.0 # Máximo retraso desde el arranque
+
+# --- Logs sin bloquear el event loop ---
+class LogSampler(logging.Filter):
+    """
+    Muestreo de logs repetitivos: de cada línea de código pasan LOG_SAMPLE_BURST mensajes
+    INFO/DEBUG por ventana; el resto se descarta y el primero de la ventana siguiente indica
+    cuántos se omitieron. Los WARNING y superiores pasan siempre.
+    """
+    def __init__(self, burst, window):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.sites = {} # {(archivo, línea): [inicio de la ventana, emitidos, omitidos]}
+        self.suppressed = 0
+
+    def filter(self, record):
+        if self.burst <= 0 or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        site = self.sites.get((record.pathname, record.lineno))
+        if site is None or now - site[0] >= self.window:
+            omitted = site[2] if site else 0
+            self.sites[(record.pathname, record.lineno)] = [now, 1, 0]
+            if omitted:
+                record.msg = f"{record.getMessage()} (+{omitted} similares omitidos)"
+                record.args = None
+            return True
+        if site[1] < self.burst:
+            site[1] += 1
+            return True
+        site[2] += 1
+        self.suppressed += 1
+        return False
+
+class NonBlockingLogHandler(logging.handlers.QueueHandler):
+    """
+    Encola el registro tal cual: el formateo y la escritura los hace el hilo de log_listener.
+    Si la cola está llena se descarta el registro en vez de bloquear el event loop.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.exc_info:
+            # El traceback se formatea ya (sus frames no deben sobrevivir al registro); el resto, en el listener.
+            # QueueHandler.prepare formatearía el mensaje entero y el listener le pondría otra vez el prefijo
+            record.exc_text = self.formatter.formatException(record.exc_info) if self.formatter else logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except QueueFull:
+            self.dropped += 1
+
+log_queue = ThreadQueue(LOG_QUEUE_MAX)
+log_output = logging.StreamHandler()
+log_output.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = logging.handlers.QueueListener(log_queue, log_output)
+log_handler = NonBlockingLogHandler(log_queue)
+log_sampler = LogSampler(LOG_SAMPLE_BURST, LOG_SAMPLE_WINDOW)
+log_handler.addFilter(log_sampler)
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler])
+log_listener.start()
+atexit.register(log_listener.stop) # Escribe lo que quede en la cola al salir
 logger = logging.getLogger(__name__)
 
+# --- Importaciones de Google con carga diferida ---
+# googleapiclient y google_auth_oauthlib tardan en importarse: se cargan en el warm-up de
+# arranque (en un hilo, después de que el servidor HTTP ya escucha) o, como muy tarde,
+# la primera vez que se necesitan.
+Request = Flow = build_from_document = get_static_doc = MediaIoBaseUpload = ProgressMediaUpload = None
+google_modules_ready = False
+_google_modules_lock = threading.Lock()
+_drive_discovery_doc = None # Documento de discovery de Drive v3 (JSON), reutilizado en cada build
+
+def load_google_modules():
+    """Importa los módulos de Google una sola vez. Idempotente y seguro entre hilos."""
+    global Request, Flow, build_from_document, get_static_doc, MediaIoBaseUpload, ProgressMediaUpload, google_modules_ready
+    if google_modules_ready:
+        return
+    with _google_modules_lock:
+        if google_modules_ready:
+            return
+        from google.auth.transport.requests import Request
+        from google_auth_oauthlib.flow import Flow
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+        from googleapiclient.http import MediaIoBaseUpload
+        ProgressMediaUpload = _define_progress_media_upload(MediaIoBaseUpload)
+        google_modules_ready = True
+
+async def ensure_google_modules():
+    if not google_modules_ready:
+        await asyncio.to_thread(load_google_modules)
+
+def get_drive_discovery_doc():
+    global _drive_discovery_doc
+    if _drive_discovery_doc is None:
+        load_google_modules()
+        discovery_doc = get_static_doc('drive', 'v3')
+        if DRIVE_API_ROOT_URL:
+            # Apuntar el servicio a un servidor Drive alternativo (benchmarks/pruebas)
+            parsed = json.loads(discovery_doc)
+            parsed['rootUrl'] = DRIVE_API_ROOT_URL.rstrip('/') + '/'
+            discovery_doc = json.dumps(parsed)
+        _drive_discovery_doc = discovery_doc
+    return _drive_discovery_doc
+
+def warm_up_google():
+    """Warm-up de arranque (se ejecuta en un hilo): importa los módulos y precarga el discovery de Drive."""
+    try:
+        load_google_modules()
+        get_drive_discovery_doc()
+        record_startup_phase('google_warm_up')
+    except Exception as e:
+        logger.error(f"Error en el warm-up de Google (se reintentará bajo demanda): {e}", exc_info=True)
+
+# --- Configuración OAuth de Google (se parsea una sola vez al arrancar) ---
+def load_google_client_config():
+    creds_data = os.environ.get("GOOGLE_CREDENTIALS_JSON")
+    if not creds_data:
+        logger.warning("GOOGLE_CREDENTIALS_JSON no está configurado; /drive_login no estará disponible.")
+        return None
+    try:
+        return json.loads(creds_data)
+    except ValueError as e:
+        logger.error(f"GOOGLE_CREDENTIALS_JSON no es un JSON válido: {e}")
+        return None
+
+GOOGLE_CLIENT_CONFIG = load_google_client_config()
+
+def build_oauth_flow():
+    # Solo CPU: el flujo se construye desde la configuración en memoria, sin tocar el disco
+    load_google_modules()
+    return Flow.from_client_config(GOOGLE_CLIENT_CONFIG, scopes=SCOPES, redirect_uri=RENDER_REDIRECT_URI)
+
+def create_login_url(user_id):
+    """Registra un nuevo state para user_id y devuelve el enlace de autorización de Google."""
+    state = secrets.token_urlsafe(32)
+    login_states[state] = user_id
+    authorization_url, _ = build_oauth_flow().authorization_url(
+        access_type='offline',
+        include_granted_scopes='true',
+        state=state)
+    return authorization_url
+
+# --- Métricas en memoria (exportadas en formato de texto Prometheus en /metrics) ---
+class MetricsRegistry:
+    """
+    Contadores, gauges y resúmenes (summary) con etiquetas.
+    Registrar una observación es O(1): una búsqueda en dict y un append a un deque acotado;
+    los cuantiles solo se calculan al servir /metrics.
+    """
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, window=METRICS_WINDOW):
+        self._window = window
+        self._help = {}
+        self._types = {}
+        self._counters = {} # {(name, labels): valor}
+        self._summaries = {} # {(name, labels): [deque, suma, cuenta]}
+        self._gauges = {} # {(name, labels): valor}
+        self._gauge_callbacks = {} # {name: función que devuelve el valor}
+
+    def describe(self, name, metric_type, help_text):
+        self._types[name] = metric_type
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        series = self._summaries.get(key)
+        if series is None:
+            series = self._summaries[key] = [deque(maxlen=self._window), 0.0, 0]
+        series[0].append(value)
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def quantile(self, name, q, **labels):
+        """Cuantil q de la ventana reciente de una serie, o None si no hay observaciones."""
+        series = self._summaries.get((name, tuple(sorted(labels.items()))))
+        if not series or not series[0]:
+            return None
+        ordered = sorted(series[0])
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def gauge(self, name, callback):
+        self._gauge_callbacks[name] = callback
+
+    def set_gauge(self, name, value, **labels):
+        self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+    def _header(self, lines, name, seen):
+        if name in seen:
+            return
+        seen.add(name)
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {self._types[name]}")
+
+    def render(self):
+        lines = []
+        seen = set()
+        for (name, labels), value in sorted(self._counters.items()) + sorted(self._gauges.items()):
+            self._header(lines, name, seen)
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for name, callback in sorted(self._gauge_callbacks.items()):
+            self._header(lines, name, seen)
+            try:
+                lines.append(f"{name} {callback()}")
+            except Exception as e:
+                logger.warning(f"Error calculando gauge {name}: {e}")
+        for (name, labels), (window, total, count) in sorted(self._summaries.items()):
+            self._header(lines, name, seen)
+            ordered = sorted(window)
+            for q in self.QUANTILES:
+                value = ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0
+                lines.append(f"{name}{self._format_labels(labels, [('quantile', q)])} {value}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("bot_stage_seconds", "summary", "Duración de cada etapa (queue_wait, download, upload, token_refresh, status_edit, total).")
+metrics.describe("bot_transfer_bytes_per_second", "summary", "Velocidad por archivo de descargas de Telegram y subidas a Drive.")
+metrics.describe("bot_transfer_bytes_total", "counter", "Bytes transferidos por dirección.")
+metrics.describe("bot_enqueued_total", "counter", "Videos agregados a la cola.")
+metrics.describe("bot_tasks_total", "counter", "Tareas de subida terminadas por resultado (ok, error, cancelled).")
+metrics.describe("bot_errors_total", "counter", "Errores por etapa.")
+metrics.describe("bot_flood_wait_total", "counter", "Respuestas FLOOD_WAIT recibidas de Telegram por origen (status_edit, queue_edit, download, pyrogram_auto).")
+metrics.describe("bot_flood_wait_seconds_total", "counter", "Segundos de espera impuestos por FLOOD_WAIT, por origen.")
+metrics.describe("bot_queue_depth", "gauge", "Tareas esperando en la cola.")
+metrics.describe("bot_active_operations", "gauge", "Tareas en proceso de descarga o subida.")
+metrics.gauge("bot_queue_depth", lambda: len(queued_tasks))
+metrics.gauge("bot_active_operations", lambda: len(active_operations))
+metrics.describe("bot_state_evictions_total", "counter", "Entradas expiradas eliminadas de los mapas en memoria.")
+metrics.describe("bot_startup_seconds", "gauge", "Segundos desde el arranque hasta completar cada fase (import, http, google_warm_up, telegram, worker).")
+metrics.describe("bot_event_loop_lag_seconds", "gauge", "Último retraso de planificación medido en el event loop.")
+metrics.gauge("bot_event_loop_lag_seconds", lambda: loop_lag_seconds)
+metrics.describe("bot_download_session_bytes_total", "counter", "Bytes descargados por cada sesión de Telegram.")
+metrics.describe("bot_download_failover_total", "counter", "Veces que una sesión de descarga se apartó por FLOOD_WAIT o corte.")
+metrics.describe("bot_cancel_seconds", "summary", "Tiempo desde que se pide cancelar una transferencia activa hasta que el worker queda libre.")
+metrics.describe("bot_dashboard_watchers", "gauge", "Paneles de administración conectados por SSE.")
+metrics.describe("bot_admission_rejected_total", "counter", "Archivos rechazados al encolar por cuota del usuario o por la cola llena, por motivo.")
+metrics.describe("bot_admitted_files", "gauge", "Archivos admitidos y aún sin terminar (cola y en proceso).")
+metrics.gauge("bot_admitted_files", lambda: admitted_total)
+metrics.describe("bot_dashboard_dropped_total", "counter", "Snapshots del panel descartados porque el cliente no los leyó a tiempo.")
+
+# --- Trazas por tarea (formato Chrome trace-event) ---
+# El task_id de cada tarea es su trace ID: viaja en current_trace_id (contextvars) por la cola,
+# las descargas, cada chunk de la subida, el refresco del token y las ediciones del estado.
+current_trace_id = contextvars.ContextVar('current_trace_id', default=None)
+
+class TraceRecorder:
+    """
+    Registrar un span es un append a un deque (seguro desde cualquier hilo); export_traces()
+    los vuelca por lotes. El archivo es un array JSON de eventos sin el "]" final, que el
+    formato permite omitir: se abre tal cual en ui.perfetto.dev o chrome://tracing, con una
+    pista por tarea. Al pasar de TRACE_MAX_MB se rota como los logs (.1, .2, ...).
+    """
+    def __init__(self, path, max_bytes, backups, buffer_max):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.buffer_max = buffer_max
+        self.pending = deque()
+        self.dropped = 0
+        self._flush_lock = threading.Lock() # export_traces (en un hilo) y el drain (en el loop) pueden coincidir
+        self._pid = os.getpid()
+        # Reloj monotónico anclado a la hora real: las trazas de front y workers se alinean en el visor
+        self._wall_offset = time.time() - time.monotonic()
+
+    def _emit(self, event):
+        if len(self.pending) >= self.buffer_max:
+            self.dropped += 1
+            return
+        self.pending.append(event)
+
+    def _event(self, name, phase, start, trace_id, args):
+        if trace_id:
+            args['trace_id'] = trace_id
+        return {'name': name, 'ph': phase, 'ts': int((start + self._wall_offset) * 1e6), 'pid': self._pid,
+                'tid': zlib.crc32(trace_id.encode()) if trace_id else 0, 'args': args}
+
+    def span(self, name, start, end, trace_id=None, **args):
+        """Span entre dos instantes de time.monotonic()."""
+        event = self._event(name, 'X', start, trace_id, args)
+        event['dur'] = int((end - start) * 1e6)
+        self._emit(event)
+
+    def instant(self, name, trace_id=None, **args):
+        event = self._event(name, 'i', time.monotonic(), trace_id, args)
+        event['s'] = 't'
+        self._emit(event)
+
+    def name_lane(self, trace_id, label):
+        """Pone nombre a la pista de una tarea (el visor la muestra en vez del número)."""
+        self._emit({'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': zlib.crc32(trace_id.encode()), 'args': {'name': label}})
+
+    def _rotate(self):
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{n}"):
+                os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def flush(self):
+        """Escribe los spans pendientes. Bloqueante: se llama desde un hilo o al apagar."""
+        # Sin el lock, dos volcados a la vez pueden ver el archivo vacío y escribir dos cabeceras "["
+        with self._flush_lock:
+            lines = []
+            while self.pending:
+                lines.append(json.dumps(self.pending.popleft(), ensure_ascii=False, separators=(',', ':')))
+            if not lines:
+                return 0
+            size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if size >= self.max_bytes:
+                self._rotate()
+                size = 0
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(("[\n" if size == 0 else ",\n") + ",\n".join(lines))
+            return len(lines)
+
+tracer = TraceRecorder(TRACE_PATH, int(TRACE_MAX_MB * 1024 * 1024), TRACE_BACKUPS, TRACE_BUFFER_MAX) if TRACE_PATH else None
+metrics.describe("bot_log_dropped_total", "counter", "Registros de log descartados porque la cola de escritura estaba llena.")
+metrics.gauge("bot_log_dropped_total", lambda: log_handler.dropped)
+metrics.describe("bot_log_sampled_total", "counter", "Registros INFO/DEBUG repetitivos omitidos por el muestreo de logs.")
+metrics.gauge("bot_log_sampled_total", lambda: log_sampler.suppressed)
+metrics.describe("bot_trace_spans_dropped_total", "counter", "Spans descartados porque el búfer de trazas estaba lleno.")
+metrics.gauge("bot_trace_spans_dropped_total", lambda: tracer.dropped if tracer else 0)
+
+@contextmanager
+def trace_span(name, trace_id=None, **args):
+    """Span de la tarea actual (o de trace_id) alrededor de un bloque, síncrono o asíncrono."""
+    if tracer is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException as e:
+        args['error'] = str(e)[:200] or type(e).__name__
+        raise
+    finally:
+        tracer.span(name, start, time.monotonic(), trace_id or current_trace_id.get(), **args)
+
+def trace_instant(name, trace_id=None, **args):
+    if tracer is not None:
+        tracer.instant(name, trace_id or current_trace_id.get(), **args)
+
+async def export_traces():
+    """Vuelca los spans al archivo de trazas cada TRACE_FLUSH_INTERVAL, fuera del event loop."""
+    while True:
+        await asyncio.sleep(TRACE_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(tracer.flush)
+        except Exception as e:
+            logger.warning(f"No se pudieron escribir las trazas en {TRACE_PATH}: {e}")
+
+# --- Conteo de FLOOD_WAIT ---
+def count_flood_wait(seconds, source, trace_id=None):
+    """Único punto de conteo de bot_flood_wait_total: las ediciones, las descargas y las esperas automáticas de pyrogram."""
+    metrics.inc("bot_flood_wait_total", source=source)
+    metrics.inc("bot_flood_wait_seconds_total", seconds, source=source)
+    trace_instant("telegram.flood_wait", trace_id, seconds=seconds, source=source)
+
+class PyrogramFloodWaitFilter(logging.Filter):
+    """
+    Pyrogram duerme él mismo los FLOOD_WAIT por debajo de sleep_threshold y solo lo deja en su log:
+    sin este filtro esas esperas no llegarían nunca a la métrica.
+    """
+    def filter(self, record):
+        if isinstance(record.msg, str) and record.msg.startswith('[%s] Waiting for %s seconds') and record.args:
+            count_flood_wait(record.args[1], 'pyrogram_auto')
+        return True
+
+logging.getLogger("pyrogram.session.session").addFilter(PyrogramFloodWaitFilter())
+
+# --- Medición del arranque ---
+startup_timings = {} # {fase: segundos desde BOOT_STARTED}
+http_ready = asyncio.Event() # Se activa cuando el servidor Quart está por servir
+
+def record_startup_phase(phase):
+    elapsed = time.monotonic() - BOOT_STARTED
+    startup_timings[phase] = round(elapsed, 3)
+    metrics.set_gauge("bot_startup_seconds", round(elapsed, 3), phase=phase)
+    logger.info(f"⏱️ Arranque: fase '{phase}' completada a los {elapsed:.3f}s.")
+
 # --- Funciones auxiliares para Google Drive ---
 def is_user_authenticated(user_id):
     creds = user_credentials.get(user_id)
@@ -64,96 +920,394 @@ def is_user_authenticated(user_id):
         return True
     if creds.expired and creds.refresh_token:
         try:
-            creds.refresh(Request())
+            load_google_modules()
+            with metrics.timer("bot_stage_seconds", stage="token_refresh"), trace_span("google.token_refresh", user_id=user_id):
+                creds.refresh(Request())
             user_credentials[user_id] = creds
             return True
         except Exception as e:
+            metrics.inc("bot_errors_total", stage="token_refresh")
             logger.error(f"Error refrescando credenciales para {user_id}: {e}")
-            user_credentials.pop(user_id, None)
+            forget_credentials(user_id, shared=_access_revoked(e))
             return False
     return False
 
+def remember_credentials(user_id, creds):
+    """Guarda las credenciales del usuario; en modo front también en la cola compartida para los workers."""
+    user_credentials[user_id] = creds
+    if job_store is not None:
+        job_store.save_credentials(user_id, creds.to_json())
+
+def forget_credentials(user_id, shared=True):
+    """Olvida las credenciales del usuario; con shared también las borra de la cola compartida."""
+    user_credentials.pop(user_id, None)
+    if shared and job_store is not None:
+        job_store.delete_credentials(user_id)
+
+def _access_revoked(error):
+    """Refresco rechazado de forma definitiva (invalid_grant): el usuario revocó el acceso al bot."""
+    return type(error).__name__ == 'RefreshError' and not getattr(error, 'retryable', False)
+
+def load_shared_credentials(user_id):
+    """Modo worker: trae de la cola compartida las credenciales que guardó el front tras /drive_login."""
+    creds_json = job_store.load_credentials(user_id)
+    if not creds_json:
+        return
+    load_google_modules()
+    from google.oauth2.credentials import Credentials
+    try:
+        user_credentials[user_id] = Credentials.from_authorized_user_info(json.loads(creds_json), SCOPES)
+    except Exception as e:
+        logger.error(f"Credenciales compartidas inválidas para {user_id}: {e}")
+
+def build_drive_service(creds):
+    # El discovery ya está precargado: no se relee el documento empaquetado en cada build
+    discovery_doc = get_drive_discovery_doc()
+    return build_from_document(discovery_doc, credentials=creds)
+
 def get_user_drive_service(user_id):
     creds = user_credentials.get(user_id)
     if not creds:
         return None
     if creds and creds.valid:
-        return build('drive', 'v3', credentials=creds)
+        return build_drive_service(creds)
     elif creds.expired and creds.refresh_token:
         try:
-            creds.refresh(Request())
+            load_google_modules()
+            with metrics.timer("bot_stage_seconds", stage="token_refresh"), trace_span("google.token_refresh", user_id=user_id):
+                creds.refresh(Request())
             user_credentials[user_id] = creds
-            return build('drive', 'v3', credentials=creds)
+            return build_drive_service(creds)
         except Exception as e:
+            metrics.inc("bot_errors_total", stage="token_refresh")
             logger.error(f"Error refrescando token para {user_id}: {e}")
-            user_credentials.pop(user_id, None)
+            forget_credentials(user_id, shared=_access_revoked(e))
             return None
     else:
         user_credentials.pop(user_id, None)
         return None
 
-# --- Clase para subida con progreso ---
-class ProgressMediaUpload(MediaIoBaseUpload):
-    def __init__(self, filename, mimetype=None, chunksize=1024 * 1024, resumable=False, callback=None, cancel_flag=None):
-        self._filename = filename
-        self._file_handle = open(filename, 'rb')
-        self._total_size = os.path.getsize(filename)
-        self._callback = callback
-        self._cancel_flag = cancel_flag
-        self._uploaded = 0
-        super().__init__(self._file_handle, mimetype or 'application/octet-stream', chunksize=chunksize, resumable=resumable)
-
-    def next_chunk(self, http=None, num_retries=0):
-        if self._cancel_flag and self._cancel_flag.is_set():
-            self._file_handle.close()
-            raise Exception("Operación cancelada por el usuario.")
+# --- Carpeta de destino por usuario en Drive ---
+# Las subidas van a una carpeta propia del bot en el Drive de cada usuario. Su ID se resuelve
+# una vez (caché en memoria + DRIVE_FOLDERS_PATH o la cola compartida) y el listado usa
+# "'<carpeta>' in parents", una consulta indexada, en vez de buscar por nombre en todo el Drive.
+DRIVE_FOLDER_MIME = 'application/vnd.google-apps.folder'
+DRIVE_FOLDER_PROPERTY = 'telegramDriveBot' # appProperty que marca la carpeta creada por el bot
+# Un lock por usuario para resolver su carpeta (peticiones HTTP lentas) y uno global y breve para
+# el mapa de locks y la escritura de DRIVE_FOLDERS_PATH: un Drive lento no frena a los demás usuarios
+_drive_folder_locks = {} # {user_id: threading.Lock}
+_drive_folders_guard = threading.Lock()
+
+def _user_folder_lock(user_id):
+    with _drive_folders_guard:
+        return _drive_folder_locks.setdefault(user_id, threading.Lock())
+
+def load_drive_folders():
+    if job_store is not None or not os.path.exists(DRIVE_FOLDERS_PATH):
+        return {} # En modo front/worker se leen de la cola compartida bajo demanda
+    try:
+        with open(DRIVE_FOLDERS_PATH) as f:
+            return {int(uid): folder_id for uid, folder_id in json.load(f).items()}
+    except Exception as e:
+        logger.error(f"No se pudo leer {DRIVE_FOLDERS_PATH}: {e}")
+        return {}
 
-        pre_pos = self._file_handle.tell()
-        status, response = super().next_chunk(http=http, num_retries=num_retries)
-        post_pos = self._file_handle.tell()
-        self._uploaded += (post_pos - pre_pos)
+drive_folder_ids = load_drive_folders() # {user_id: folder_id}
 
-        if self._callback and self._total_size > 0:
-            progress = min(100, int((self._uploaded / self._total_size) * 100))
+def _persist_drive_folder(user_id, folder_id):
+    if job_store is not None:
+        job_store.save_drive_folder(user_id, folder_id)
+        return
+    with _drive_folders_guard: # El archivo guarda las carpetas de todos los usuarios
+        tmp_path = DRIVE_FOLDERS_PATH + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({str(uid): fid for uid, fid in list(drive_folder_ids.items())}, f)
+        os.replace(tmp_path, DRIVE_FOLDERS_PATH)
+
+def forget_drive_folder(user_id):
+    """Olvida la carpeta cacheada (cuenta de Google nueva o carpeta borrada por el usuario)."""
+    with _user_folder_lock(user_id):
+        if drive_folder_ids.pop(user_id, None) is not None or job_store is not None:
             try:
-                self._callback(progress)
+                _persist_drive_folder(user_id, None)
             except Exception as e:
-                logger.warning(f"Error en callback de progreso: {e}")
+                logger.warning(f"No se pudo olvidar la carpeta de Drive de {user_id}: {e}")
 
-        if self._cancel_flag and self._cancel_flag.is_set():
-            self._file_handle.close()
-            raise Exception("Operación cancelada por el usuario.")
+def _is_legacy_upload(item):
+    """
+    ¿Lo subió una versión anterior del bot? Nombre "video_<file_unique_id>_<nombre>", tipo video/*
+    y creado por esta misma aplicación OAuth: cualquier otro archivo de la raíz es del usuario
+    y no debe acabar en la carpeta del bot (de donde "Borrar Todos" lo eliminaría).
+    """
+    parts = item.get('name', '').split('_', 2)
+    return (len(parts) == 3 and parts[0] == 'video' and parts[1] and parts[2]
+            and item.get('mimeType', '').startswith('video/') and item.get('isAppAuthorized') is True)
+
+def _adopt_legacy_uploads(service, folder_id):
+    """Mueve a la carpeta nueva los videos que versiones anteriores subían a la raíz del Drive."""
+    # Primero se recorre el listado completo y luego se mueve: mover durante la paginación saca
+    # archivos de la raíz y desplaza las páginas siguientes, que se saltarían archivos
+    legacy = []
+    page_token = None
+    while True:
+        results = service.files().list(
+            q="'root' in parents and name contains 'video_' and mimeType contains 'video/' and trashed = false",
+            fields="nextPageToken, files(id, name, mimeType, parents, isAppAuthorized)", pageSize=1000, pageToken=page_token).execute()
+        legacy.extend(item for item in results.get('files', []) if _is_legacy_upload(item))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    moved = 0
+    for item in legacy:
+        try:
+            service.files().update(fileId=item['id'], addParents=folder_id,
+                                   removeParents=','.join(item.get('parents', [])), fields='id').execute()
+            moved += 1
+        except Exception as e:
+            logger.warning(f"No se pudo mover {item['id']} a la carpeta {folder_id}: {e}")
+    return moved
+
+def resolve_drive_folder(user_id, service):
+    """
+    ID de la carpeta del bot en el Drive del usuario: de la caché, de la cola compartida, buscándola
+    por su appProperty o, si no existe, creándola. Bloqueante la primera vez: llamar con asyncio.to_thread.
+    """
+    folder_id = drive_folder_ids.get(user_id)
+    if folder_id:
+        return folder_id
+    created = False
+    with _user_folder_lock(user_id):
+        folder_id = drive_folder_ids.get(user_id) or (job_store.load_drive_folder(user_id) if job_store is not None else None)
+        if not folder_id:
+            found = service.files().list(
+                q=f"appProperties has {{ key='{DRIVE_FOLDER_PROPERTY}' and value='uploads' }}"
+                  f" and mimeType = '{DRIVE_FOLDER_MIME}' and trashed = false",
+                fields="files(id)", pageSize=1).execute().get('files', [])
+            if found:
+                folder_id = found[0]['id']
+            else:
+                folder_id = service.files().create(
+                    body={'name': DRIVE_FOLDER_NAME, 'mimeType': DRIVE_FOLDER_MIME,
+                          'appProperties': {DRIVE_FOLDER_PROPERTY: 'uploads'}},
+                    fields='id').execute()['id']
+                created = True
+            drive_folder_ids[user_id] = folder_id
+            _persist_drive_folder(user_id, folder_id)
+        else:
+            drive_folder_ids[user_id] = folder_id
+    if created:
+        # Fuera del lock: recorre toda la raíz del Drive y no debe bloquear la resolución de la carpeta
+        moved = _adopt_legacy_uploads(service, folder_id)
+        logger.info(f"📁 Carpeta '{DRIVE_FOLDER_NAME}' creada para user {user_id} ({folder_id}); {moved} videos anteriores movidos.")
+    return folder_id
+
+def _is_not_found(error):
+    resp = getattr(error, 'resp', None)
+    return resp is not None and getattr(resp, 'status', None) == 404
+
+# --- Clase para subida con progreso y verificación MD5 ---
+def _define_progress_media_upload(MediaIoBaseUpload):
+    """Define ProgressMediaUpload sobre MediaIoBaseUpload (se llama desde load_google_modules)."""
+    class ProgressMediaUpload(MediaIoBaseUpload):
+        """
+        Media resumible que calcula el MD5 de los datos a medida que se envían.
+        Los chunks se envían desde un hilo (ver send_next_chunk), así que el hash
+        nunca se ejecuta en el event loop y no requiere una segunda lectura del archivo.
+        """
+        def __init__(self, filename, mimetype=None, chunksize=1024 * 1024, resumable=False, callback=None, cancel_flag=None):
+            self._filename = filename
+            self._file_handle = open(filename, 'rb')
+            self._total_size = os.path.getsize(filename)
+            self._callback = callback
+            self._cancel_flag = cancel_flag
+            self._uploaded = 0
+            self._md5 = hashlib.md5()
+            self._hashed_until = 0 # Offset hasta el que ya se ha calculado el hash
+            super().__init__(self._file_handle, mimetype or 'application/octet-stream', chunksize=chunksize, resumable=resumable)
+
+        def has_stream(self):
+            # Forzar la ruta getbytes() de googleapiclient para ver los bytes de cada chunk
+            return False
 
-        if response is not None:
-            self._file_handle.close()
-        return status, response
+        def getbytes(self, begin, length):
+            data = super().getbytes(begin, length)
+            end = begin + len(data)
+            # Solo se hashea la parte nueva: si Drive pide reenviar un rango ya leído, no se cuenta dos veces
+            if begin <= self._hashed_until < end:
+                self._md5.update(memoryview(data)[self._hashed_until - begin:])
+                self._hashed_until = end
+            return data
+
+        def md5_hexdigest(self):
+            """MD5 de los datos enviados, o None si no se leyó el archivo completo."""
+            if self._hashed_until != self._total_size:
+                return None
+            return self._md5.hexdigest()
+
+        def send_next_chunk(self, request, num_retries=0):
+            """Envía el siguiente chunk de `request`. Bloqueante: ejecutar con asyncio.to_thread."""
+            if self._cancel_flag and self._cancel_flag.is_set():
+                self._file_handle.close()
+                raise Exception("Operación cancelada por el usuario.")
 
-    def __del__(self):
-        if hasattr(self, '_file_handle') and not self._file_handle.closed:
-            self._file_handle.close()
+            status, response = request.next_chunk(num_retries=num_retries)
+            if response is not None:
+                self._uploaded = self._total_size
+            elif status is not None:
+                self._uploaded = status.resumable_progress
 
-async def upload_to_drive_with_progress(user_id, file_path, file_name, progress_callback, cancel_flag):
-    service = get_user_drive_service(user_id)
+            if self._callback and self._total_size > 0:
+                progress = min(100, int((self._uploaded / self._total_size) * 100))
+                try:
+                    self._callback(progress)
+                except Exception as e:
+                    if self._cancel_flag and self._cancel_flag.is_set():
+                        self._file_handle.close()
+                        raise
+                    logger.warning(f"Error en callback de progreso: {e}")
+
+            if self._cancel_flag and self._cancel_flag.is_set():
+                self._file_handle.close()
+                raise Exception("Operación cancelada por el usuario.")
+
+            if response is not None:
+                self._file_handle.close()
+            return status, response
+
+        def close(self):
+            if not self._file_handle.closed:
+                self._file_handle.close()
+
+        def __del__(self):
+            if hasattr(self, '_file_handle') and not self._file_handle.closed:
+                self._file_handle.close()
+
+    return ProgressMediaUpload
+
+# --- Cancelación inmediata de transferencias ---
+async def run_cancellable(cancel_flag, awaitable, on_cancel=None):
+    """
+    Espera `awaitable` pero lo aborta en cuanto se activa cancel_flag, sin esperar al siguiente
+    chunk ni al siguiente callback de progreso. on_cancel() corta la E/S que asyncio no puede
+    interrumpir por sí solo (la petición HTTP bloqueante de un hilo).
+    """
+    if cancel_flag.is_set():
+        raise Exception("Operación cancelada por el usuario.")
+    work = asyncio.ensure_future(awaitable)
+    cancelled = asyncio.ensure_future(cancel_flag.wait())
+    try:
+        await asyncio.wait({work, cancelled}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        cancelled.cancel()
+        if not work.done():
+            work.cancel()
+    if not work.cancelled() and work.done():
+        return work.result()
+    if on_cancel:
+        on_cancel()
+    # La descarga cancelada borra su temporal al recibir CancelledError: se le da un momento
+    await asyncio.wait({work}, timeout=CANCEL_GRACE)
+    raise Exception("Operación cancelada por el usuario.")
+
+def _delete_resumable_session(session_uri):
+    """Borra la sesión resumible en Drive para que no quede una subida a medias (Drive responde 499)."""
+    try:
+        urllib.request.urlopen(urllib.request.Request(session_uri, method='DELETE'), timeout=10).close()
+    except urllib.error.HTTPError:
+        pass # 499 (u otro código): la sesión ya no sirve
+    except Exception as e:
+        logger.warning(f"No se pudo borrar la sesión de subida resumible: {e}")
+
+def _abort_upload(service, request):
+    """
+    Corta la subida en curso: cierra los sockets del servicio (el hilo bloqueado en send/recv
+    falla al instante y no puede reconectar) y borra la sesión resumible en segundo plano.
+    """
+    http = getattr(service, '_http', None)
+    http = getattr(http, 'http', http) # AuthorizedHttp envuelve al httplib2.Http con las conexiones
+    for conn in list(getattr(http, 'connections', {}).values()):
+        conn.connect = _refuse_connect # httplib2 reintenta una vez con una conexión nueva: se impide
+        if conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+    if getattr(request, 'resumable_uri', None):
+        asyncio.get_running_loop().run_in_executor(None, _delete_resumable_session, request.resumable_uri)
+
+def _refuse_connect(*args, **kwargs):
+    raise OSError("Subida cancelada.")
+
+def _delete_drive_file_quietly(service, file_id):
+    try:
+        service.files().delete(fileId=file_id).execute()
+    except Exception as e:
+        logger.warning(f"No se pudo borrar el archivo corrupto {file_id} de Drive: {e}")
+
+async def upload_to_drive_with_progress(user_id, file_path, file_name, progress_callback, cancel_flag, service=None, mime_type=None):
+    await ensure_google_modules()
+    service = service or get_user_drive_service(user_id)
     if not service:
         return None
     try:
-        file_metadata = {'name': file_name}
-        mime_type, _ = mimetypes.guess_type(file_path)
-        media = ProgressMediaUpload(
-            filename=file_path,
-            mimetype=mime_type or 'application/octet-stream',
-            chunksize=1024 * 1024,
-            resumable=True,
-            callback=progress_callback,
-            cancel_flag=cancel_flag
-        )
-        request = service.files().create(body=file_metadata, media_body=media, fields='id')
-        response = None
-        while response is None:
-            if cancel_flag.is_set():
-                raise Exception("Operación cancelada por el usuario.")
-            status, response = request.next_chunk()
-        return response.get('id')
+        # Tras la primera vez es una búsqueda en el dict: en un lote se resuelve una sola vez
+        folder_id = drive_folder_ids.get(user_id)
+        if not folder_id:
+            with trace_span("drive.resolve_folder"):
+                folder_id = await asyncio.to_thread(resolve_drive_folder, user_id, service)
+        file_metadata = {'name': file_name, 'parents': [folder_id]}
+        mime_type = mime_type or mimetypes.guess_type(file_path)[0] # Normalmente ya viene de los metadatos de Telegram
+        attempt = 0
+        while attempt < UPLOAD_MD5_MAX_ATTEMPTS:
+            attempt += 1
+            media = ProgressMediaUpload(
+                filename=file_path,
+                mimetype=mime_type or 'application/octet-stream',
+                chunksize=1024 * 1024,
+                resumable=True,
+                callback=progress_callback,
+                cancel_flag=cancel_flag
+            )
+            try:
+                request = service.files().create(body=file_metadata, media_body=media, fields='id, md5Checksum')
+                response = None
+                chunk = 0
+                while response is None:
+                    chunk += 1
+                    # El chunk en vuelo se aborta en cuanto se cancela, no al terminar de enviarse
+                    with trace_span("drive.next_chunk", chunk=chunk, attempt=attempt):
+                        status, response = await run_cancellable(cancel_flag, asyncio.to_thread(media.send_next_chunk, request),
+                                                                 on_cancel=lambda: _abort_upload(service, request))
+            except Exception as e:
+                if not (_is_not_found(e) and folder_id in str(e)) or file_metadata['parents'] != [folder_id]:
+                    raise
+                # La carpeta cacheada ya no existe (el usuario la borró): se resuelve de nuevo una vez
+                logger.warning(f"La carpeta {folder_id} de user {user_id} ya no existe; se vuelve a crear.")
+                trace_instant("drive.folder_missing", folder_id=folder_id)
+                await asyncio.to_thread(forget_drive_folder, user_id)
+                file_metadata['parents'] = [await asyncio.to_thread(resolve_drive_folder, user_id, service)]
+                attempt -= 1
+                continue
+            finally:
+                media.close()
+
+            file_id = response.get('id')
+            remote_md5 = response.get('md5Checksum')
+            local_md5 = media.md5_hexdigest()
+            if not remote_md5:
+                logger.warning(f"Drive no devolvió md5Checksum para {file_id}; se omite la verificación.")
+                return file_id
+            if local_md5 == remote_md5:
+                logger.info(f"MD5 verificado para {file_id} ({local_md5}).")
+                return file_id
+
+            logger.warning(
+                f"MD5 no coincide para {file_name} de user {user_id} (intento {attempt}/{UPLOAD_MD5_MAX_ATTEMPTS}): "
+                f"local={local_md5} drive={remote_md5}. Reintentando subida."
+            )
+            trace_instant("drive.md5_mismatch", attempt=attempt)
+            await asyncio.to_thread(_delete_drive_file_quietly, service, file_id)
+        raise Exception(f"La verificación de integridad (MD5) falló tras {UPLOAD_MD5_MAX_ATTEMPTS} intentos.")
     except Exception as e:
         logger.error(f"Error subiendo a Drive para {user_id}: {e}")
         raise e
@@ -161,23 +1315,32 @@ async def upload_to_drive_with_progress(user_id, file_path, file_name, progress_
 def get_file_url(file_id):
     return f"https://drive.google.com/file/d/{file_id}/view?usp=sharing"
 
-def list_drive_videos(user_id):
+def list_drive_videos(user_id, limit=100):
+    """Archivos de la carpeta del bot, los más recientes primero: como mucho limit (None = todos, página a página)."""
     service = get_user_drive_service(user_id)
     if not service:
         return []
     try:
-        query = "name contains 'video_' and (mimeType contains 'video/' or name contains '.mp4' or name contains '.avi' or name contains '.mov' or name contains '.wmv' or name contains '.flv' or name contains '.webm')"
-        results = service.files().list(
-            pageSize=100,
-            fields="nextPageToken, files(id, name, mimeType, size, createdTime)",
-            q=query,
-            orderBy="createdTime desc"
-        ).execute()
-        items = results.get('files', [])
+        # Solo la carpeta del bot: consulta por padre, indexada, sin recorrer todo el Drive
+        query = f"'{resolve_drive_folder(user_id, service)}' in parents and trashed = false"
+        items = []
+        page_token = None
+        while True:
+            results = service.files().list(
+                pageSize=min(limit, 1000) if limit else 1000,
+                fields="nextPageToken, files(id, name, mimeType, size, createdTime)",
+                q=query,
+                orderBy="createdTime desc",
+                pageToken=page_token
+            ).execute()
+            items.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token or (limit and len(items) >= limit):
+                break
         processed_items = []
         for item in items:
             drive_name = item.get('name', 'Sin_nombre')
-            if drive_name.startswith("video_") and '_' in drive_name:
+            if drive_name.startswith(DRIVE_NAME_PREFIXES) and drive_name.count('_') >= 2:
                 parts = drive_name.split('_', 2)
                 display_name = parts[2] if len(parts) == 3 else drive_name
             else:
@@ -203,19 +1366,20 @@ def delete_from_drive(file_id, user_id):
 # --- NUEVA: Función para borrar todos los videos del usuario ---
 async def delete_all_user_videos(user_id: int, status_message: Message, client: Client):
     """
-    Borra todos los videos del usuario de su Google Drive.
+    Borra todos los archivos de la carpeta del bot en el Google Drive del usuario.
     """
     try:
-        videos = list_drive_videos(user_id)
+        # Listar (y, la primera vez, crear la carpeta) son peticiones HTTP bloqueantes: fuera del event loop
+        videos = await asyncio.to_thread(list_drive_videos, user_id, None) # Todos, no solo la primera página
         if not videos:
-            await status_message.edit_text("ℹ️ No se encontraron videos para borrar.")
+            await status_message.edit_text("ℹ️ No se encontraron archivos para borrar.")
             return
 
         total_videos = len(videos)
         deleted_count = 0
         failed_count = 0
 
-        await status_message.edit_text(f"🗑️ Borrando {total_videos} videos... 0%")
+        await status_message.edit_text(f"🗑️ Borrando {total_videos} archivos... 0%")
 
         for i, video in enumerate(videos):
             file_id = video.get('id')
@@ -224,15 +1388,15 @@ async def delete_all_user_videos(user_id: int, status_message: Message, client:
             # Calcular progreso
             progress = int(((i + 1) / total_videos) * 100)
             
-            if delete_from_drive(file_id, user_id):
+            if await asyncio.to_thread(delete_from_drive, file_id, user_id):
                 deleted_count += 1
                 # Actualizar mensaje de progreso
-                await status_message.edit_text(f"🗑️ Borrando {total_videos} videos...\n"
+                await status_message.edit_text(f"🗑️ Borrando {total_videos} archivos...\n"
                                               f"Progreso: {progress}%\n"
                                               f"Éxito: {deleted_count}/{total_videos}")
             else:
                 failed_count += 1
-                logger.warning(f"Error al borrar video {file_name} (ID: {file_id}) para user {user_id}")
+                logger.warning(f"Error al borrar {file_name} (ID: {file_id}) para user {user_id}")
                 # No detener el proceso por un fallo individual
             
             # Pequeña pausa para no saturar la API de Google Drive
@@ -240,7 +1404,7 @@ async def delete_all_user_videos(user_id: int, status_message: Message, client:
 
         # Mensaje final
         if failed_count == 0:
-            final_message = f"✅ Todos los videos ({deleted_count}) han sido eliminados exitosamente de tu Google Drive."
+            final_message = f"✅ Todos los archivos ({deleted_count}) han sido eliminados exitosamente de tu Google Drive."
         else:
             final_message = (f"⚠️ Proceso de eliminación completado.\n"
                             f"Éxito: {deleted_count}/{total_videos}\n"
@@ -250,20 +1414,384 @@ async def delete_all_user_videos(user_id: int, status_message: Message, client:
 
     except Exception as e:
         logger.error(f"Error en delete_all_user_videos para user {user_id}: {e}")
-        await status_message.edit_text(f"❌ Ocurrió un error al borrar los videos: {str(e)}")
+        await status_message.edit_text(f"❌ Ocurrió un error al borrar los archivos: {str(e)}")
+
+# --- Archivos adjuntos soportados (video, documento, audio o animación) ---
+MEDIA_KINDS = ('video', 'document', 'audio', 'animation') # Orden en que se busca el adjunto en el mensaje
+MEDIA_LABELS = {'video': 'video', 'document': 'archivo', 'audio': 'audio', 'animation': 'GIF'}
+DRIVE_NAME_PREFIXES = tuple(f"{kind}_" for kind in MEDIA_KINDS) # Prefijo "<tipo>_<file_unique_id>_" de los nombres en Drive
+media_filter = filters.video | filters.document | filters.audio | filters.animation
+
+def describe_media(message):
+    """
+    Descriptor del adjunto del mensaje, o None si no trae ninguno soportado. El tipo MIME se
+    toma una sola vez de los metadatos de Telegram; solo si faltan se deduce del nombre.
+    """
+    for kind in MEDIA_KINDS:
+        media = getattr(message, kind, None)
+        if media:
+            break
+    else:
+        return None
+    file_name = getattr(media, 'file_name', None)
+    mime_type = getattr(media, 'mime_type', None) or (mimetypes.guess_type(file_name)[0] if file_name else None) or 'application/octet-stream'
+    if not file_name:
+        # Los videos, audios y GIF sin nombre se llaman como su tipo, con la extensión del MIME
+        file_name = MEDIA_LABELS[kind].lower() + (mimetypes.guess_extension(mime_type) or '')
+    return {
+        'kind': kind,
+        'label': MEDIA_LABELS[kind],
+        'media': media,
+        'file_name': file_name,
+        'mime_type': mime_type,
+        'drive_name': f"{kind}_{media.file_unique_id}_{file_name}",
+    }
+
+def capitalize_label(label):
+    return label[:1].upper() + label[1:]
+
+# --- Descargas repartidas entre varias sesiones de Telegram ---
+TELEGRAM_CHUNK_SIZE = 1024 * 1024 # stream_media entrega (y cuenta offset/limit en) bloques de 1 MiB
+
+def _media_dc_id(media):
+    """DC donde Telegram guarda el archivo (0 si no se puede decodificar el file_id)."""
+    try:
+        from pyrogram.file_id import FileId
+        return FileId.decode(media.file_id).dc_id
+    except Exception:
+        return 0
+
+class DownloadSessionPool:
+    """
+    Sesiones del bot disponibles para descargar. Telegram limita el ritmo por sesión, así que
+    los archivos grandes se parten en fragmentos que las sesiones se van repartiendo según
+    quedan libres. Una sesión que recibe FLOOD_WAIT (o se corta) se aparta durante la espera
+    y el resto del fragmento lo termina otra.
+    """
+    def __init__(self):
+        self.extra_clients = {} # {nombre: Client} sesiones extra; la principal llega en cada llamada
+        self.state = {} # {nombre: {'active': n, 'active_by_dc': {dc: n}, 'cooldown_until': t}}
+
+    def add(self, name, client):
+        self.extra_clients[name] = client
+
+    def _state(self, name):
+        return self.state.setdefault(name, {'active': 0, 'active_by_dc': {}, 'cooldown_until': 0.0})
+
+    def _sessions(self, primary):
+        return [('principal', primary)] + list(self.extra_clients.items())
+
+    def _cool_down(self, name, seconds, reason):
+        state = self._state(name)
+        state['cooldown_until'] = max(state['cooldown_until'], time.monotonic() + seconds)
+        metrics.inc("bot_download_failover_total", session=name)
+        logger.warning(f"Sesión de descarga '{name}' en pausa {seconds:.0f}s: {reason}")
+
+    def pick(self, primary, dc_id):
+        """La sesión con menos descargas en ese DC y en total; si todas están en pausa, la que antes vuelve."""
+        now = time.monotonic()
+        def load(session):
+            state = self._state(session[0])
+            cooling = state['cooldown_until'] > now
+            return (cooling, state['cooldown_until'] if cooling else 0, state['active_by_dc'].get(dc_id, 0), state['active'])
+        return min(self._sessions(primary), key=load)
+
+    @contextmanager
+    def _busy(self, name, dc_id):
+        state = self._state(name)
+        state['active'] += 1
+        state['active_by_dc'][dc_id] = state['active_by_dc'].get(dc_id, 0) + 1
+        try:
+            yield
+        finally:
+            state['active'] -= 1
+            state['active_by_dc'][dc_id] -= 1
+
+    async def download(self, primary, message, media, file_name, progress, cancel_flag):
+        """Descarga el archivo del mensaje en DOWNLOAD_DIR y devuelve su ruta."""
+        dc_id = _media_dc_id(media)
+        if self.extra_clients and (media.file_size or 0) > DOWNLOAD_SHARD_MB * TELEGRAM_CHUNK_SIZE:
+            return await self._download_sharded(primary, message, media, file_name, progress, cancel_flag, dc_id)
+
+        last_error = None
+        for _ in range(DOWNLOAD_SHARD_ATTEMPTS):
+            name, client = self.pick(primary, dc_id)
+            wait = self._state(name)['cooldown_until'] - time.monotonic()
+            if wait > 0:
+                with trace_span("telegram.session_cooldown", session=name):
+                    await asyncio.sleep(wait)
+            try:
+                with self._busy(name, dc_id), trace_span("telegram.download_media", session=name):
+                    file_path = await client.download_media(message, file_name=DOWNLOAD_DIR + os.sep, progress=progress)
+            except FloodWait as e:
+                count_flood_wait(e.value, 'download')
+                self._cool_down(name, e.value, f"FLOOD_WAIT de {e.value}s")
+                last_error = e
+                continue
+            if cancel_flag.is_set():
+                raise Exception("Operación cancelada por el usuario.")
+            if file_path:
+                metrics.inc("bot_download_session_bytes_total", media.file_size or 0, session=name)
+                return file_path
+            # Pyrogram no propaga los FLOOD_WAIT largos ni los cortes de red: devuelve None
+            last_error = "descarga interrumpida"
+            self._cool_down(name, DOWNLOAD_SESSION_COOLDOWN, last_error)
+        raise Exception(f"No se pudo descargar el archivo: {last_error}")
+
+    async def _download_sharded(self, primary, message, media, file_name, progress, cancel_flag, dc_id):
+        size = media.file_size
+        total_chunks = -(-size // TELEGRAM_CHUNK_SIZE)
+        # (primer bloque, bloque final exclusivo, intentos fallidos)
+        pending = deque((start, min(start + DOWNLOAD_SHARD_MB, total_chunks), 0)
+                        for start in range(0, total_chunks, DOWNLOAD_SHARD_MB))
+        downloaded = 0
+        in_flight = 0 # Fragmentos en curso: si uno falla, su resto vuelve a pending
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        file_path = os.path.join(DOWNLOAD_DIR, f"{media.file_unique_id}_{os.path.basename(file_name)}")
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        async def run_session(name, client):
+            nonlocal downloaded, in_flight
+            while pending or in_flight:
+                # Una sesión en pausa (o sin trabajo) espera en pasos cortos: si las demás terminan, no hay que esperarla
+                if not pending or self._state(name)['cooldown_until'] > time.monotonic():
+                    await asyncio.sleep(0.05 if not pending else min(0.5, self._state(name)['cooldown_until'] - time.monotonic()))
+                    continue
+                start, end, failures = pending.popleft()
+                in_flight += 1
+                position = start
+                reason = None
+                try:
+                    with self._busy(name, dc_id), trace_span("telegram.download_shard", session=name, first_chunk=start, end_chunk=end):
+                        async for chunk in client.stream_media(message, limit=end - start, offset=start):
+                            await asyncio.to_thread(os.pwrite, fd, chunk, position * TELEGRAM_CHUNK_SIZE)
+                            position += 1
+                            downloaded += len(chunk)
+                            metrics.inc("bot_download_session_bytes_total", len(chunk), session=name)
+                            progress(downloaded, size)
+                            if position >= end:
+                                break
+                except FloodWait as e:
+                    count_flood_wait(e.value, 'download')
+                    self._cool_down(name, e.value, f"FLOOD_WAIT de {e.value}s")
+                    reason = e
+                finally:
+                    in_flight -= 1
+                if position >= end:
+                    continue
+                if cancel_flag.is_set():
+                    raise Exception("Operación cancelada por el usuario.")
+                if reason is None:
+                    # stream_media termina antes de tiempo en vez de propagar FLOOD_WAIT largos o cortes
+                    reason = "fragmento incompleto"
+                    self._cool_down(name, DOWNLOAD_SESSION_COOLDOWN, reason)
+                if failures + 1 >= DOWNLOAD_SHARD_ATTEMPTS:
+                    raise Exception(f"No se pudo descargar el archivo: {reason}")
+                # Lo que falta del fragmento vuelve a la cola para la primera sesión libre
+                pending.appendleft((position, end, failures + 1))
+
+        tasks = [asyncio.create_task(run_session(name, client)) for name, client in self._sessions(primary)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            os.close(fd)
+            os.remove(file_path)
+            raise
+        os.close(fd)
+        return file_path
+
+download_pool = DownloadSessionPool()
+
+async def start_download_sessions():
+    """Arranca las sesiones extra de descarga (DOWNLOAD_SESSIONS), todas con el token del bot."""
+    for n in range(1, DOWNLOAD_SESSIONS + 1):
+        name = f"{app_telegram.name}_dl{n}"
+        client = Client(name, api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, no_updates=True)
+        try:
+            await client.start()
+            download_pool.add(name, client)
+        except Exception as e:
+            logger.error(f"No se pudo iniciar la sesión de descarga {name}: {e}")
+    if download_pool.extra_clients:
+        logger.info(f"📥 {len(download_pool.extra_clients)} sesiones extra de descarga activas.")
+
+# --- Avance de las transferencias (panel de administración) ---
+def start_stage(operation, stage, total=0):
+    """Marca el inicio de la descarga o subida de un archivo (referencia para la velocidad media)."""
+    operation.update(stage=stage, stage_started=time.monotonic(), bytes_done=0, bytes_total=total)
+
+def track_progress(operation, stage, done, total):
+    """
+    Registra bytes transferidos en la operación activa. Se llama desde los mismos callbacks de
+    progreso que editan el mensaje de estado, en los hilos de descarga/subida: solo asigna
+    campos, el panel calcula velocidad y ETA al publicar.
+    """
+    if operation.get('stage') != stage:
+        start_stage(operation, stage)
+    operation['bytes_done'] = done
+    operation['bytes_total'] = total
+
+def record_failure(task_id, user_id, file_name, stage, error):
+    recent_failures.append({
+        'time': time.time(),
+        'task_id': task_id,
+        'user_id': user_id,
+        'file_name': file_name,
+        'stage': stage,
+        'error': str(error)[:200],
+    })
+
+# --- Cuotas por usuario y control de admisión ---
+QUOTA_KEYS = ('archivos', 'mb', 'hora') # Límites por usuario que el admin puede ajustar con /cuota
+quota_limits = {'archivos': QUOTA_MAX_QUEUED, 'mb': QUOTA_MAX_QUEUED_MB, 'hora': QUOTA_UPLOADS_PER_HOUR, 'cola': QUEUE_HIGH_WATER}
+quota_overrides = {} # {user_id: {'archivos': n, 'mb': n, 'hora': n, 'exento': bool}} - Ajustes del admin por usuario
+quota_usage = {} # {user_id: {'items': n, 'bytes': n, 'tokens': x, 'refilled': t}} - Pendiente de cada usuario y cubo de /hora
+admitted_tasks = {} # {task_id: (user_id, archivos, bytes)} - Cuota reservada por cada tarea hasta que termina
+admitted_total = 0 # Archivos admitidos y aún sin terminar, de todos los usuarios
+seconds_per_file = 30.0 # Media móvil del tiempo de proceso por archivo (estimación del retry-after)
+
+def user_quota(user_id):
+    """Límites efectivos del usuario, o None si está exento."""
+    override = quota_overrides.get(user_id, {})
+    if user_id == ADMIN_TELEGRAM_ID or override.get('exento'):
+        return None
+    return {key: override.get(key, quota_limits[key]) for key in QUOTA_KEYS}
+
+def _refill_hourly_tokens(usage, per_hour, now):
+    """Cubo de tokens: se recupera un archivo cada 3600/per_hour segundos, hasta per_hour."""
+    if per_hour > 0:
+        usage['tokens'] = min(float(per_hour), usage['tokens'] + (now - usage['refilled']) * per_hour / 3600)
+    usage['refilled'] = now
+
+def _quota_rejection(usage, limits, files, size, now):
+    """(motivo, segundos de espera estimados o None si esperar no basta) o None si cabe."""
+    high_water = quota_limits['cola']
+    if high_water and admitted_total + files > high_water:
+        return 'cola', (admitted_total + files - high_water) * seconds_per_file
+    if limits['archivos']:
+        if files > limits['archivos']:
+            return 'lote_archivos', None
+        if usage['items'] + files > limits['archivos']:
+            return 'archivos', (usage['items'] + files - limits['archivos']) * seconds_per_file
+    max_bytes = limits['mb'] * 1024 * 1024
+    if max_bytes:
+        if size > max_bytes:
+            return 'lote_mb', None
+        if usage['bytes'] + size > max_bytes:
+            # Archivos propios que deben terminar para liberar el espacio, al tamaño medio de los pendientes
+            average = usage['bytes'] / max(usage['items'], 1)
+            return 'mb', -(-(usage['bytes'] + size - max_bytes) // max(average, 1)) * seconds_per_file
+    if limits['hora']:
+        if files > limits['hora']:
+            return 'lote_hora', None
+        _refill_hourly_tokens(usage, limits['hora'], now)
+        if usage['tokens'] < files:
+            return 'hora', (files - usage['tokens']) * 3600 / limits['hora']
+    return None
+
+def admit_upload(user_id, task_id, files, size, enforce=True):
+    """
+    Control de admisión al encolar, en O(1). Si la tarea cabe reserva su cuota y devuelve None;
+    si no, devuelve (motivo, segundos de espera estimados o None). Con enforce=False (tareas
+    ya aceptadas antes de un reinicio) solo reserva.
+    """
+    global admitted_total
+    limits = user_quota(user_id)
+    now = time.monotonic()
+    usage = quota_usage.get(user_id)
+    if usage is None:
+        usage = {'items': 0, 'bytes': 0, 'tokens': float(limits['hora'] if limits else 0), 'refilled': now}
+    if limits is not None and enforce:
+        rejection = _quota_rejection(usage, limits, files, size, now)
+        if rejection:
+            metrics.inc("bot_admission_rejected_total", reason=rejection[0])
+            return rejection
+        if limits['hora']:
+            usage['tokens'] -= files
+    usage['items'] += files
+    usage['bytes'] += size
+    quota_usage[user_id] = usage
+    admitted_tasks[task_id] = (user_id, files, size)
+    admitted_total += files
+    return None
+
+def release_quota(task_id, elapsed=None):
+    """Devuelve la cuota de una tarea terminada o cancelada; elapsed (s) alimenta la estimación del retry-after."""
+    global admitted_total, seconds_per_file
+    admitted = admitted_tasks.pop(task_id, None)
+    if admitted is None:
+        return # Ya liberada, o tarea que no pasó por la admisión de este proceso
+    user_id, files, size = admitted
+    admitted_total -= files
+    if elapsed is not None:
+        seconds_per_file = 0.8 * seconds_per_file + 0.2 * (elapsed / files)
+    usage = quota_usage.get(user_id)
+    if usage:
+        usage['items'] -= files
+        usage['bytes'] -= size
+
+def sweep_quota_usage():
+    """Olvida a los usuarios sin nada pendiente y con el cubo de /hora ya lleno."""
+    now = time.monotonic()
+    for user_id, usage in list(quota_usage.items()):
+        limits = user_quota(user_id)
+        per_hour = limits['hora'] if limits else 0
+        _refill_hourly_tokens(usage, per_hour, now)
+        if usage['items'] <= 0 and (not per_hour or usage['tokens'] >= per_hour):
+            del quota_usage[user_id]
+
+def _format_wait(seconds):
+    seconds = max(1, int(seconds + 0.5))
+    if seconds < 60:
+        return f"{seconds} s"
+    if seconds < 3600:
+        return f"{-(-seconds // 60)} min"
+    return f"{seconds / 3600:.1f} h"
+
+def admission_rejection_text(user_id, reason, retry_after, files):
+    limits = user_quota(user_id) or {}
+    usage = quota_usage.get(user_id, {'items': 0, 'bytes': 0})
+    texts = {
+        'cola': "🚦 El bot está al máximo de su capacidad en este momento.",
+        'archivos': f"🚦 Ya tienes {usage['items']} archivos pendientes (máximo {limits.get('archivos')}).",
+        'mb': f"🚦 Ya tienes {usage['bytes'] / (1024 * 1024):.0f} MB pendientes (máximo {limits.get('mb')} MB).",
+        'hora': f"🚦 Llegaste al límite de {limits.get('hora')} archivos por hora.",
+        'lote_archivos': f"🚦 Enviaste {files} archivos de una vez y tu límite es {limits.get('archivos')} pendientes.",
+        'lote_mb': f"🚦 Este envío supera tu límite de {limits.get('mb')} MB pendientes.",
+        'lote_hora': f"🚦 Enviaste {files} archivos de una vez y tu límite es {limits.get('hora')} por hora.",
+    }
+    text = texts[reason] + (" No se ha encolado." if files == 1 else f" No se ha encolado ninguno de los {files} archivos.")
+    if retry_after is None:
+        return text + "\nEnvíalos en tandas más pequeñas."
+    return text + f"\n⏱️ Vuelve a intentarlo en ~{_format_wait(retry_after)}."
 
 # --- Función auxiliar para actualizar mensajes de estado ---
-async def update_status_message(client: Client, chat_id: int, message_id: int, text: str, user_id: int, remove_buttons: bool = False):
+async def update_status_message(client: Client, chat_id: int, message_id: int, text: str, user_id: int, remove_buttons: bool = False, task_id: str = None):
+    start = time.perf_counter()
+    span_start = time.monotonic()
     try:
-        if remove_buttons:
+        if remove_buttons or not task_id:
             await client.edit_message_text(chat_id, message_id, text, parse_mode=enums.ParseMode.MARKDOWN, disable_web_page_preview=True)
         else:
-            cancel_button = [[InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_{user_id}")]]
+            # El botón debe llevar el task_id: on_callback_query busca la operación por ese ID
+            cancel_button = [[InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_{task_id}")]]
             reply_markup = InlineKeyboardMarkup(cancel_button)
             await client.edit_message_text(chat_id, message_id, text, parse_mode=enums.ParseMode.MARKDOWN, disable_web_page_preview=True, reply_markup=reply_markup)
+    except FloodWait as e:
+        count_flood_wait(e.value, 'status_edit', task_id)
+        logger.warning(f"FLOOD_WAIT de {e.value}s actualizando mensaje de estado.")
     except Exception as e:
         if "MESSAGE_NOT_MODIFIED" not in str(e):
+            metrics.inc("bot_errors_total", stage="status_edit")
             logger.error(f"Error actualizando mensaje de estado: {e}")
+    finally:
+        metrics.observe("bot_stage_seconds", time.perf_counter() - start, stage="status_edit")
+        if tracer is not None:
+            # Las ediciones lanzadas desde los hilos de progreso no heredan el contexto: de ahí task_id
+            tracer.span("telegram.edit_status", span_start, time.monotonic(), task_id or current_trace_id.get())
 
 # --- NUEVA: Función para actualizar el mensaje de estado de cola ---
 async def update_queue_status_message(client: Client, user_id: int, chat_id: int, message_id: int, position: int):
@@ -273,23 +1801,132 @@ async def update_queue_status_message(client: Client, user_id: int, chat_id: int
     try:
         if position <= 0:
             if position == 0:
-                 await client.edit_message_text(chat_id, message_id, "⏳ Su video está próximo a ser procesado.", parse_mode=enums.ParseMode.MARKDOWN)
+                 await client.edit_message_text(chat_id, message_id, "⏳ Su archivo está próximo a ser procesado.", parse_mode=enums.ParseMode.MARKDOWN)
         else:
-            await client.edit_message_text(chat_id, message_id, f"⏳ Su video está en cola. Posición: {position}.", parse_mode=enums.ParseMode.MARKDOWN)
+            await client.edit_message_text(chat_id, message_id, f"⏳ Su archivo está en cola. Posición: {position}.", parse_mode=enums.ParseMode.MARKDOWN)
+    except FloodWait as e:
+        count_flood_wait(e.value, 'queue_edit')
+        logger.warning(f"FLOOD_WAIT de {e.value}s actualizando mensaje de cola para user {user_id}.")
     except Exception as e:
         if "MESSAGE_NOT_MODIFIED" not in str(e) and "Message to edit not found" not in str(e):
             logger.warning(f"Error actualizando mensaje de cola para user {user_id}, msg_id {message_id}: {e}")
 
+# --- Procesamiento de lotes (álbumes y reenvíos masivos) ---
+async def process_batch(client: Client, queue_item: dict, task_id: str, status_message_id: int, service, cancel_flag: asyncio.Event):
+    """
+    Sube los archivos de un lote uno tras otro con un solo mensaje de estado y el mismo servicio
+    de Drive. El estado se edita como mucho cada BATCH_STATUS_INTERVAL; un error en un archivo
+    no detiene el lote, pero una cancelación sí.
+    """
+    user_id = queue_item['user_id']
+    messages = queue_item['messages']
+    chat_id = messages[0].chat.id
+    operation = active_operations[task_id]
+    total = len(messages)
+    results = [] # [(nombre, file_id o None)]
+    last_edit = 0.0
+    main_loop = asyncio.get_running_loop()
+
+    async def report(detail, force=False):
+        nonlocal last_edit
+        if not force and time.monotonic() - last_edit < BATCH_STATUS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        uploaded = sum(1 for _, file_id in results if file_id)
+        await update_status_message(client, chat_id, status_message_id,
+            f"📦 Lote de {total} archivos: {uploaded} subidos, {len(results) - uploaded} con error.\n{detail}",
+            user_id, task_id=task_id)
+
+    for index, message in enumerate(messages, 1):
+        if cancel_flag.is_set():
+            raise Exception("Operación cancelada por el usuario.")
+        descriptor = describe_media(message)
+        file_name = descriptor['file_name']
+        operation['file_name'] = file_name
+
+        def download_progress(current, size, index=index, file_name=file_name):
+            if cancel_flag.is_set():
+                raise Exception("Operación cancelada por el usuario.")
+            track_progress(operation, 'download', current, size)
+            if size > 0 and time.monotonic() - last_edit >= BATCH_STATUS_INTERVAL:
+                main_loop.call_soon_threadsafe(asyncio.create_task, report(f"📥 {index}/{total} {file_name}: descargando {int(current / size * 100)}%"))
+
+        def upload_progress(progress, index=index, file_name=file_name):
+            if cancel_flag.is_set():
+                raise Exception("Operación cancelada por el usuario.")
+            track_progress(operation, 'upload', int(file_size * progress / 100), file_size)
+            if time.monotonic() - last_edit >= BATCH_STATUS_INTERVAL:
+                main_loop.call_soon_threadsafe(asyncio.create_task, report(f"☁️ {index}/{total} {file_name}: subiendo {int(progress)}%"))
+
+        file_path = None
+        file_id = None
+        try:
+            start_stage(operation, 'download', descriptor['media'].file_size or 0)
+            download_start = time.perf_counter()
+            with trace_span("download", index=index, file_name=file_name, bytes=descriptor['media'].file_size or 0):
+                file_path = await run_cancellable(cancel_flag, download_pool.download(client, message, descriptor['media'], file_name, download_progress, cancel_flag))
+            download_elapsed = time.perf_counter() - download_start
+            file_size = os.path.getsize(file_path)
+            operation['file_path'] = file_path
+            metrics.observe("bot_stage_seconds", download_elapsed, stage="download")
+            metrics.inc("bot_transfer_bytes_total", file_size, direction="download")
+
+            start_stage(operation, 'upload', file_size)
+            upload_start = time.perf_counter()
+            with trace_span("upload", index=index, file_name=file_name, bytes=file_size):
+                file_id = await upload_to_drive_with_progress(user_id, file_path, descriptor['drive_name'], upload_progress, cancel_flag,
+                                                              service=service, mime_type=descriptor['mime_type'])
+            metrics.observe("bot_stage_seconds", time.perf_counter() - upload_start, stage="upload")
+            if file_id:
+                metrics.inc("bot_transfer_bytes_total", file_size, direction="upload")
+        except Exception as e:
+            if cancel_flag.is_set():
+                raise
+            metrics.inc("bot_errors_total", stage="batch_item")
+            record_failure(task_id, user_id, file_name, "batch_item", e)
+            logger.error(f"Error en el archivo {index}/{total} del lote {task_id}: {e}")
+        finally:
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+
+        results.append((file_name, file_id))
+        operation['messages'].remove(message)
+        metrics.inc("bot_tasks_total", result="ok" if file_id else "error")
+        await report(f"✔️ {index}/{total} {file_name}")
+
+    uploaded = [(name, file_id) for name, file_id in results if file_id]
+    failed = [name for name, file_id in results if not file_id]
+    lines = [f"{'✅' if not failed else '⚠️'} Lote terminado: {len(uploaded)} de {total} archivos subidos a tu Google Drive.", ""]
+    lines += [f"🔗 [{name}]({get_file_url(file_id)})" for name, file_id in uploaded[:BATCH_LINKS_SHOWN]]
+    if len(uploaded) > BATCH_LINKS_SHOWN:
+        lines.append(f"... y {len(uploaded) - BATCH_LINKS_SHOWN} más.")
+    lines += [f"❌ {name}" for name in failed]
+    lines += ["", "Usa /ver_nube para ver y gestionar tus archivos."]
+    await update_status_message(client, chat_id, status_message_id, "\n".join(lines), user_id, remove_buttons=True)
+    logger.info(f"Lote {task_id} de user {user_id} terminado: {len(uploaded)}/{total} subidos.")
+
 # --- CORREGIDO Y ROBUSTECIDO: Función para procesar la cola de subidas ---
 async def process_upload_queue(client: Client):
-    """Función asíncrona continua que procesa videos de la cola."""
+    """Función asíncrona continua que procesa los archivos de la cola."""
     global total_uploads_queued
     while True:
         task_id = None # Variable para rastrear task_id en el bloque finally
+        got_item = False # task_done() solo corresponde si get() devolvió un elemento
+        stage = 'setup' # Etapa actual, para etiquetar errores en las métricas
+        cancel_flag = None
+        task_started = None # Inicio del proceso de la tarea (span "task" de la traza)
+        trace_result = 'ok'
         try:
             queue_item = await upload_queue.get()
+            got_item = True
             task_id = queue_item['task_id'] # Guardar task_id inmediatamente
 
+            if draining:
+                # Apagado en curso: la tarea se queda en queued_tasks para guardarse en el checkpoint
+                logger.info(f"Drain en curso: la tarea {task_id} no se inicia y queda para el checkpoint.")
+                # El worker queda parado en vez de terminar: /healthz no debe verlo muerto a mitad del drain
+                await asyncio.Event().wait()
+
             # --- VERIFICACIÓN Y EXTRACCIÓN CORRECTA ---
             if task_id not in queued_tasks:
                 logger.info(f"Tarea {task_id} fue cancelada o eliminada mientras estaba en cola.")
@@ -303,12 +1940,23 @@ async def process_upload_queue(client: Client):
                  logger.warning(f"Tarea {task_id} desapareció de queued_tasks justo antes de procesarla.")
                  continue
 
+            metrics.observe("bot_stage_seconds", time.monotonic() - queue_item['enqueued_at'], stage="queue_wait")
+
             # Extraer información
             user_id = queue_item['user_id']
             message: Message = queue_item['message']
-            file_name = queue_item.get('file_name', 'video.mp4')
+            descriptor = describe_media(message)
+            file_name = queue_item.get('file_name') or descriptor['file_name']
+            label = descriptor['label']
 
-            logger.info(f"Iniciando procesamiento de video en cola para user {user_id}, tarea {task_id}")
+            # Todo lo que se haga desde aquí (y las tareas que se creen) lleva el task_id como trace ID
+            current_trace_id.set(task_id)
+            task_started = time.monotonic()
+            if tracer is not None:
+                tracer.name_lane(task_id, f"{file_name} · {task_id[:8]}") # En modo worker la pista es de este proceso
+                tracer.span("queue_wait", queue_item['enqueued_at'], task_started, task_id)
+
+            logger.info(f"Iniciando procesamiento de {label} en cola para user {user_id}, tarea {task_id}")
 
             # --- ACTUALIZAR POSICIONES Y MENSAJES DE LAS TAREAS RESTANTES EN COLA ---
             total_uploads_queued -= 1
@@ -330,12 +1978,15 @@ async def process_upload_queue(client: Client):
 
             # --- LÓGICA DE PROCESAMIENTO (DESCARGA Y SUBIDA) ---
             # Verificaciones iniciales
+            await ensure_google_modules()
             if not is_user_authenticated(user_id):
+                trace_result = 'not_authenticated'
                 await message.reply_text("❌ Tu cuenta de Google Drive ya no está conectada. Por favor, vuelve a autenticarte con /drive_login.")
                 # task_done() se llamará en el finally
                 continue
 
-            service = get_user_drive_service(user_id)
+            with trace_span("drive.build_service"):
+                service = get_user_drive_service(user_id)
             if not service:
                 await message.reply_text("❌ Problema de conexión con tu Drive. Intenta desconectarte y reconectarte.")
                 # task_done() se llamará en el finally
@@ -348,6 +1999,8 @@ async def process_upload_queue(client: Client):
             cancel_button = [[InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_{task_id}")]]
             reply_markup = InlineKeyboardMarkup(cancel_button)
             
+            batch_messages = queue_item.get('messages')
+            initial_text = f"📦 Lote de {len(batch_messages)} archivos: iniciando..." if batch_messages else f"📥 Descargando el {label}... 0%"
             status_message_id = None
             if queue_status_message_id:
                 # Si existe un mensaje de cola, lo editamos para mostrar "Descargando..."
@@ -355,7 +2008,7 @@ async def process_upload_queue(client: Client):
                     await client.edit_message_text(
                         chat_id=message.chat.id, 
                         message_id=queue_status_message_id, 
-                        text="📥 Descargando el video... 0%", 
+                        text=initial_text, 
                         reply_markup=reply_markup
                     )
                     status_message_id = queue_status_message_id # Reutilizamos el ID del mensaje de cola
@@ -364,7 +2017,7 @@ async def process_upload_queue(client: Client):
                     # Si falla la edición, crear un nuevo mensaje como respuesta al video (explícito)
                     status_message = await client.send_message(
                         chat_id=message.chat.id,
-                        text="📥 Descargando el video... 0%",
+                        text=initial_text,
                         reply_markup=reply_markup,
                         reply_to_message_id=message.id # <-- EXPLÍCITO
                     )
@@ -373,7 +2026,7 @@ async def process_upload_queue(client: Client):
                 # Si no hay mensaje de cola (primer video), crear un nuevo mensaje como respuesta al video (explícito)
                 status_message = await client.send_message(
                     chat_id=message.chat.id,
-                    text="📥 Descargando el video... 0%",
+                    text=initial_text,
                     reply_markup=reply_markup,
                     reply_to_message_id=message.id # <-- EXPLÍCITO
                 )
@@ -386,8 +2039,18 @@ async def process_upload_queue(client: Client):
                 'status_message_id': status_message_id,
                 'cancel_flag': cancel_flag,
                 'user_id': user_id,
-                'message': message
+                'message': message,
+                'file_name': file_name,
+                'messages': list(batch_messages) if batch_messages else None, # Videos del lote aún sin procesar
+                'started_at': time.monotonic()
             }
+            current_operation = active_operations[task_id]
+
+            if batch_messages:
+                stage = 'batch'
+                await process_batch(client, queue_item, task_id, status_message_id, service, cancel_flag)
+                metrics.observe("bot_stage_seconds", time.monotonic() - queue_item['enqueued_at'], stage="total")
+                continue
 
             last_update = time.time()
             main_loop = asyncio.get_running_loop()
@@ -398,6 +2061,7 @@ async def process_upload_queue(client: Client):
                 current_time = time.time()
                 if cancel_flag.is_set():
                     raise Exception("Operación cancelada por el usuario.")
+                track_progress(current_operation, 'download', current, total)
                 if current_time - last_update > 2 or current == total:
                     if total > 0:
                         progress = int((current / total) * 100)
@@ -410,18 +2074,28 @@ async def process_upload_queue(client: Client):
                         if current_milestone > last_shown_progress:
                             main_loop.call_soon_threadsafe(
                                 asyncio.create_task,
-                                update_status_message(client, message.chat.id, status_message_id, f"📥 Descargando el video... {current_milestone}%", user_id)
+                                update_status_message(client, message.chat.id, status_message_id, f"📥 Descargando el {label}... {current_milestone}%", user_id, task_id=task_id)
                             )
                             last_shown_progress = current_milestone
                     last_update = current_time
 
-            file_path = await client.download_media(message, progress=progress_callback)
+            stage = 'download'
+            start_stage(current_operation, 'download', descriptor['media'].file_size or 0)
+            download_start = time.perf_counter()
+            with trace_span("download", bytes=descriptor['media'].file_size or 0):
+                file_path = await run_cancellable(cancel_flag, download_pool.download(client, message, descriptor['media'], file_name, progress_callback, cancel_flag))
             # Si se cancela durante la descarga, se lanza una excepción y se maneja en el except general
+            download_elapsed = time.perf_counter() - download_start
+            file_size = os.path.getsize(file_path)
+            metrics.observe("bot_stage_seconds", download_elapsed, stage="download")
+            metrics.inc("bot_transfer_bytes_total", file_size, direction="download")
+            if download_elapsed > 0:
+                metrics.observe("bot_transfer_bytes_per_second", file_size / download_elapsed, direction="download")
             
-            await update_status_message(client, message.chat.id, status_message_id, "📥 Descargando el video... 100%", user_id)
+            await update_status_message(client, message.chat.id, status_message_id, f"📥 Descargando el {label}... 100%", user_id, task_id=task_id)
             await asyncio.sleep(0.5)
             active_operations[task_id]['file_path'] = file_path
-            await update_status_message(client, message.chat.id, status_message_id, "☁️ Subiendo a tu Google Drive... 0%", user_id)
+            await update_status_message(client, message.chat.id, status_message_id, "☁️ Subiendo a tu Google Drive... 0%", user_id, task_id=task_id)
             
             last_shown_progress_upload = 0
             main_loop_upload = asyncio.get_running_loop()
@@ -430,6 +2104,7 @@ async def process_upload_queue(client: Client):
                 nonlocal last_shown_progress_upload
                 if cancel_flag.is_set():
                     raise Exception("Operación cancelada por el usuario.")
+                track_progress(current_operation, 'upload', int(file_size * progress / 100), file_size)
                 milestones = [0, 25, 50, 75, 100]
                 current_milestone = 0
                 for m in reversed(milestones):
@@ -439,25 +2114,38 @@ async def process_upload_queue(client: Client):
                 if current_milestone > last_shown_progress_upload:
                     main_loop_upload.call_soon_threadsafe(
                         asyncio.create_task,
-                        update_status_message(client, message.chat.id, status_message_id, f"☁️ Subiendo a tu Google Drive... {current_milestone}%", user_id)
+                        update_status_message(client, message.chat.id, status_message_id, f"☁️ Subiendo a tu Google Drive... {current_milestone}%", user_id, task_id=task_id)
                     )
                     last_shown_progress_upload = current_milestone
 
-            final_file_name = f"video_{message.video.file_unique_id}_{file_name}"
-            file_id = await upload_to_drive_with_progress(user_id, file_path, final_file_name, update_upload_progress, cancel_flag)
+            final_file_name = descriptor['drive_name']
+            stage = 'upload'
+            start_stage(current_operation, 'upload', file_size)
+            upload_start = time.perf_counter()
+            with trace_span("upload", bytes=file_size):
+                file_id = await upload_to_drive_with_progress(user_id, file_path, final_file_name, update_upload_progress, cancel_flag,
+                                                             service=service, mime_type=descriptor['mime_type'])
             # Si se cancela durante la subida, se lanza una excepción y se maneja en el except general
+            upload_elapsed = time.perf_counter() - upload_start
+            metrics.observe("bot_stage_seconds", upload_elapsed, stage="upload")
+            if file_id:
+                metrics.inc("bot_transfer_bytes_total", file_size, direction="upload")
+                if upload_elapsed > 0:
+                    metrics.observe("bot_transfer_bytes_per_second", file_size / upload_elapsed, direction="upload")
 
             # --- RESULTADO FINAL ---
             if file_id:
                 file_url = get_file_url(file_id)
                 await update_status_message(client, message.chat.id, status_message_id,
-                    f"✅ ¡Video subido exitosamente a tu Google Drive!\n\n"
-                    f"🔗 [Descargar Video]({file_url})\n\n"
-                    f"Usa /ver_nube para ver y gestionar tus videos.",
+                    f"✅ ¡{capitalize_label(label)} subido exitosamente a tu Google Drive!\n\n"
+                    f"🔗 [Descargar {capitalize_label(label)}]({file_url})\n\n"
+                    f"Usa /ver_nube para ver y gestionar tus archivos.",
                     user_id, remove_buttons=True
                 )
             else:
-                await update_status_message(client, message.chat.id, status_message_id, "❌ Error al subir el video a tu Google Drive.", user_id, remove_buttons=True)
+                await update_status_message(client, message.chat.id, status_message_id, f"❌ Error al subir el {label} a tu Google Drive.", user_id, remove_buttons=True)
+            metrics.inc("bot_tasks_total", result="ok" if file_id else "error")
+            metrics.observe("bot_stage_seconds", time.monotonic() - queue_item['enqueued_at'], stage="total")
             
             # Limpiar archivo temporal
             if os.path.exists(file_path):
@@ -468,6 +2156,18 @@ async def process_upload_queue(client: Client):
             raise # Re-lanzar para que el manejador de cancelación lo capture correctamente si es necesario
         except Exception as e:
             # Manejo general de errores para cualquier excepción no capturada durante el procesamiento
+            interrupted_by_drain = bool(task_id and active_operations.get(task_id, {}).get('requeue_on_shutdown'))
+            cancelled_by_user = not interrupted_by_drain and cancel_flag is not None and cancel_flag.is_set()
+            trace_result = 'requeued' if interrupted_by_drain else 'cancelled' if cancelled_by_user else 'error'
+            if interrupted_by_drain:
+                metrics.inc("bot_tasks_total", result="requeued")
+            elif cancelled_by_user:
+                metrics.inc("bot_tasks_total", result="cancelled")
+            else:
+                metrics.inc("bot_tasks_total", result="error")
+                metrics.inc("bot_errors_total", stage=stage)
+                failed_operation = active_operations.get(task_id, {}) if task_id else {}
+                record_failure(task_id, failed_operation.get('user_id'), failed_operation.get('file_name'), stage, e)
             logger.error(f"Error en process_upload_queue para tarea {task_id}: {e}", exc_info=True)
             # Intentar notificar al usuario si es posible
             if task_id and task_id in active_operations:
@@ -476,7 +2176,16 @@ async def process_upload_queue(client: Client):
                 chat_id_op = active_operations[task_id].get('message').chat.id if active_operations[task_id].get('message') else user_id_op
                 if status_msg_id and user_id_op:
                     try:
-                        await update_status_message(client, chat_id_op, status_msg_id, f"❌ Ocurrió un error: {str(e)}", user_id_op, remove_buttons=True)
+                        if interrupted_by_drain:
+                            await update_status_message(client, chat_id_op, status_msg_id, "🔄 El bot se está reiniciando. Tu subida se reanudará automáticamente.", user_id_op, remove_buttons=True)
+                        elif cancelled_by_user:
+                            cancelled_edit = update_status_message(client, chat_id_op, status_msg_id, "❌ Operación cancelada.", user_id_op, remove_buttons=True)
+                            if job_store is not None:
+                                await cancelled_edit # Modo worker: es una escritura en la cola compartida y debe llegar antes de cerrar el trabajo
+                            else:
+                                asyncio.create_task(cancelled_edit) # En segundo plano: el worker queda libre sin esperar a Telegram
+                        else:
+                            await update_status_message(client, chat_id_op, status_msg_id, f"❌ Ocurrió un error: {str(e)}", user_id_op, remove_buttons=True)
                     except Exception as notify_e:
                         logger.error(f"Error notificando error al usuario {user_id_op}: {notify_e}")
             
@@ -491,20 +2200,642 @@ async def process_upload_queue(client: Client):
             # --- BLOQUE FINALLY CRÍTICO: Asegurar task_done y limpieza ---
             # Este bloque se ejecuta SIEMPRE después de un upload_queue.get(), haya error o no.
             if task_id:
-                # Limpiar operaciones activas
-                active_operations.pop(task_id, None)
-                
+                # Limpiar operaciones activas (las interrumpidas por el drain pasan al checkpoint)
+                operation = active_operations.pop(task_id, None)
+                if operation and operation.get('cancel_requested_at'):
+                    metrics.observe("bot_cancel_seconds", time.monotonic() - operation['cancel_requested_at'])
+                # Solo las tareas que llegaron al final cuentan para estimar el tiempo por archivo
+                finished_normally = operation is not None and not operation['cancel_flag'].is_set() and not operation.get('requeue_on_shutdown')
+                release_quota(task_id, time.monotonic() - operation['started_at'] if finished_normally else None)
+                if tracer is not None and task_started is not None:
+                    tracer.span("task", task_started, time.monotonic(), task_id, result=trace_result, user_id=queue_item['user_id'])
+                if operation and operation.get('requeue_on_shutdown'):
+                    # De un lote solo se guardan los videos que faltaban por subir
+                    for pending_message in operation.get('messages') or [operation['message']]:
+                        interrupted_tasks.append(_checkpoint_entry(task_id, operation['user_id'], pending_message.chat.id,
+                                                                   pending_message.id, operation.get('file_name')))
+            current_trace_id.set(None)
+
             # LLAMAR task_done() EXACTAMENTE UNA VEZ por cada upload_queue.get()
+            # (un `continue` aquí se tragaría el CancelledError, por eso se usa un if)
+            if got_item:
+                try:
+                    upload_queue.task_done()
+                    logger.debug(f"task_done() llamado para tarea {task_id}")
+                except ValueError as ve:
+                    # Capturar específicamente el error de task_done() ya llamado
+                    logger.error(f"Error al llamar task_done() para tarea {task_id}: {ve}")
+                except Exception as e:
+                    # Capturar cualquier otro error inesperado en task_done()
+                    logger.error(f"Error inesperado al llamar task_done() para tarea {task_id}: {e}")
+
+
+# --- Modos front/worker: cola compartida entre procesos ---
+class JobReportingClient:
+    """
+    Cliente que recibe process_upload_queue en modo worker: descarga con la sesión propia del
+    worker, pero las ediciones del mensaje de estado quedan en la cola compartida y las publica
+    el proceso front, así todas las ediciones del bot comparten un solo límite de FLOOD_WAIT.
+    """
+    def __init__(self, client: Client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None, **kwargs):
+        await asyncio.to_thread(job_store.report_status, chat_id, message_id, text, reply_markup is not None)
+
+async def enqueue_shared_job(messages: list, task_id: str, file_name: str):
+    """Modo front: responde con la posición y deja el trabajo (video o lote) en la cola compartida para los workers."""
+    message = messages[0]
+    user_id = message.from_user.id
+    position = await asyncio.to_thread(job_store.count, 'queued') + 1
+    # Los workers editan siempre este mensaje, aunque el video no tenga que esperar
+    if len(messages) > 1:
+        queue_text = f"📦 Recibidos {len(messages)} archivos: se subirán juntos. Posición en la cola: {position}."
+    else:
+        queue_text = f"⏳ Su archivo está en cola. Posición: {position}."
+    queue_status_message = await message.reply_text(queue_text, reply_to_message_id=message.id)
+    batch_message_ids = [m.id for m in messages] if len(messages) > 1 else None
+    total_bytes = sum(describe_media(m)['media'].file_size or 0 for m in messages)
+    await asyncio.to_thread(job_store.enqueue, task_id, user_id, message.chat.id, message.id, file_name,
+                            queue_status_message.id, position, batch_message_ids, total_bytes)
+    metrics.inc("bot_enqueued_total", len(messages))
+    logger.info(f"{len(messages)} archivo(s) de user {user_id} agregados a la cola compartida. Tarea ID: {task_id}. Posición: {position}.")
+
+def restore_shared_admissions(jobs):
+    """
+    Modo front: admitted_tasks vive en memoria, así que tras reiniciar el front se vuelve a
+    reservar la cuota de los trabajos que siguen en la cola compartida (sin aplicar límites).
+    """
+    restored = 0
+    for task_id, user_id, files, size in jobs:
+        if task_id not in admitted_tasks:
+            admit_upload(user_id, task_id, files, size, enforce=False)
+            restored += files
+    return restored
+
+async def relay_shared_jobs(client: Client):
+    """
+    Modo front: publica en Telegram el progreso que reportan los workers, mantiene al día la
+    posición mostrada a los trabajos en cola y purga los trabajos ya terminados.
+    """
+    restored = restore_shared_admissions(await asyncio.to_thread(job_store.unfinished_jobs))
+    if restored:
+        logger.info(f"🚦 {restored} archivos pendientes en la cola compartida vuelven a contar para las cuotas.")
+    last_housekeeping = 0.0
+    while True:
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+        try:
+            for task_id, user_id, chat_id, message_id, text, buttons, version in await asyncio.to_thread(job_store.pending_status_updates):
+                await update_status_message(client, chat_id, message_id, text, user_id, remove_buttons=not buttons, task_id=task_id)
+                await asyncio.to_thread(job_store.mark_relayed, task_id, version)
+
+            if time.monotonic() - last_housekeeping < 5:
+                continue
+            last_housekeeping = time.monotonic()
+            for index, (task_id, user_id, chat_id, message_id, shown_position) in enumerate(await asyncio.to_thread(job_store.queued_jobs)):
+                if index + 1 != shown_position:
+                    await update_queue_status_message(client, user_id, chat_id, message_id, index + 1)
+                    await asyncio.to_thread(job_store.set_position, task_id, index + 1)
+            abandoned = await asyncio.to_thread(job_store.finish_abandoned_cancels)
+            if abandoned:
+                logger.warning(f"🧹 {abandoned} trabajos cancelados de workers caídos dados por terminados.")
+            for task_id in await asyncio.to_thread(job_store.purge_finished):
+                release_quota(task_id) # La cuota del front se libera cuando el trabajo ya terminó en un worker
+        except Exception as e:
+            metrics.inc("bot_errors_total", stage="job_relay")
+            logger.error(f"Error publicando el progreso de los workers: {e}", exc_info=True)
+
+async def feed_shared_jobs(client: Client):
+    """
+    Modo worker: reclama trabajos de la cola compartida y los pasa de uno en uno al
+    process_upload_queue local. Al terminar el trabajo se marca como hecho, o vuelve a la
+    cola si un apagado lo interrumpió.
+    """
+    global total_uploads_queued
+    while not draining:
+        job = await asyncio.to_thread(job_store.claim, WORKER_ID)
+        if not job:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        task_id = job['task_id']
+        try:
+            await asyncio.to_thread(load_shared_credentials, job['user_id'])
+            message_ids = job['batch_message_ids'] or [job['message_id']]
+            messages = await client.get_messages(job['chat_id'], message_ids) # Una sola llamada para todo el lote
+        except Exception as e:
+            logger.error(f"Worker {WORKER_ID}: no se pudo preparar la tarea {task_id}: {e}")
+            await asyncio.to_thread(job_store.release, task_id)
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        messages = [m for m in messages if m and not getattr(m, 'empty', False) and describe_media(m)]
+        message = messages[0] if messages else None
+        if not message:
+            await asyncio.to_thread(job_store.report_status, job['chat_id'], job['status_message_id'], "❌ El archivo ya no está disponible.", False)
+            await asyncio.to_thread(job_store.finish, task_id)
+            continue
+
+        logger.info(f"Worker {WORKER_ID}: tarea {task_id} reclamada.")
+        total_uploads_queued += 1
+        queued_tasks[task_id] = {
+            'user_id': job['user_id'],
+            'message_id': job['message_id'],
+            'file_name': job['file_name'],
+            'position': 0,
+            'queue_status_message_id': job['status_message_id'],
+            'chat_id': job['chat_id']
+        }
+        queue_item = {
+            'task_id': task_id,
+            'user_id': job['user_id'],
+            'message': message,
+            'file_name': job['file_name'],
+            # La espera en la cola compartida cuenta como queue_wait
+            'enqueued_at': time.monotonic() - max(0.0, time.time() - job['enqueued_at'])
+        }
+        if job['batch_message_ids']:
+            queue_item['messages'] = messages
+        await upload_queue.put(queue_item)
+        await upload_queue.join()
+        if any(entry['task_id'] == task_id for entry in interrupted_tasks):
+            await asyncio.to_thread(job_store.release, task_id)
+        else:
+            await asyncio.to_thread(job_store.finish, task_id)
+
+async def renew_job_leases():
+    """Modo worker: renueva el lease de las transferencias en curso y aplica las cancelaciones pedidas desde el front."""
+    while True:
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+        for task_id, operation in list(active_operations.items()): # Copia: se espera entre iteraciones
             try:
-                upload_queue.task_done()
-                logger.debug(f"task_done() llamado para tarea {task_id}")
-            except ValueError as ve:
-                # Capturar específicamente el error de task_done() ya llamado
-                logger.error(f"Error al llamar task_done() para tarea {task_id}: {ve}")
+                cancel_requested = await asyncio.to_thread(job_store.renew, task_id, WORKER_ID)
             except Exception as e:
-                # Capturar cualquier otro error inesperado en task_done()
-                logger.error(f"Error inesperado al llamar task_done() para tarea {task_id}: {e}")
+                logger.warning(f"No se pudo renovar el lease de {task_id}: {e}")
+                continue
+            if cancel_requested and not operation['cancel_flag'].is_set():
+                logger.info(f"Worker {WORKER_ID}: cancelación recibida para la tarea {task_id}.")
+                operation['cancel_requested_at'] = time.monotonic()
+                operation['cancel_flag'].set()
+
+# --- Barrido periódico del estado en memoria ---
+async def sweep_expiring_maps():
+    """Purga periódicamente las entradas expiradas, aunque no haya tráfico que las toque."""
+    while True:
+        await asyncio.sleep(STATE_SWEEP_INTERVAL)
+        for name, expiring_map in (('login_states', login_states), ('pending_emails', pending_emails),
+                                   ('user_info', user_info), ('dashboard_links', dashboard_links),
+                                   ('dashboard_sessions', dashboard_sessions)):
+            removed = expiring_map.sweep()
+            if removed:
+                metrics.inc("bot_state_evictions_total", removed, map=name)
+                logger.info(f"🧹 {removed} entradas expiradas eliminadas de {name}.")
+        sweep_quota_usage()
+
+# --- Watchdog del event loop ---
+async def monitor_event_loop():
+    """
+    Mide continuamente el retraso de planificación del event loop.
+    Un hilo vigilante registra el stack del hilo del loop si este deja de responder
+    durante más de LOOP_LAG_THRESHOLD, para ver qué llamada bloqueante lo detuvo.
+    """
+    global loop_heartbeat, loop_lag_seconds, loop_max_lag_seconds
+    loop_thread_id = threading.get_ident()
+    threading.Thread(target=_loop_stall_watchdog, args=(loop_thread_id,), name="loop-watchdog", daemon=True).start()
+    logger.info(f"Monitor del event loop iniciado (intervalo {LOOP_LAG_INTERVAL}s, umbral {LOOP_LAG_THRESHOLD}s).")
+    while True:
+        start = time.monotonic()
+        loop_heartbeat = start
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL)
+        loop_lag_seconds = lag
+        loop_max_lag_seconds = max(loop_max_lag_seconds, lag)
+        metrics.observe("bot_stage_seconds", lag, stage="loop_lag")
+        if lag > LOOP_LAG_THRESHOLD:
+            logger.warning(f"⚠️ El event loop estuvo bloqueado {lag:.3f}s.")
+
+def _loop_stall_watchdog(loop_thread_id):
+    """Hilo daemon: registra el stack del hilo del loop una vez por cada bloqueo."""
+    reported_heartbeat = None
+    while True:
+        time.sleep(LOOP_LAG_THRESHOLD / 2)
+        heartbeat = loop_heartbeat
+        stalled_for = time.monotonic() - heartbeat - LOOP_LAG_INTERVAL
+        if stalled_for > LOOP_LAG_THRESHOLD and heartbeat != reported_heartbeat:
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(stack no disponible)"
+            logger.warning(f"⚠️ Event loop bloqueado durante {stalled_for:.3f}s. Stack del hilo del loop:\n{stack}")
+
+def get_health_status():
+    """Estado usado por /healthz y /readyz."""
+    worker_alive = queue_processor_task is not None and not queue_processor_task.done()
+    telegram_connected = bool(getattr(app_telegram, 'is_connected', False))
+    stalled_for = max(0.0, time.monotonic() - loop_heartbeat - LOOP_LAG_INTERVAL)
+    return {
+        'loop_lag_seconds': round(max(loop_lag_seconds, stalled_for), 4),
+        'loop_max_lag_seconds': round(loop_max_lag_seconds, 4),
+        'worker_alive': worker_alive,
+        'telegram_connected': telegram_connected,
+        'queue_depth': len(queued_tasks),
+        'active_operations': len(active_operations),
+        'startup': startup_timings,
+        'draining': draining,
+        'worker_mode': WORKER_MODE,
+        'startup_error': startup_error,
+    }
 
+# --- Panel de administración en vivo (SSE) y /stats ---
+class DashboardHub:
+    """
+    Reparte el estado del panel a los navegadores conectados. El snapshot se serializa una sola
+    vez por publicación y cada suscriptor tiene una cola de un elemento: si un cliente lento no
+    leyó el anterior, se reemplaza. Publicar nunca espera a nadie, así que cientos de paneles
+    abiertos no frenan el loop ni las transferencias.
+    """
+    def __init__(self):
+        self.subscribers = set()
+        self.latest = None # Último snapshot publicado (JSON)
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=1)
+        if self.latest is not None:
+            queue.put_nowait(self.latest)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+        if not self.subscribers:
+            self.latest = None # Sin paneles no se publica: el próximo empezará con un snapshot nuevo
+
+    def publish(self, payload):
+        self.latest = payload
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+                metrics.inc("bot_dashboard_dropped_total")
+            queue.put_nowait(payload)
+
+dashboard_hub = DashboardHub()
+metrics.gauge("bot_dashboard_watchers", lambda: len(dashboard_hub.subscribers))
+
+async def build_dashboard_snapshot():
+    """Cola, transferencias activas (bytes, velocidad, ETA), uso de workers y errores recientes."""
+    now = time.monotonic()
+    active = []
+    for task_id, operation in active_operations.items():
+        done = operation.get('bytes_done', 0)
+        total = operation.get('bytes_total', 0)
+        elapsed = now - operation.get('stage_started', now)
+        rate = done / elapsed if elapsed > 0 else 0.0 # Media desde que empezó la etapa actual
+        active.append({
+            'task_id': task_id,
+            'user_id': operation.get('user_id'),
+            'file_name': operation.get('file_name'),
+            'stage': operation.get('stage', 'setup'),
+            'bytes_done': done,
+            'bytes_total': total,
+            'rate_bytes_per_second': round(rate),
+            'eta_seconds': round((total - done) / rate, 1) if rate > 0 and total else None,
+            'batch_pending': len(operation['messages']) if operation.get('messages') else None,
+        })
+    sessions = []
+    for name, _ in download_pool._sessions(None):
+        state = download_pool._state(name)
+        sessions.append({'name': name, 'active': state['active'], 'cooling_down': state['cooldown_until'] > now})
+    snapshot = {
+        'time': time.time(),
+        'worker_mode': WORKER_MODE,
+        'draining': draining,
+        'queue': {'queued': len(queued_tasks), 'pending_batches': len(pending_batches)},
+        'admission': {'admitted_files': admitted_total, 'high_water': quota_limits['cola'], 'seconds_per_file': round(seconds_per_file, 1)},
+        'active': active,
+        'workers': {
+            'busy': len(active_operations),
+            'utilization_60s': round(sum(worker_busy_samples) / len(worker_busy_samples), 3) if worker_busy_samples else 0.0,
+            'download_sessions': sessions,
+        },
+        'recent_failures': list(recent_failures),
+    }
+    if WORKER_MODE == "front":
+        # Las transferencias ocurren en los workers: el front solo ve la cola compartida
+        queued, running = await asyncio.gather(asyncio.to_thread(job_store.count, 'queued'), asyncio.to_thread(job_store.running_jobs))
+        snapshot['queue']['queued'] = queued
+        snapshot['active'] = [{'task_id': task_id, 'user_id': user_id, 'file_name': file_name, 'worker_id': worker_id,
+                               'stage': (status_text or 'running').split('\n', 1)[0]}
+                              for task_id, user_id, file_name, worker_id, status_text in running]
+        by_worker = {}
+        for job in running:
+            by_worker[job[3]] = by_worker.get(job[3], 0) + 1
+        snapshot['workers'] = {'busy': len(running), 'by_worker': by_worker}
+    return snapshot
+
+async def publish_dashboard():
+    """Muestrea el uso del worker y, si hay paneles abiertos, les publica el estado cada DASHBOARD_INTERVAL."""
+    while True:
+        await asyncio.sleep(DASHBOARD_INTERVAL)
+        worker_busy_samples.append(1 if active_operations else 0)
+        if not dashboard_hub.subscribers:
+            continue
+        try:
+            dashboard_hub.publish(json.dumps(await build_dashboard_snapshot()))
+        except Exception as e:
+            logger.warning(f"Error publicando el estado del panel: {e}")
+
+def _format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return f"{n:.1f} {unit}" if unit != 'B' else f"{int(n)} B"
+        n /= 1024
+
+def format_stats_text(snapshot):
+    """Resumen del snapshot del panel para el comando /stats."""
+    lines = [f"📊 Estado del bot ({snapshot['worker_mode']}{', drain' if snapshot['draining'] else ''})", ""]
+    lines.append(f"⏳ En cola: {snapshot['queue']['queued']} · lotes abiertos: {snapshot['queue']['pending_batches']}")
+    admission = snapshot['admission']
+    lines.append(f"🚦 Archivos admitidos: {admission['admitted_files']} (límite: {admission['high_water'] or 'sin límite'})")
+    lines.append(f"⚙️ Activas: {len(snapshot['active'])}")
+    for item in snapshot['active'][:10]:
+        line = f"  • {item.get('file_name') or '?'} (user {item.get('user_id')}): {item.get('stage')}"
+        if item.get('bytes_total'):
+            line += f" {int(item['bytes_done'] / item['bytes_total'] * 100)}%"
+        if item.get('rate_bytes_per_second'):
+            line += f" · {_format_bytes(item['rate_bytes_per_second'])}/s"
+        if item.get('eta_seconds') is not None:
+            line += f" · ETA {int(item['eta_seconds'])}s"
+        if item.get('worker_id'):
+            line += f" · {item['worker_id']}"
+        lines.append(line)
+    workers = snapshot['workers']
+    if 'utilization_60s' in workers:
+        lines.append(f"👷 Uso del worker (60s): {int(workers['utilization_60s'] * 100)}%")
+        sessions = ", ".join(f"{s['name']} {s['active']}{' (en pausa)' if s['cooling_down'] else ''}" for s in workers['download_sessions'])
+        lines.append(f"📥 Sesiones de descarga: {sessions}")
+    else:
+        lines.append(f"👷 Workers ocupados: {', '.join(f'{w} {n}' for w, n in workers['by_worker'].items()) or 'ninguno'}")
+    failures = snapshot['recent_failures']
+    lines += ["", f"❌ Errores recientes: {len(failures)}"]
+    for failure in failures[-5:]:
+        lines.append(f"  • {time.strftime('%H:%M:%S', time.localtime(failure['time']))} {failure.get('file_name') or '?'}"
+                     f" ({failure['stage']}): {failure['error'][:80]}")
+    return "\n".join(lines)
+
+# --- Perfilador por muestreo bajo demanda (admin) ---
+class StackSampler:
+    """
+    Toma muestras de la pila de todos los hilos cada PROFILE_INTERVAL desde un hilo propio y,
+    cada TASK_SAMPLE_EVERY muestras, la cadena de awaits de todas las tareas de asyncio (esa
+    parte se ejecuta en el loop, que es el único sitio seguro para recorrerlas; pesa lo mismo
+    que las muestras que se salta). El resultado es el formato "collapsed" de flamegraph.pl,
+    speedscope o Perfetto: una línea "raíz;...;hoja cuenta" por pila distinta.
+    """
+    TASK_SAMPLE_EVERY = 10
+
+    def __init__(self, loop, interval):
+        self.loop = loop
+        self.interval = interval
+        self.counts = {} # {pila colapsada: muestras}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._task_sample_pending = False
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+
+    def _add(self, stack, weight=1):
+        key = ";".join(stack)
+        self.counts[key] = self.counts.get(key, 0) + weight
+
+    def _sample_threads(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self._thread.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_label(frame))
+                frame = frame.f_back
+            stack.append(f"hilo {names.get(ident, ident)}".replace(';', ':'))
+            self._add(reversed(stack))
+
+    def _sample_tasks(self):
+        self._task_sample_pending = False
+        for task in asyncio.all_tasks(self.loop):
+            stack = ["tareas asyncio"]
+            awaitable = task.get_coro()
+            while awaitable is not None:
+                frame = getattr(awaitable, 'cr_frame', None) or getattr(awaitable, 'ag_frame', None) or getattr(awaitable, 'gi_frame', None)
+                if frame is None:
+                    break
+                stack.append(self._frame_label(frame))
+                awaitable = getattr(awaitable, 'cr_await', None) or getattr(awaitable, 'ag_await', None) or getattr(awaitable, 'gi_yieldfrom', None)
+            self._add(stack, self.TASK_SAMPLE_EVERY)
+
+    def _schedule_task_sample(self):
+        # Una sola petición pendiente: si el loop está bloqueado no se acumulan callbacks
+        if self._task_sample_pending or self.loop.is_closed():
+            return
+        self._task_sample_pending = True
+        self.loop.call_soon_threadsafe(self._sample_tasks)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample_threads()
+            self.samples += 1
+            if self.samples % self.TASK_SAMPLE_EVERY == 0:
+                self._schedule_task_sample()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]))
+
+profile_lock = asyncio.Lock() # Un solo perfil a la vez
+
+async def run_sampling_profile(seconds):
+    """Perfila el proceso durante `seconds` y devuelve las pilas colapsadas (texto)."""
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    async with profile_lock:
+        sampler = StackSampler(asyncio.get_running_loop(), PROFILE_INTERVAL)
+        logger.info(f"🔥 Perfil por muestreo iniciado ({seconds:.0f}s, cada {PROFILE_INTERVAL * 1000:.0f}ms).")
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.to_thread(sampler.stop)
+        logger.info(f"🔥 Perfil terminado: {sampler.samples} muestras, {len(sampler.counts)} pilas distintas.")
+        return sampler.collapsed()
+
+# --- Apagado controlado (drain) y checkpoint de la cola ---
+def _checkpoint_entry(task_id, user_id, chat_id, message_id, file_name, queue_status_message_id=None):
+    return {
+        'task_id': task_id,
+        'user_id': user_id,
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'file_name': file_name,
+        'queue_status_message_id': queue_status_message_id,
+    }
+
+def save_checkpoint():
+    """Guarda las tareas pendientes (interrumpidas primero, luego la cola en orden) y las credenciales."""
+    tasks = list(interrupted_tasks)
+    for task_id, info in sorted(queued_tasks.items(), key=lambda item: item[1].get('position', 0)):
+        for message_id in info.get('message_ids') or [info['message_id']]:
+            tasks.append(_checkpoint_entry(task_id, info['user_id'], info.get('chat_id', info['user_id']), message_id,
+                                           info.get('file_name'), info.get('queue_status_message_id')))
+    data = {
+        'version': 1,
+        'saved_at': time.time(),
+        'tasks': tasks,
+        'credentials': {str(uid): creds.to_json() for uid, creds in user_credentials.items()},
+        'approved_users': sorted(approved_users),
+        'quota_limits': quota_limits,
+        'quota_overrides': {str(uid): override for uid, override in quota_overrides.items()},
+    }
+    # Escritura atómica y solo legible por el propietario: contiene refresh tokens
+    tmp_path = CHECKPOINT_PATH + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, CHECKPOINT_PATH)
+    return len(tasks)
+
+async def restore_checkpoint(client: Client):
+    """Recupera credenciales y vuelve a encolar las tareas guardadas por el último drain."""
+    if not os.path.exists(CHECKPOINT_PATH):
+        return
+    try:
+        with open(CHECKPOINT_PATH) as f:
+            data = json.load(f)
+    except Exception as e:
+        logger.error(f"No se pudo leer el checkpoint {CHECKPOINT_PATH}: {e}")
+        return
+
+    await ensure_google_modules()
+    from google.oauth2.credentials import Credentials
+    for uid, creds_json in data.get('credentials', {}).items():
+        try:
+            if int(uid) not in user_credentials:
+                remember_credentials(int(uid), Credentials.from_authorized_user_info(json.loads(creds_json), SCOPES))
+        except Exception as e:
+            logger.warning(f"No se pudieron restaurar las credenciales de {uid}: {e}")
+    approved_users.update(data.get('approved_users', []))
+    quota_limits.update(data.get('quota_limits', {}))
+    quota_overrides.update({int(uid): override for uid, override in data.get('quota_overrides', {}).items()})
+
+    # Los archivos de un mismo lote comparten task_id y se vuelven a encolar juntos
+    grouped = OrderedDict()
+    for entry in data.get('tasks', []):
+        grouped.setdefault(entry['task_id'], []).append(entry)
+    restored = 0
+    for task_id, entries in grouped.items():
+        try:
+            messages = []
+            for entry in entries:
+                message = await client.get_messages(entry['chat_id'], entry['message_id'])
+                if not message or getattr(message, 'empty', False) or not describe_media(message):
+                    logger.warning(f"El mensaje {entry['message_id']} de la tarea {task_id} ya no existe; se descarta.")
+                    continue
+                messages.append(message)
+            if not messages:
+                continue
+            if not is_user_authenticated(messages[0].from_user.id):
+                logger.warning(f"El usuario de la tarea {task_id} ya no tiene Drive conectado; se descarta.")
+                continue
+            # Ya se aceptaron antes del reinicio: reservan cuota pero no se vuelven a rechazar
+            await enqueue_media(client, messages, enforce_quota=False)
+            restored += len(messages)
+        except Exception as e:
+            logger.error(f"Error restaurando la tarea {task_id}: {e}")
+    os.remove(CHECKPOINT_PATH)
+    logger.info(f"♻️ Checkpoint restaurado: {restored}/{len(data.get('tasks', []))} tareas vueltas a encolar.")
+
+def cleanup_temp_files():
+    """Borra los archivos temporales de descarga que hayan quedado en DOWNLOAD_DIR."""
+    if not os.path.isdir(DOWNLOAD_DIR):
+        return 0
+    removed = 0
+    for entry in os.scandir(DOWNLOAD_DIR):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+            removed += 1
+        except OSError as e:
+            logger.warning(f"No se pudo borrar el temporal {entry.path}: {e}")
+    return removed
+
+async def drain_and_shutdown(client: Client):
+    """
+    Apagado controlado (SIGTERM): no se inician transferencias nuevas, las activas tienen
+    DRAIN_TIMEOUT para terminar, lo demás se guarda en el checkpoint y se borran los temporales.
+    """
+    global draining
+    if draining:
+        return
+    draining = True
+    await flush_pending_batches(client)
+    logger.info(f"🛑 Señal de apagado recibida: modo drain ({len(active_operations)} transferencias activas, "
+                f"{len(queued_tasks)} en cola, límite {DRAIN_TIMEOUT}s).")
+
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while active_operations and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+
+    # Interrumpir lo que no terminó a tiempo: se reanudará desde el checkpoint
+    for operation in active_operations.values():
+        operation['requeue_on_shutdown'] = True
+        operation['cancel_flag'].set()
+    grace_deadline = time.monotonic() + 5
+    while active_operations and time.monotonic() < grace_deadline:
+        await asyncio.sleep(0.2)
+
+    if queue_processor_task is not None and not queue_processor_task.done():
+        queue_processor_task.cancel()
+        try:
+            await queue_processor_task
+        except (asyncio.CancelledError, Exception):
+            pass
+
+    # Detener Telegram antes de guardar: así ningún video nuevo llega después del checkpoint
+    for session in [client] + list(download_pool.extra_clients.values()):
+        try:
+            if getattr(session, 'is_connected', False):
+                await session.stop()
+        except Exception as e:
+            logger.warning(f"Error deteniendo el cliente de Telegram: {e}")
+
+    if WORKER_MODE == "worker":
+        # Los trabajos sin terminar vuelven a la cola compartida para otro worker
+        for task_id in [entry['task_id'] for entry in interrupted_tasks] + list(queued_tasks):
+            job_store.release(task_id)
+        logger.info(f"↩️ {len(interrupted_tasks) + len(queued_tasks)} trabajos devueltos a la cola compartida.")
+    else:
+        try:
+            saved = save_checkpoint()
+            logger.info(f"💾 Checkpoint guardado en {CHECKPOINT_PATH}: {saved} tareas pendientes.")
+        except Exception as e:
+            logger.error(f"Error guardando el checkpoint: {e}", exc_info=True)
+    removed = cleanup_temp_files()
+    if tracer is not None:
+        try:
+            tracer.flush() # Los últimos spans (las tareas interrumpidas) no esperan al siguiente volcado
+        except Exception as e:
+            logger.warning(f"No se pudieron escribir las trazas en {TRACE_PATH}: {e}")
+    logger.info(f"✅ Drain completado. {removed} temporales eliminados. Saliendo.")
+    shutdown_event.set()
 
 # --- Manejadores de Pyrogram ---
 @app_telegram.on_message(filters.command("start"))
@@ -513,8 +2844,8 @@ async def start_command(client: Client, message: Message):
         "¡Hola! 👋\n\n"
         "Antes de usar el bot, necesitas conectar tu cuenta de Google Drive.\n"
         "Usa el comando /drive_login para autenticarte.\n\n"
-        "Después de autenticarte, envíame un video para subirlo a tu Google Drive.\n"
-        "Los videos se procesan en orden de llegada (cola).\n\n"
+        "Después de autenticarte, envíame un video, documento, audio o GIF para subirlo a tu Google Drive.\n"
+        "Los archivos se procesan en orden de llegada (cola).\n\n"
         "Usa los comandos del menú para interactuar conmigo.\n"
     )
     await message.reply_text(welcome_text)
@@ -523,9 +2854,12 @@ async def set_bot_commands(client: Client):
     commands = [
         BotCommand("start", "Mostrar mensaje de inicio"),
         BotCommand("drive_login", "Conectar tu cuenta de Google Drive"),
-        BotCommand("ver_nube", "Ver tus videos en la nube"),
+        BotCommand("ver_nube", "Ver tus archivos en la nube"),
         BotCommand("lista_aprobados", "🔐 Ver lista de usuarios aprobados (Admin)"),
         BotCommand("desaprobar_usuario", "🔐 Desaprobar un usuario (Admin)"),
+        BotCommand("stats", "🔐 Estado de la cola y transferencias (Admin)"),
+        BotCommand("cuota", "🔐 Ver o ajustar las cuotas de subida (Admin)"),
+        BotCommand("perfil", "🔐 Perfil de CPU por muestreo (Admin)"),
     ]
     try:
         await client.set_bot_commands(commands)
@@ -547,33 +2881,18 @@ async def drive_login_command(client: Client, message: Message):
             f"✅ ¡Hola Administrador {user_name}!\n"
             f"Asegúrate de que tu correo (`{ADMIN_EMAIL}`) esté en 'Usuarios de prueba'."
         )
-        state = secrets.token_urlsafe(32)
-        login_states[state] = user_id
-        creds_data = os.environ.get("GOOGLE_CREDENTIALS_JSON")
-        # --- CORREGIDO: 'creds_data' ---
-        if not creds_data:
+        if not GOOGLE_CLIENT_CONFIG:
             await message.reply_text("❌ Error: Credenciales de Google no configuradas.")
             return
         try:
-            async with aiofiles.open('credentials_temp.json', 'w') as f:
-                await f.write(creds_data)
-            flow = Flow.from_client_secrets_file(
-                'credentials_temp.json', scopes=SCOPES,
-                redirect_uri=RENDER_REDIRECT_URI)
-            authorization_url, _ = flow.authorization_url(
-                access_type='offline',
-                include_granted_scopes='true',
-                state=state)
-            login_url = authorization_url
+            await ensure_google_modules()
+            login_url = create_login_url(user_id)
             await message.reply_text(
                 f"**Haz clic aquí para autenticarte:**\n{login_url}"
             )
         except Exception as e:
             logger.error(f"Error login admin {user_id}: {e}")
             await message.reply_text("❌ Error al iniciar login.")
-        finally:
-            if os.path.exists('credentials_temp.json'):
-                os.remove('credentials_temp.json')
         return
 
     if user_id not in approved_users:
@@ -593,11 +2912,7 @@ async def drive_login_command(client: Client, message: Message):
             )
         return
 
-    state = secrets.token_urlsafe(32)
-    login_states[state] = user_id
-    creds_data = os.environ.get("GOOGLE_CREDENTIALS_JSON")
-    # --- CORREGIDO: 'creds_data' ---
-    if not creds_data:
+    if not GOOGLE_CLIENT_CONFIG:
         await message.reply_text("❌ Error del servidor: Credenciales no configuradas.")
         if ADMIN_TELEGRAM_ID:
             try:
@@ -606,16 +2921,8 @@ async def drive_login_command(client: Client, message: Message):
         return
 
     try:
-        async with aiofiles.open('credentials_temp.json', 'w') as f:
-            await f.write(creds_data)
-        flow = Flow.from_client_secrets_file(
-            'credentials_temp.json', scopes=SCOPES,
-            redirect_uri=RENDER_REDIRECT_URI)
-        authorization_url, _ = flow.authorization_url(
-            access_type='offline',
-            include_granted_scopes='true',
-            state=state)
-        login_url = authorization_url
+        await ensure_google_modules()
+        login_url = create_login_url(user_id)
         await message.reply_text(
             f"✅ ¡Hola {user_name}! Has sido aprobado.\n\n"
             f"**Haz clic aquí para autenticarte:**\n{login_url}"
@@ -627,9 +2934,6 @@ async def drive_login_command(client: Client, message: Message):
             try:
                 await client.send_message(ADMIN_TELEGRAM_ID, f"❌ Error en /drive_login para {user_id} ({user_name}): {e}")
             except: pass
-    finally:
-        if os.path.exists('credentials_temp.json'):
-            os.remove('credentials_temp.json')
 
 @app_telegram.on_message(filters.command("ver_nube"))
 async def ver_nube_command(client: Client, message: Message):
@@ -641,10 +2945,11 @@ async def ver_nube_command(client: Client, message: Message):
     if not service:
         await message.reply_text("❌ Problema de conexión con tu Drive. Intenta desconectarte y reconectarte.")
         return
-    status_message = await message.reply_text("🔍 Buscando videos...")
-    videos = list_drive_videos(user_id)
+    status_message = await message.reply_text("🔍 Buscando archivos...")
+    # Bloqueante (la primera vez también crea la carpeta y mueve los videos anteriores): en un hilo
+    videos = await asyncio.to_thread(list_drive_videos, user_id)
     if not videos:
-        await status_message.edit_text("No se encontraron videos en tu nube.")
+        await status_message.edit_text("No se encontraron archivos en tu nube.")
         return
     
     # --- MODIFICADO: Agregar botón para borrar todos ---
@@ -655,14 +2960,15 @@ async def ver_nube_command(client: Client, message: Message):
     reply_markup = InlineKeyboardMarkup(keyboard)
     # --- FIN MODIFICADO ---
     
-    response_text = f"*{len(videos)} videos en tu nube:*\n"
+    response_text = f"*{len(videos)} archivos en tu nube:*\n"
     for video in videos:
         file_name_to_display = video.get('display_name', 'Sin_nombre')
         file_id = video.get('id')
         display_name_limited = (file_name_to_display[:45] + '...') if len(file_name_to_display) > 48 else file_name_to_display
         file_url = get_file_url(file_id)
         delete_command = f"`/delete_{file_id}`"
-        response_text += f"\n🎬 [{display_name_limited}]({file_url})\n🗑️ {delete_command}\n"
+        icon = '🎬' if video.get('mimeType', '').startswith('video/') else '🎵' if video.get('mimeType', '').startswith('audio/') else '📄'
+        response_text += f"\n{icon} [{display_name_limited}]({file_url})\n🗑️ {delete_command}\n"
     
     if len(response_text) > 4096:
         # Si el mensaje es muy largo, dividirlo
@@ -676,19 +2982,94 @@ async def ver_nube_command(client: Client, message: Message):
         # Editar el mensaje con el botón
         await status_message.edit_text(response_text, parse_mode=enums.ParseMode.MARKDOWN, disable_web_page_preview=True, reply_markup=reply_markup)
 
-# --- CORREGIDO: handle_video con manejo de errores y almacenamiento anticipado ---
-@app_telegram.on_message(filters.video & filters.private)
-async def handle_video(client: Client, message: Message):
+# --- CORREGIDO: handle_media con manejo de errores y almacenamiento anticipado ---
+@app_telegram.on_message(media_filter & filters.private)
+async def handle_media(client: Client, message: Message):
     user_id = message.from_user.id
     if not is_user_authenticated(user_id):
         # Responder directamente al video con error
         await message.reply_text("❌ Conecta tu cuenta de Google Drive primero con /drive_login.")
         return
 
+    if BATCH_WINDOW <= 0:
+        await enqueue_media(client, [message])
+        return
+
+    # --- Agrupar álbumes y ráfagas del mismo usuario en un lote ---
+    now = time.monotonic()
+    media_group_id = getattr(message, 'media_group_id', None)
+    if media_group_id:
+        # Álbum: Telegram lo entrega como mensajes sueltos con el mismo media_group_id; todos, también el
+        # primero, esperan en el lote del álbum
+        key = (user_id, media_group_id)
+    else:
+        # Un archivo suelto se encola sin esperar: el lote solo se abre si llega otro dentro de BATCH_WINDOW
+        key = user_id
+        follows_recent = user_id in recent_media
+        recent_media[user_id] = now
+        if key not in pending_batches and not follows_recent:
+            await enqueue_media(client, [message])
+            return
+    batch = pending_batches.get(key)
+    if batch is None:
+        batch = pending_batches[key] = {'messages': [], 'started': now, 'last': now}
+        batch['timer'] = asyncio.create_task(_flush_batch_later(client, key, batch))
+    batch['messages'].append(message)
+    batch['last'] = now
+    if len(batch['messages']) >= BATCH_MAX_ITEMS:
+        pending_batches.pop(key, None)
+        batch['timer'].cancel()
+        await enqueue_media(client, batch['messages'])
+
+async def _flush_batch_later(client: Client, key, batch: dict):
+    """Cierra el lote cuando el usuario deja de enviar archivos durante BATCH_WINDOW (o tras BATCH_MAX_WAIT)."""
+    while True:
+        wait = min(batch['last'] + BATCH_WINDOW, batch['started'] + BATCH_MAX_WAIT) - time.monotonic()
+        if wait <= 0:
+            break
+        await asyncio.sleep(wait)
+    if pending_batches.get(key) is batch:
+        pending_batches.pop(key)
+        await enqueue_media(client, batch['messages'])
+
+async def flush_pending_batches(client: Client):
+    """Encola ya los lotes que aún estaban recibiendo archivos (p. ej. al empezar el drain)."""
+    for key, batch in list(pending_batches.items()):
+        pending_batches.pop(key, None)
+        batch['timer'].cancel()
+        await enqueue_media(client, batch['messages'])
+
+async def enqueue_media(client: Client, messages: list, enforce_quota: bool = True):
+    """Encola un archivo suelto o, si son varios, un lote con un solo mensaje de estado."""
+    messages = sorted(messages, key=lambda m: m.id) # Los álbumes pueden llegar desordenados
+    message = messages[0]
+    user_id = message.from_user.id
+    is_batch = len(messages) > 1
+
     global total_uploads_queued
 
     task_id = str(uuid.uuid4())
-    file_name = message.video.file_name or 'video.mp4'
+    file_name = describe_media(message)['file_name']
+
+    # --- Control de admisión: cuotas del usuario y límite global de la cola ---
+    total_size = sum(describe_media(m)['media'].file_size or 0 for m in messages)
+    rejection = admit_upload(user_id, task_id, len(messages), total_size, enforce=enforce_quota)
+    if rejection:
+        reason, retry_after = rejection
+        logger.info(f"{len(messages)} archivo(s) de user {user_id} rechazados al encolar (motivo: {reason}, reintento en {retry_after}s).")
+        try:
+            await message.reply_text(admission_rejection_text(user_id, reason, retry_after, len(messages)), reply_to_message_id=message.id)
+        except Exception as e:
+            logger.warning(f"Error notificando el rechazo al usuario {user_id}: {e}")
+        return
+    if tracer is not None:
+        tracer.name_lane(task_id, f"{file_name} · {task_id[:8]}")
+        tracer.instant("enqueue", task_id, user_id=user_id, files=len(messages), bytes=total_size)
+
+    if job_store is not None:
+        # Modo front: la transferencia la hace un proceso worker
+        await enqueue_shared_job(messages, task_id, file_name)
+        return
     
     # --- Calcular posición ---
     # Considerar tanto videos en cola como videos activos (en proceso)
@@ -703,13 +3084,17 @@ async def handle_video(client: Client, message: Message):
         'task_id': task_id,
         'user_id': user_id,
         'message': message,
-        'file_name': file_name
+        'file_name': file_name,
+        'enqueued_at': time.monotonic()
     }
+    if is_batch:
+        queue_item['messages'] = messages
     
     # --- Almacenar en queued_tasks primero ---
     queued_tasks[task_id] = {
         'user_id': user_id,
         'message_id': message.id,
+        'message_ids': [m.id for m in messages] if is_batch else None,
         'file_name': file_name,
         'position': new_position,
         'queue_status_message_id': None, # Se actualizará si se envía mensaje
@@ -718,16 +3103,34 @@ async def handle_video(client: Client, message: Message):
     
     # Poner la tarea en la cola de procesamiento
     await upload_queue.put(queue_item)
+    metrics.inc("bot_enqueued_total", len(messages))
+
+    if draining:
+        # Durante el apagado el video solo se guarda: se procesará cuando el bot vuelva a arrancar
+        try:
+            drain_message = await message.reply_text(
+                "⏸️ El bot se está reiniciando. Tu archivo quedó guardado en la cola y se procesará en cuanto vuelva.",
+                reply_to_message_id=message.id
+            )
+            queued_tasks[task_id]['queue_status_message_id'] = drain_message.id
+        except Exception as e:
+            logger.warning(f"Error notificando drain al usuario {user_id} para tarea {task_id}: {e}")
+        logger.info(f"Archivo de user {user_id} aceptado durante el drain. Tarea ID: {task_id}.")
+        return
     
     # --- MODIFICADO: Responder al video y considerar videos activos ---
     queue_status_message = None
-    # Mostrar mensaje de cola si hay videos en cola O videos activos (en proceso)
-    if (current_queue_size + current_active_size) > 0: 
+    # Mostrar mensaje de cola si hay videos en cola O videos activos (en proceso); un lote siempre lo recibe
+    if is_batch or (current_queue_size + current_active_size) > 0:
         try:
             # --- MODIFICADO: Usar reply_to_message_id para responder al video ---
             # Enviar el mensaje de estado de cola como respuesta al mensaje de video
+            if is_batch:
+                queue_text = f"📦 Recibidos {len(messages)} archivos: se subirán juntos. Posición en la cola: {new_position}."
+            else:
+                queue_text = f"⏳ Su archivo está en cola. Posición: {new_position}."
             queue_status_message = await message.reply_text(
-                f"⏳ Su video está en cola. Posición: {new_position}.",
+                queue_text,
                 reply_to_message_id=message.id # <-- Responder al video
             )
             # Actualizar queued_tasks con el message_id del mensaje enviado
@@ -736,14 +3139,17 @@ async def handle_video(client: Client, message: Message):
             logger.error(f"Error enviando mensaje de cola al usuario {user_id} para tarea {task_id}: {e}")
             # Si falla, intentar enviar un mensaje normal (no como respuesta)
             try:
-                fallback_message = await message.reply_text("⚠️ Hubo un error al notificarte sobre tu posición en la cola. El video se procesará igualmente.")
+                fallback_message = await message.reply_text("⚠️ Hubo un error al notificarte sobre tu posición en la cola. El archivo se procesará igualmente.")
                 # Opcionalmente, podríamos almacenar este fallback_message.id también
             except:
                 pass # Ignorar errores al enviar mensaje de fallback
     # Si no hay videos en cola ni activos, no se envía mensaje de cola.
     # El mensaje "Descargando..." vendrá del process_upload_queue y se creará nuevo (o editará el de cola).
 
-    logger.info(f"Video de user {user_id} agregado a la cola. Tarea ID: {task_id}. Posición: {new_position}.")
+    if is_batch:
+        logger.info(f"Lote de {len(messages)} archivos de user {user_id} agregado a la cola. Tarea ID: {task_id}. Posición: {new_position}.")
+    else:
+        logger.info(f"Archivo de user {user_id} agregado a la cola. Tarea ID: {task_id}. Posición: {new_position}.")
 
 @app_telegram.on_callback_query()
 async def on_callback_query(client: Client, callback_query: CallbackQuery):
@@ -760,6 +3166,7 @@ async def on_callback_query(client: Client, callback_query: CallbackQuery):
         # Verificar si es una cancelación de tarea en cola
         if identifier in queued_tasks:
             task_info = queued_tasks.pop(identifier)
+            release_quota(identifier)
             global total_uploads_queued
             total_uploads_queued -= 1
             cancelled_position = task_info.get('position', 0)
@@ -798,13 +3205,29 @@ async def on_callback_query(client: Client, callback_query: CallbackQuery):
                  await callback_query.answer("❌ No puedes cancelar la operación de otro usuario.", show_alert=True)
                  return # Salir si no tiene permiso
                  
+            # La transferencia en curso se aborta al momento y el worker publica "❌ Operación cancelada."
+            operation['cancel_requested_at'] = time.monotonic()
             operation['cancel_flag'].set()
-            status_message_id = operation['status_message_id']
-            # Usar la función auxiliar para actualizar el mensaje
-            await update_status_message(client, chat_id, status_message_id, "⏳ Cancelando operación...", operation['user_id'], remove_buttons=True)
             await callback_query.answer("Operación cancelada.")
             return # Salir después de manejar
 
+        # Modo front: la tarea puede estar en la cola compartida o en un worker
+        elif job_store is not None and (job := await asyncio.to_thread(job_store.get_job, identifier)):
+            job_status, job_user_id, job_chat_id, job_message_id = job
+            if job_user_id != user_id and user_id != ADMIN_TELEGRAM_ID:
+                await callback_query.answer("❌ No puedes cancelar la operación de otro usuario.", show_alert=True)
+                return
+            previous_status = await asyncio.to_thread(job_store.request_cancel, identifier)
+            if previous_status == 'queued':
+                await update_status_message(client, job_chat_id, job_message_id, "❌ Operación cancelada mientras estaba en cola.", job_user_id, remove_buttons=True)
+                await callback_query.answer("Operación cancelada mientras estaba en cola.", show_alert=True)
+            elif previous_status == 'running':
+                await update_status_message(client, job_chat_id, job_message_id, "⏳ Cancelando operación...", job_user_id, remove_buttons=True)
+                await callback_query.answer("Operación cancelada.")
+            else:
+                await callback_query.answer("❌ No se encontró la operación para cancelar.", show_alert=True)
+            return
+
         else:
              await callback_query.answer("❌ No se encontró la operación para cancelar.", show_alert=True)
              return # Salir si no se encuentra
@@ -819,10 +3242,10 @@ async def on_callback_query(client: Client, callback_query: CallbackQuery):
             return # Salir si el ID es inválido
 
         if user_id != target_user_id:
-            await callback_query.answer("❌ No puedes borrar videos de otro usuario.", show_alert=True)
+            await callback_query.answer("❌ No puedes borrar archivos de otro usuario.", show_alert=True)
             return # Salir si no es el propietario
 
-        await callback_query.answer("Iniciando borrado de todos los videos...")
+        await callback_query.answer("Iniciando borrado de todos los archivos...")
         # Llamar a la función de borrado masivo como una tarea en segundo plano
         asyncio.create_task(delete_all_user_videos(target_user_id, callback_query.message, client))
         return # Salir después de iniciar la tarea
@@ -865,7 +3288,7 @@ async def delete_file(client: Client, message: Message):
         return
     file_id = match.group(1)
     status_message = await message.reply_text("🗑️ Eliminando video...")
-    if delete_from_drive(file_id, user_id):
+    if await asyncio.to_thread(delete_from_drive, file_id, user_id):
         await status_message.edit_text("✅ Video eliminado exitosamente de tu Google Drive.")
     else:
         await status_message.edit_text("❌ Error al eliminar el video de tu Google Drive.")
@@ -882,6 +3305,11 @@ async def handle_user_email(client: Client, message: Message):
 
     if "@" in text and "." in text and " " not in text:
         email = text
+        if user_id not in pending_emails and pending_emails.full():
+            # Las solicitudes no caducan: con el mapa lleno se rechaza la nueva en vez de perder una antigua
+            logger.warning(f"⚠️ Solicitud de {user_id} rechazada: hay {len(pending_emails)} correos esperando aprobación.")
+            await message.reply_text("⚠️ Hay demasiadas solicitudes pendientes. Vuelve a intentarlo más tarde.")
+            return
         pending_emails[user_id] = email
         
         user_mention = message.from_user.username
@@ -1012,7 +3440,7 @@ async def revoke_user_command(client: Client, message: Message):
         if pending_email:
             logger.info(f"ℹ️ Correo pendiente eliminado para {target_user_id}: {pending_email}")
 
-        user_credentials.pop(target_user_id, None)
+        forget_credentials(target_user_id)
         logger.info(f"ℹ️ Credenciales eliminadas para {target_user_id} (si existían).")
 
         await message.reply_text(
@@ -1051,11 +3479,275 @@ async def list_approved_users_command(client: Client, message: Message):
     await message.reply_text(response_text, parse_mode=enums.ParseMode.MARKDOWN)
     logger.info(f"✅ Lista de aprobados enviada al admin {ADMIN_TELEGRAM_ID}")
 
+# --- Comando /stats (admin): mismo resumen que el panel en vivo ---
+@app_telegram.on_message(filters.command("stats") & filters.private)
+async def stats_command(client: Client, message: Message):
+    if message.from_user.id != ADMIN_TELEGRAM_ID:
+        await message.reply_text("❌ No tienes permiso para ejecutar este comando.")
+        return
+    text = format_stats_text(await build_dashboard_snapshot())
+    # Enlace de un solo uso y de vida corta: el token fijo nunca aparece en el chat
+    code = secrets.token_urlsafe(24)
+    dashboard_links[code] = True
+    text += f"\n\n🖥️ Panel en vivo (enlace de un solo uso, {_format_wait(DASHBOARD_LINK_TTL)}): {PUBLIC_BASE_URL}/admin?code={code}"
+    await message.reply_text(text, disable_web_page_preview=True)
+
+# --- Comando /cuota (admin): ver y ajustar en caliente las cuotas de admisión ---
+QUOTA_USAGE_TEXT = (
+    "Uso:\n"
+    "`/cuota` - límites globales y ajustes por usuario\n"
+    "`/cuota global <archivos|mb|hora|cola> <n>` - cambiar un límite global (0 = sin límite)\n"
+    "`/cuota <user_id>` - límites y uso de un usuario\n"
+    "`/cuota <user_id> <archivos|mb|hora> <n>` - límite propio del usuario (0 = sin límite)\n"
+    "`/cuota <user_id> exento|normal` - eximir al usuario o volver a los límites globales"
+)
+
+def _format_limit(value, unit=""):
+    return f"{value}{unit}" if value else "sin límite"
+
+def format_user_quota_text(user_id):
+    limits = user_quota(user_id)
+    usage = quota_usage.get(user_id, {'items': 0, 'bytes': 0})
+    lines = [f"🚦 Cuota de `{user_id}`" + (" (exento)" if limits is None else ""), ""]
+    if limits is not None:
+        lines.append(f"📦 Pendientes: {usage['items']} de {_format_limit(limits['archivos'])}")
+        lines.append(f"💾 Tamaño pendiente: {_format_bytes(usage['bytes'])} de {_format_limit(limits['mb'], ' MB')}")
+        if limits['hora']:
+            available = limits['hora']
+            if 'tokens' in usage:
+                _refill_hourly_tokens(usage, limits['hora'], time.monotonic())
+                available = int(usage['tokens'])
+            lines.append(f"⏱️ Por hora: {available} disponibles de {limits['hora']}")
+        else:
+            lines.append("⏱️ Por hora: sin límite")
+    else:
+        lines.append(f"📦 Pendientes: {usage['items']} ({_format_bytes(usage['bytes'])})")
+    if quota_overrides.get(user_id):
+        lines.append(f"🔧 Ajustes propios: {', '.join(f'{k}={v}' for k, v in quota_overrides[user_id].items())}")
+    return "\n".join(lines)
+
+def format_global_quota_text():
+    lines = ["🚦 Cuotas globales", ""]
+    lines.append(f"📦 Archivos pendientes por usuario: {_format_limit(quota_limits['archivos'])}")
+    lines.append(f"💾 MB pendientes por usuario: {_format_limit(quota_limits['mb'], ' MB')}")
+    lines.append(f"⏱️ Archivos por usuario y hora: {_format_limit(quota_limits['hora'])}")
+    lines.append(f"🌊 Archivos pendientes en total: {admitted_total} (límite: {_format_limit(quota_limits['cola'])})")
+    lines.append(f"⌛ Tiempo medio por archivo: {seconds_per_file:.1f} s")
+    if quota_overrides:
+        lines += ["", "🔧 Ajustes por usuario:"]
+        for uid, override in list(quota_overrides.items())[:30]:
+            lines.append(f"  • `{uid}`: {', '.join(f'{k}={v}' for k, v in override.items())}")
+    return "\n".join(lines)
+
+@app_telegram.on_message(filters.command("cuota") & filters.private)
+async def quota_command(client: Client, message: Message):
+    if message.from_user.id != ADMIN_TELEGRAM_ID:
+        await message.reply_text("❌ No tienes permiso para ejecutar este comando.")
+        return
+
+    args = message.text.strip().split()[1:]
+    if not args:
+        await message.reply_text(format_global_quota_text(), parse_mode=enums.ParseMode.MARKDOWN)
+        return
+
+    if args[0] == "global":
+        if len(args) != 3 or args[1] not in quota_limits or not args[2].isdigit():
+            await message.reply_text(QUOTA_USAGE_TEXT, parse_mode=enums.ParseMode.MARKDOWN)
+            return
+        quota_limits[args[1]] = int(args[2])
+        logger.info(f"🚦 Límite global '{args[1]}' cambiado a {args[2]} por el admin.")
+        await message.reply_text(f"✅ Límite global actualizado.\n\n{format_global_quota_text()}", parse_mode=enums.ParseMode.MARKDOWN)
+        return
+
+    if not args[0].isdigit():
+        await message.reply_text(QUOTA_USAGE_TEXT, parse_mode=enums.ParseMode.MARKDOWN)
+        return
+    target_user_id = int(args[0])
+
+    if len(args) == 2 and args[1] in ("exento", "normal"):
+        if args[1] == "exento":
+            quota_overrides[target_user_id] = {'exento': True}
+        else:
+            quota_overrides.pop(target_user_id, None)
+        logger.info(f"🚦 Cuota de {target_user_id}: {args[1]}.")
+    elif len(args) == 3 and args[1] in QUOTA_KEYS and args[2].isdigit():
+        override = quota_overrides.setdefault(target_user_id, {})
+        override.pop('exento', None)
+        override[args[1]] = int(args[2])
+        logger.info(f"🚦 Cuota de {target_user_id}: '{args[1]}' = {args[2]}.")
+    elif len(args) != 1:
+        await message.reply_text(QUOTA_USAGE_TEXT, parse_mode=enums.ParseMode.MARKDOWN)
+        return
+
+    await message.reply_text(format_user_quota_text(target_user_id), parse_mode=enums.ParseMode.MARKDOWN)
+
+# --- Comando /perfil (admin): perfil por muestreo del proceso ---
+@app_telegram.on_message(filters.command("perfil") & filters.private)
+async def profile_command(client: Client, message: Message):
+    if message.from_user.id != ADMIN_TELEGRAM_ID:
+        await message.reply_text("❌ No tienes permiso para ejecutar este comando.")
+        return
+    args = message.text.strip().split()[1:]
+    try:
+        seconds = float(args[0]) if args else 10.0
+    except ValueError:
+        await message.reply_text(f"Uso: `/perfil [segundos]` (máximo {PROFILE_MAX_SECONDS:.0f})", parse_mode=enums.ParseMode.MARKDOWN)
+        return
+    if profile_lock.locked():
+        await message.reply_text("⏳ Ya hay un perfil en curso. Inténtalo cuando termine.")
+        return
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    await message.reply_text(f"🔥 Perfilando el bot durante {seconds:.0f}s...")
+    collapsed = await run_sampling_profile(seconds)
+    document = io.BytesIO(collapsed.encode())
+    document.name = f"perfil-{WORKER_ID}-{int(time.time())}.folded"
+    await client.send_document(
+        message.chat.id, document,
+        caption="🔥 Pilas colapsadas: ábrelo en speedscope.app o con flamegraph.pl.",
+        reply_to_message_id=message.id
+    )
+
 # --- Rutas Web OAuth (Corregidas) ---
+@app_quart.before_serving
+async def on_http_ready():
+    record_startup_phase('http')
+    http_ready.set()
+
 @app_quart.route('/')
 async def index():
     return '<h1>Bot Listo</h1><p>El bot está en funcionamiento.</p>'
 
+@app_quart.route('/healthz')
+async def healthz():
+    # Vivo mientras el loop responda y el procesador de cola no haya muerto (durante el arranque aún no existe).
+    # Durante el drain el procesador se detiene a propósito: matar el proceso ahí perdería el checkpoint
+    status = get_health_status()
+    worker_died = queue_processor_task is not None and queue_processor_task.done() and not draining
+    # Si el arranque falló, queue_processor_task nunca llega a existir: sin esto se vería "ok" para siempre
+    healthy = startup_error is None and not worker_died and status['loop_lag_seconds'] <= LOOP_LAG_THRESHOLD
+    status['status'] = ('draining' if draining else 'ok') if healthy else 'unhealthy'
+    return jsonify(status), 200 if healthy else 503
+
+@app_quart.route('/readyz')
+async def readyz():
+    # Listo para recibir tráfico (incluidos callbacks OAuth) solo si además Telegram está conectado
+    status = get_health_status()
+    ready = (status['worker_alive'] and status['telegram_connected'] and not status['draining']
+             and status['loop_lag_seconds'] <= LOOP_LAG_THRESHOLD)
+    status['status'] = 'ready' if ready else 'not_ready'
+    return jsonify(status), 200 if ready else 503
+
+@app_quart.route('/metrics')
+async def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+DASHBOARD_HTML = """<!doctype html>
+<html><head><meta charset="utf-8"><title>Panel del bot</title>
+<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse}td,th{border:1px solid #ccc;padding:4px 8px}</style>
+</head><body>
+<h1>Panel del bot</h1><p id="summary">Conectando...</p>
+<h2>Transferencias activas</h2><table id="active"></table>
+<h2>Errores recientes</h2><table id="failures"></table>
+<script>
+// Nombres de archivo y errores vienen de los usuarios: siempre como texto, nunca como HTML
+const row = (tag, values) => {
+  const tr = document.createElement("tr");
+  for (const value of values) {
+    const cell = document.createElement(tag);
+    cell.textContent = value ?? "";
+    tr.appendChild(cell);
+  }
+  return tr;
+};
+const fill = (id, items, cols) => document.getElementById(id).replaceChildren(row("th", cols), ...items.map(i => row("td", cols.map(c => i[c]))));
+const source = new EventSource("admin/stream"); // Autenticado por la cookie que fija /admin
+source.onmessage = e => {
+  const s = JSON.parse(e.data);
+  document.getElementById("summary").textContent = `Modo ${s.worker_mode} · en cola ${s.queue.queued} · activas ${s.active.length}`
+    + (s.workers.utilization_60s !== undefined ? ` · uso del worker (60s) ${Math.round(s.workers.utilization_60s * 100)}%` : "")
+    + (s.draining ? " · DRAIN" : "");
+  const activeCols = ["file_name", "user_id", "stage", "bytes_done", "bytes_total", "rate_bytes_per_second", "eta_seconds", "worker_id"];
+  fill("active", s.active, activeCols);
+  const failureCols = ["file_name", "user_id", "stage", "error"];
+  fill("failures", s.recent_failures.slice().reverse(), failureCols);
+};
+</script></body></html>"""
+
+DASHBOARD_COOKIE = 'dashboard_session'
+
+def dashboard_authorized():
+    """Cookie de sesión del panel o Authorization: Bearer <DASHBOARD_TOKEN>. Nunca un token en la URL."""
+    session = request.cookies.get(DASHBOARD_COOKIE)
+    if session and session in dashboard_sessions:
+        return True
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    return bool(token) and secrets.compare_digest(token, DASHBOARD_TOKEN)
+
+@app_quart.route('/admin')
+async def admin_dashboard():
+    code = request.args.get('code') or request.args.get('token')
+    if code:
+        # Intercambio: el enlace de /stats (un solo uso) o el token fijo se cambian por una cookie de sesión
+        # HttpOnly y se quitan de la URL (historial, cabecera Referer y scripts de la página dejan de verlos)
+        if not (dashboard_links.pop(code, None) or secrets.compare_digest(code, DASHBOARD_TOKEN)):
+            return 'Enlace no válido o caducado. Pide uno nuevo con /stats.', 403
+        session = secrets.token_urlsafe(32)
+        dashboard_sessions[session] = True
+        response = redirect('/admin')
+        response.set_cookie(DASHBOARD_COOKIE, session, httponly=True, samesite='Lax', path='/admin',
+                            max_age=DASHBOARD_SESSION_TTL, secure=PUBLIC_BASE_URL.startswith('https://'))
+        return response
+    if not dashboard_authorized():
+        return 'No autorizado.', 403
+    return DASHBOARD_HTML, 200, {'Referrer-Policy': 'no-referrer', 'Cache-Control': 'no-store'}
+
+@app_quart.route('/admin/profile')
+async def admin_profile():
+    """Perfil por muestreo de ?seconds= segundos (10 por defecto), descargable como pilas colapsadas."""
+    if not dashboard_authorized():
+        return 'No autorizado.', 403
+    if profile_lock.locked():
+        return 'Ya hay un perfil en curso.', 409
+    try:
+        seconds = float(request.args.get('seconds', 10))
+    except ValueError:
+        return 'seconds debe ser un número.', 400
+    collapsed = await run_sampling_profile(seconds)
+    return collapsed, 200, {
+        'Content-Type': 'text/plain; charset=utf-8',
+        'Content-Disposition': f'attachment; filename="perfil-{WORKER_ID}-{int(time.time())}.folded"',
+    }
+
+@app_quart.route('/admin/stream')
+async def admin_stream():
+    if not dashboard_authorized():
+        return 'No autorizado.', 403
+    if len(dashboard_hub.subscribers) >= DASHBOARD_MAX_WATCHERS:
+        return 'Demasiados paneles abiertos.', 503
+    queue = dashboard_hub.subscribe()
+    first = None if dashboard_hub.latest is not None else json.dumps(await build_dashboard_snapshot())
+
+    async def events():
+        try:
+            if first is not None:
+                yield f"data: {first}\n\n"
+            while True:
+                try:
+                    payload = await asyncio.wait_for(queue.get(), 15)
+                    yield f"data: {payload}\n\n"
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n" # Evita que los proxies cierren la conexión inactiva
+        finally:
+            dashboard_hub.unsubscribe(queue)
+
+    response = await make_response(events(), 200, {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response.timeout = None # Conexión de larga duración
+    return response
+
 @app_quart.route('/oauth2callback')
 async def oauth2callback():
     code = request.args.get('code')
@@ -1069,22 +3761,17 @@ async def oauth2callback():
     if not user_id:
         return 'Error: No se pudo asociar el código con un usuario.', 400
 
-    creds_data = os.environ.get("GOOGLE_CREDENTIALS_JSON")
-    # --- CORREGIDO: 'creds_data' ---
-    if not creds_data:
+    if not GOOGLE_CLIENT_CONFIG:
         return "Error: GOOGLE_CREDENTIALS_JSON no está configurado.", 500
 
     try:
-        async with aiofiles.open('credentials_temp.json', 'w') as f:
-            await f.write(creds_data)
-        flow = Flow.from_client_secrets_file(
-            'credentials_temp.json', scopes=SCOPES,
-            redirect_uri=RENDER_REDIRECT_URI)
-        flow.fetch_token(code=code)
+        await ensure_google_modules()
+        flow = build_oauth_flow()
+        # El intercambio del código es una petición HTTP bloqueante: fuera del event loop
+        await asyncio.to_thread(flow.fetch_token, code=code)
         creds = flow.credentials
-        user_credentials[user_id] = creds
-        if os.path.exists('credentials_temp.json'):
-            os.remove('credentials_temp.json')
+        await asyncio.to_thread(remember_credentials, user_id, creds)
+        await asyncio.to_thread(forget_drive_folder, user_id) # Puede ser otra cuenta de Google
         return """
         <h1>¡Autenticación Exitosa!</h1>
         <p>Tu cuenta de Google Drive ha sido conectada.</p>
@@ -1093,28 +3780,85 @@ async def oauth2callback():
         """
     except Exception as e:
         logger.error(f"Error en oauth2callback para {user_id}: {e}")
-        if os.path.exists('credentials_temp.json'):
-            os.remove('credentials_temp.json')
         # --- CORREGIDO: Asegurar que se devuelve una tupla (respuesta, código) ---
         return f'Error durante la autenticación: {e}', 500
     # --- FIN CORREGIDO ---
 
 # --- Punto de Entrada ---
+record_startup_phase('import')
+
 if __name__ == "__main__":
     async def run_bot():
+        # El servidor HTTP (health/OAuth) se enlaza primero; Google y Telegram arrancan después
+        await http_ready.wait()
+        warm_up_task = asyncio.create_task(asyncio.to_thread(warm_up_google))
+
         await app_telegram.start()
+        record_startup_phase('telegram')
         logger.info("Bot de Telegram iniciado.")
-        await set_bot_commands(app_telegram)
-        
-        queue_processor_task = asyncio.create_task(process_upload_queue(app_telegram))
-        logger.info("Procesador de cola iniciado.")
+        if WORKER_MODE != "front":
+            await start_download_sessions()
+        if WORKER_MODE != "worker":
+            await set_bot_commands(app_telegram)
+
+        # El procesador de cola necesita Telegram y los módulos de Google listos
+        await warm_up_task
+        removed = cleanup_temp_files()
+        if removed:
+            logger.info(f"🧹 {removed} temporales de una ejecución anterior eliminados.")
+        global queue_processor_task
+        if WORKER_MODE == "worker":
+            # Solo transfiere: el front recibe los mensajes y publica el progreso
+            queue_processor_task = asyncio.create_task(process_upload_queue(JobReportingClient(app_telegram)))
+            asyncio.create_task(feed_shared_jobs(app_telegram))
+            asyncio.create_task(renew_job_leases())
+            logger.info(f"Worker {WORKER_ID} iniciado sobre {JOB_DB_PATH}.")
+        else:
+            await restore_checkpoint(app_telegram)
+            if WORKER_MODE == "front":
+                queue_processor_task = asyncio.create_task(relay_shared_jobs(app_telegram))
+                logger.info(f"Modo front: las transferencias las hacen los workers de {JOB_DB_PATH}.")
+            else:
+                queue_processor_task = asyncio.create_task(process_upload_queue(app_telegram))
+                logger.info("Procesador de cola iniciado.")
+        record_startup_phase('worker')
 
     async def run_quart():
         # --- CORREGIDO: Asegurar el binding al puerto correcto ---
         port = int(os.environ.get("PORT", 10000))
         logger.info(f"Iniciando servidor Quart en 0.0.0.0:{port}")
-        await app_quart.run_task(host="0.0.0.0", port=port)
+        await app_quart.run_task(host="0.0.0.0", port=port, shutdown_trigger=shutdown_event.wait)
 
     loop = asyncio.get_event_loop()
+    shutdown_signals = 0
+
+    def on_shutdown_signal():
+        # La primera señal inicia el drain; la segunda sale en el acto (drain atascado)
+        global shutdown_signals
+        shutdown_signals += 1
+        if shutdown_signals == 1:
+            loop.create_task(drain_and_shutdown(app_telegram))
+            return
+        logger.warning("⚠️ Segunda señal de apagado: saliendo sin esperar al drain (no se guarda checkpoint).")
+        log_listener.stop() # os._exit no ejecuta atexit: vaciar antes la cola de logs
+        os._exit(1)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, on_shutdown_signal)
+    loop_monitor_task = loop.create_task(monitor_event_loop())
+    state_sweeper_task = loop.create_task(sweep_expiring_maps())
+    dashboard_task = loop.create_task(publish_dashboard())
+    if tracer is not None:
+        trace_export_task = loop.create_task(export_traces())
     bot_task = loop.create_task(run_bot())
+
+    def on_bot_task_done(task):
+        # Nadie espera a run_bot: su excepción se registra aquí y marca el proceso como no sano
+        global startup_error
+        if task.cancelled() or task.exception() is None:
+            return
+        startup_error = f"{type(task.exception()).__name__}: {task.exception()}"
+        logger.critical(f"❌ El arranque del bot falló: {startup_error}", exc_info=task.exception())
+
+    bot_task.add_done_callback(on_bot_task_done)
     quart_task = loop.run_until_complete(run_quart())